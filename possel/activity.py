@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+possel.activity
+---------------
+
+Read markers, and the unread and mention counts that go with them. The counts are kept up to date as lines arrive so
+clients can show activity for every buffer without downloading any scrollback.
+
+Every buffer's unread lines are counted once, the first time someone without a read marker in it needs its counts, and
+kept up to date from then on; that's the count for any buffer a user hasn't got a read marker in. Buffers they have are
+counted from the marker on, using the lines' buffer index, when their counts are first needed.
+"""
+import collections
+import logging
+
+import peewee as p
+from pircel import signals
+
+from possel import auth, highlights, model
+
+logger = logging.getLogger(__name__)
+
+# UNREAD_CHANGED is about our users rather than anything on IRC, so it doesn't belong with the model's signals
+signal_factory = signals.namespace('activity')
+
+
+# Only these kinds of line count as unread, nobody wants a badge for a netsplit
+UNREAD_KINDS = ('message', 'notice', 'action')
+
+# Callback signal definitions
+UNREAD_CHANGED = 'unread_changed'
+
+
+class ReadMarkerModel(model.BaseModel):
+    """ How far through a buffer each of our users has read. """
+    user = p.ForeignKeyField(auth.UserModel, related_name='read_markers', on_delete='CASCADE')
+    buffer = p.ForeignKeyField(model.IRCBufferModel, related_name='read_markers', on_delete='CASCADE')
+    line = p.IntegerField()  # id of the last line read
+
+    class Meta:
+        indexes = ((('user', 'buffer'), True),
+                   )
+
+
+class BufferActivity:
+    __slots__ = ('unread', 'mentions', 'last_read')
+
+    def __init__(self, unread=0, mentions=0, last_read=0):
+        self.unread = unread
+        self.mentions = mentions
+        self.last_read = last_read
+
+    def to_dict(self):
+        return {'unread': self.unread, 'mentions': self.mentions, 'last_read': self.last_read}
+
+
+def _unread_after_markers(user_id, markers):
+    """ Count the lines after each of a user's read markers.
+
+    Args:
+        markers (dict): The user's read markers, buffer id -> id of the last line read.
+
+    Returns:
+        list: (buffer id, count) tuples, for buffers with any unread lines.
+    """
+    if not model.line_store.sharded:
+        line, marker = model.IRCLineModel, ReadMarkerModel
+        return list(line
+                    .select(line.buffer, p.fn.COUNT(line.id))
+                    .join(marker, on=((marker.buffer == line.buffer) & (marker.user == user_id)))
+                    .where(line.kind << UNREAD_KINDS, line.id > marker.line)
+                    .group_by(line.buffer)
+                    .tuples())
+
+    # The markers are in a different database to the lines, so count each marked buffer on its own
+    return [(buffer_id, model.line_store.count(buffer_id, line_id, UNREAD_KINDS))
+            for buffer_id, line_id in markers.items()]
+
+
+def _unread_mentions(user_id):
+    """ Count the mentions in each buffer after the user's read marker for it. """
+    mention = highlights.MentionModel
+    return (mention
+            .select(mention.buffer, p.fn.COUNT(mention.id))
+            .join(ReadMarkerModel, p.JOIN.LEFT_OUTER,
+                  on=((ReadMarkerModel.buffer == mention.buffer) & (ReadMarkerModel.user == user_id)))
+            .where(mention.line > p.fn.COALESCE(ReadMarkerModel.line, 0))
+            .group_by(mention.buffer))
+
+
+class Counters:
+    """ Unread and mention counts for every buffer, for each of our users.
+
+    A user's counts are loaded with a few queries the first time they're asked for and from then on are only ever
+    incremented as lines arrive, never recounted.
+    """
+    def __init__(self):
+        self._users = {}  # auth user id -> {buffer id: BufferActivity}
+        self._totals = collections.Counter()  # buffer id -> unread lines for someone who's never read it
+        self._uncounted = None  # ids of the buffers whose totals aren't known yet, None before the first count
+
+    def reset(self):
+        """ Forget every count, for a new database. """
+        self._users.clear()
+        self._totals.clear()
+        self._uncounted = None
+
+    def _count_totals(self, marked):
+        """ Count the unread lines of the buffers without a read marker in ``marked``, unless they have been already.
+
+        The first time, that's every buffer except those in ``marked``; they're counted one at a time when someone
+        without a marker in them turns up.
+        """
+        if self._uncounted is None:
+            self._totals.update(dict(model.line_store.counts(UNREAD_KINDS, exclude=marked)))
+            self._uncounted = set(marked)
+            return
+        for buffer_id in self._uncounted - set(marked):
+            count = model.line_store.count(buffer_id, kinds=UNREAD_KINDS)
+            if count:
+                self._totals[buffer_id] = count
+            self._uncounted.discard(buffer_id)
+
+    def load(self, user_id):
+        activity = self._users.get(user_id)
+        if activity is None:
+            activity = self._users[user_id] = {}
+            markers = dict(ReadMarkerModel
+                           .select(ReadMarkerModel.buffer, ReadMarkerModel.line)
+                           .where(ReadMarkerModel.user == user_id)
+                           .tuples())
+            for buffer_id, line_id in markers.items():
+                activity[buffer_id] = BufferActivity(last_read=line_id)
+            self._count_totals(markers)
+            for buffer_id, count in self._totals.items():
+                if buffer_id not in markers:
+                    activity[buffer_id] = BufferActivity(unread=count)
+            for buffer_id, count in _unread_after_markers(user_id, markers):
+                activity[buffer_id].unread = count
+            for buffer_id, count in _unread_mentions(user_id).tuples():
+                activity.setdefault(buffer_id, BufferActivity()).mentions = count
+        return activity
+
+    def get(self, user_id):
+        """ Get a user's counts for all buffers with any activity or a read marker, keyed by buffer id. """
+        return {buffer_id: buffer.to_dict() for buffer_id, buffer in self.load(user_id).items()}
+
+    def _changed(self, user_id, buffer_id, line_id, buffer):
+        signal_factory(UNREAD_CHANGED).send(None, user_id=user_id, buffer_id=buffer_id, line_id=line_id,
+                                            activity=buffer)
+
+    def on_new_line(self, _, line, server):
+        if line.kind not in UNREAD_KINDS:
+            return
+
+        if self._uncounted is not None and line.buffer_id not in self._uncounted:
+            self._totals[line.buffer_id] += 1  # otherwise it's counted when it's first needed
+
+        for user_id, activity in self._users.items():
+            buffer = activity.setdefault(line.buffer_id, BufferActivity())
+            buffer.unread += 1
+            self._changed(user_id, line.buffer_id, line.id, buffer)
+
+    def on_new_mention(self, _, mention, line):
+        for user_id, activity in self._users.items():
+            buffer = activity.setdefault(line.buffer_id, BufferActivity())
+            buffer.mentions += 1
+            self._changed(user_id, line.buffer_id, line.id, buffer)
+
+    def mark_read(self, user_id, buffer_id, line_id):
+        """ Move a user's read marker for a buffer and recount what's left after it. """
+        updated = (ReadMarkerModel
+                   .update(line=line_id)
+                   .where(ReadMarkerModel.user == user_id, ReadMarkerModel.buffer == buffer_id)
+                   .execute())
+        if not updated:
+            ReadMarkerModel.create(user=user_id, buffer=buffer_id, line=line_id)
+
+        buffer = self.load(user_id).setdefault(buffer_id, BufferActivity())
+        buffer.last_read = line_id
+        buffer.unread = model.line_store.count(buffer_id, line_id, UNREAD_KINDS)
+        buffer.mentions = (highlights.MentionModel
+                           .select()
+                           .where(highlights.MentionModel.buffer == buffer_id,
+                                  highlights.MentionModel.line > line_id)
+                           .count())
+        return buffer
+
+    def stats(self):
+        return {'users': len(self._users),
+                'buffers': sum(len(activity) for activity in self._users.values()),
+                }
+
+
+counters = Counters()
+model.signal_factory(model.NEW_LINE).connect(counters.on_new_line)
+model.signal_factory(highlights.NEW_MENTION).connect(counters.on_new_mention)
+
+
+def initialize():
+    model.database.create_tables([ReadMarkerModel], safe=True)
+    counters.reset()
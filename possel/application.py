@@ -2,42 +2,61 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import contextlib
+import cProfile
+import io
 import logging
 import os
+import pstats
+import random
 import socket
-import ssl
+import time
 
-from OpenSSL import crypto
 from pircel import tornado_adapter
 
 from playhouse import db_url
 
 import tornado.ioloop
+import tornado.netutil
 import tornado.web
 from tornado.web import url
 
-from possel import auth, model, push, resources, web_client
+from possel import (activity, archive, assets, auth, debug, highlights, linelog, linestore, longpoll, maintenance,
+                    model, monitor, push, queries, resources, web_client)
+
+logger = logging.getLogger(__name__)
 
 
 def get_routes(interfaces):
     interface_routes = [url(r'/line', resources.LinesHandler),
+                        url(r'/line/wait', resources.LineWaitHandler),
                         url(r'/session', resources.SessionHandler, name='session'),
                         url(r'/buffer/([0-9]+|all)', resources.BufferGetHandler),
                         url(r'/buffer', resources.BufferPostHandler),
                         url(r'/server/([0-9]+|all)', resources.ServerGetHandler),
                         url(r'/server', resources.ServerPostHandler),
-                        url(r'/user/([0-9]+|all)', resources.UserGetHandler),
+                        url(r'/user(?:/([0-9]+|all))?', resources.UserGetHandler),
+                        url(r'/roster/([0-9]+)', resources.RosterHandler),
+                        url(r'/activity', resources.ActivityHandler),
+                        url(r'/mentions', resources.MentionsHandler),
+                        url(r'/retention', resources.RetentionHandler),
+                        url(r'/stats', resources.StatsHandler),
+                        url(r'/debug/(profile|memory|objects)', resources.DebugHandler),
                         url(r'/push', push.ResourcePusher, name='push'),
                         ]
     for route in interface_routes:
         route.kwargs.update(interfaces=interfaces)
 
     routes = [url(r'/', web_client.WebUIServer, name='index'),
+              url(r'/assets/(.+)', assets.AssetHandler),
               ] + interface_routes
     return routes
 
 
 def generate_cert():
+        # Only needed to make certificates, and pyOpenSSL takes a while to import
+        from OpenSSL import crypto
+
         # create a key pair
         key = crypto.PKey()
         key.generate_key(crypto.TYPE_RSA, 1024)
@@ -59,6 +78,7 @@ def generate_cert():
 
 
 def get_ssl_context(args):
+    import ssl
     ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     ssl_ctx.load_cert_chain(args.certificate, args.certificate.replace('crt', 'key'))
     return ssl_ctx
@@ -76,10 +96,79 @@ settings = {'template_path': get_relative_path('data/templates'),
             }
 
 
+class StartupProfile:
+    """ Times each phase of startup, and with ``enabled`` profiles the lot and logs where the time went. """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = []
+        self.start = time.monotonic()
+        self.profiler = cProfile.Profile() if enabled else None
+        if enabled:
+            self.profiler.enable()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        yield
+        self.phases.append((name, time.monotonic() - start))
+
+    def report(self):
+        total = time.monotonic() - self.start
+        logger.info('Started up in %.3fs', total)
+        if not self.enabled:
+            return
+
+        self.profiler.disable()
+        for name, seconds in self.phases:
+            logger.info('    %-24s %.3fs', name, seconds)
+
+        output = io.StringIO()
+        pstats.Stats(self.profiler, stream=output).sort_stats('cumulative').print_stats(30)
+        logger.info('Startup profile:\n%s', output.getvalue())
+
+
+def connect_all(clients, stagger):
+    """ Connect every client without waiting for each in turn, spreading the connections out so we don't hit the servers
+    (or our own network) with all of them at once.
+
+    Args:
+        stagger (float): Roughly how many seconds apart to start connections.
+    """
+    io_loop = tornado.ioloop.IOLoop.current()
+    for i, client in enumerate(clients):
+        io_loop.call_later(i * stagger + random.uniform(0, stagger), client.connect)
+
+
 def get_etc_file(filename):
     return os.path.join('/etc/possel', filename)
 
 
+def parse_intervals(strings):
+    """ Parse ``--maintenance`` options into a dict of job name -> seconds, 0 to turn the job off. """
+    intervals = {}
+    for string in strings:
+        name, _, seconds = string.partition('=')
+        if name not in maintenance.JOBS:
+            raise SystemExit('Unknown maintenance job "{}"'.format(name))
+        try:
+            interval = float(seconds)
+        except ValueError:
+            interval = None
+        if interval is None or interval < 0:
+            raise SystemExit('The interval for maintenance job "{}" has to be a number of seconds, or 0 to turn it '
+                             'off, not "{}"'.format(name, seconds))
+        intervals[name] = interval
+    return intervals
+
+
+def positive_seconds(string):
+    """ argparse type for a number of seconds that has to be more than none. """
+    seconds = float(string)
+    if seconds <= 0:
+        raise argparse.ArgumentTypeError('must be more than 0 seconds, not {}'.format(string))
+    return seconds
+
+
 def get_arg_parser():
     arg_parser = argparse.ArgumentParser(description='Possel Server')
     arg_parser.add_argument('-d', '--database', default='sqlite:///possel.db',
@@ -91,11 +180,50 @@ def get_arg_parser():
     arg_parser.add_argument('-b', '--bind-address', default='',
                             help='Address possel server will listen on (e.g. 0.0.0.0 for IPv4)')
     arg_parser.add_argument('-D', '--debug', action='store_true',
-                            help='Turn on debug logging and show exceptions in the browser')
+                            help='Turn on debug logging, show exceptions in the browser and log lazy relation loads')
     arg_parser.add_argument('-c', '--certificate', default=get_etc_file('cert.pem'),
                             help='The X.509 certificate to present to clients')
     arg_parser.add_argument('-s', '--secure', action='store_true',
                             help='Enable SSL on the web server')
+    arg_parser.add_argument('--line-cache-depth', type=int, default=500,
+                            help='How many of the most recent lines to keep in memory for each buffer')
+    arg_parser.add_argument('--line-cache-size', type=int, default=64,
+                            help='Cap on the memory used by the in-memory line cache across all buffers, in MiB')
+    arg_parser.add_argument('--longpoll-lines', type=int, default=10000,
+                            help='How many recent lines (across all buffers) to keep in memory for /line/wait')
+    arg_parser.add_argument('--retention-days', type=int, default=None,
+                            help='Move lines older than this many days out of the database and into the archive '
+                            '(buffers can override this), by default lines stay in the database forever')
+    arg_parser.add_argument('--archive-dir', default='possel-archive',
+                            help='Where to keep archived lines')
+    line_storage = arg_parser.add_mutually_exclusive_group()
+    line_storage.add_argument('--line-shards', metavar='DIR',
+                              help='Keep each server\'s lines in its own SQLite database in this directory, so busy '
+                              'networks can be written in parallel')
+    line_storage.add_argument('--line-log', metavar='DIR',
+                              help='Keep lines in append-only per-buffer log files in this directory instead of the '
+                              'database')
+    arg_parser.add_argument('--line-log-sync', type=float, default=1.0, metavar='SECONDS',
+                            help='How often to sync the line log to disk, at most this much is lost in a crash')
+    default_intervals = ', '.join('{} ({}s)'.format(name, seconds)
+                                  for name, seconds in sorted(maintenance.DEFAULT_INTERVALS.items()))
+    arg_parser.add_argument('--maintenance', action='append', default=[], metavar='JOB=SECONDS',
+                            help='How often to run a maintenance job, 0 for never. Jobs (and default intervals) are: '
+                            '{}'.format(default_intervals))
+    arg_parser.add_argument('--highlight', action='append', default=[], metavar='WORD',
+                            help='Treat lines containing this word as mentioning us, can be given more than once')
+    arg_parser.add_argument('--connect-stagger', type=float, default=0.2, metavar='SECONDS',
+                            help='Roughly how far apart to start connecting to each server')
+    arg_parser.add_argument('--ping-interval', type=positive_seconds, default=30, metavar='SECONDS',
+                            help='How often to ping websocket clients')
+    arg_parser.add_argument('--ping-timeout', type=positive_seconds, default=90, metavar='SECONDS',
+                            help='Disconnect websocket clients we have not heard from in this long')
+    arg_parser.add_argument('--admin', action='append', default=[], metavar='USERNAME',
+                            help='Let this user use the /debug endpoints, can be given more than once')
+    arg_parser.add_argument('--slow-callback-ms', type=float, default=100,
+                            help='Log IRC callbacks, HTTP requests and IOLoop lag taking longer than this')
+    arg_parser.add_argument('--profile-startup', action='store_true',
+                            help='Log how long each part of startup took and a profile of where the time went')
     arg_parser.add_argument('--log-irc', action='store_true',
                             help='Log lines from IRC verbatim in addition to any other logging')
     arg_parser.add_argument('--log-database', action='store_true',
@@ -128,25 +256,57 @@ def main():
     # </setup logging>
 
     settings['debug'] = args.debug
-
-    db = db_url.connect(args.database)
-    model.database.initialize(db)
-    model.database.connect()
-    model.initialize()
-    auth.create_tables()
-
-    interfaces = model.IRCServerInterface.get_all()
-    clients = {interface_id: tornado_adapter.IRCClient.from_interface(interface)
-               for interface_id, interface in interfaces.items()}
-    for client in clients.values():
-        client.connect()
-
-    ssl_ctx = get_ssl_context(args) if args.secure else None
-
-    application = tornado.web.Application(get_routes(interfaces), **settings)
-    application.listen(args.port, args.bind_address, ssl_options=ssl_ctx)
-
-    tornado.ioloop.IOLoop.current().start()
+    settings['log_function'] = monitor.monitor.log_request
+    settings['admins'] = set(args.admin)
+    if args.debug:
+        queries.enable()
+    monitor.monitor.configure(threshold=args.slow_callback_ms / 1000)
+    profile = StartupProfile(args.profile_startup)
+
+    with profile.phase('database'):
+        db = db_url.connect(args.database)
+        model.database.initialize(db)
+        monitor.monitor.watch_database(db)
+        model.database.connect()
+        model.initialize()
+        auth.create_tables()
+        if args.line_shards:
+            linestore.initialize(args.line_shards)
+        elif args.line_log:
+            linelog.initialize(args.line_log, args.line_log_sync)
+        activity.initialize()
+        archive.initialize(args.archive_dir, args.retention_days)
+        model.recent_lines.configure(args.line_cache_depth, args.line_cache_size * 1024 * 1024)
+        longpoll.initialize(args.longpoll_lines)
+
+    with profile.phase('interfaces'):
+        interfaces = model.IRCServerInterface.get_all()
+        highlights.initialize(interfaces, args.highlight)
+
+    with profile.phase('connections'):
+        # Tornado's default resolver blocks the IOLoop, which would have us look up every server one after the other
+        tornado.netutil.Resolver.configure('tornado.netutil.ThreadedResolver')
+        clients = [tornado_adapter.IRCClient.from_interface(interface) for interface in interfaces.values()]
+        connect_all(clients, args.connect_stagger)
+
+    with profile.phase('web server'):
+        if not args.debug:
+            assets.initialize(settings['static_path'])
+        ssl_ctx = get_ssl_context(args) if args.secure else None
+        application = tornado.web.Application(get_routes(interfaces), **settings)
+        application.listen(args.port, args.bind_address, ssl_options=ssl_ctx)
+
+    maintenance.initialize(parse_intervals(args.maintenance))
+    monitor.monitor.start()
+    push.heartbeat.configure(args.ping_interval, args.ping_timeout)
+    push.heartbeat.start()
+    if args.line_log:
+        model.line_store.start()
+    debug.install_signal_handlers()
+
+    io_loop = tornado.ioloop.IOLoop.current()
+    io_loop.add_callback(profile.report)  # once we're actually up and serving
+    io_loop.start()
 
 
 if __name__ == '__main__':
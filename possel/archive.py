@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+possel.archive
+--------------
+
+Scrollback retention. Lines older than their buffer's retention horizon are moved out of the database into compressed,
+append-only segment files on disk, one directory per buffer, and indexed by the range of line ids they hold.
+
+Nothing is lost; reads of old scrollback for a buffer fall through to the segments transparently.
+
+Archiving runs a batch at a time: finding a batch's lines and deleting them happen on the IOLoop, compressing and
+syncing its segment happens on a thread in between.
+"""
+import concurrent.futures
+import datetime
+import gzip
+import json
+import logging
+import os
+import time
+
+import peewee as p
+from tornado import gen
+
+from possel import model
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveSegmentModel(model.BaseModel):
+    """ A compressed file of archived lines from a single buffer. """
+    buffer = p.ForeignKeyField(model.IRCBufferModel, related_name='archive_segments', on_delete='CASCADE')
+    first_line = p.IntegerField()
+    last_line = p.IntegerField()
+    first_timestamp = p.DateTimeField()
+    last_timestamp = p.DateTimeField()
+    count = p.IntegerField()
+    path = p.TextField()  # relative to the archive directory
+
+    class Meta:
+        indexes = ((('buffer', 'first_line', 'last_line'), True),
+                   )
+
+
+class RetentionModel(model.BaseModel):
+    """ Per-buffer override of how long lines are kept in the database. """
+    buffer = p.ForeignKeyField(model.IRCBufferModel, related_name='retention', on_delete='CASCADE', unique=True)
+    days = p.IntegerField(null=True)  # None keeps the buffer's lines in the database forever
+
+
+def _matches(line, after, before, kind):
+    if after is not None and line['id'] < after:
+        return False
+    if before is not None and line['id'] > before:
+        return False
+    return kind is None or line['kind'] == kind
+
+
+class Archiver:
+    def __init__(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)  # for writing segments
+        self.configure(directory='possel-archive', default_days=None)
+
+    def configure(self, directory, default_days, batch_size=10000):
+        """
+        Args:
+            directory (str): Where to keep the segment files.
+            default_days (int): How many days of lines to keep in the database for buffers without their own retention
+                setting, None to keep them forever.
+            batch_size (int): How many lines to put in each segment.
+        """
+        self.directory = directory
+        self.default_days = default_days
+        self.batch_size = batch_size
+        self.archived_lines = 0
+        self.archived_segments = 0
+        self.last_run_seconds = None
+
+    # =========================================================================
+    # Writing
+    # =========================================================================
+    def horizons(self):
+        """ Get the cut-off time for each buffer that has one, lines older than it should be archived. """
+        now = datetime.datetime.utcnow()
+        days = {}
+        if self.default_days is not None:
+            buffer_ids = model.IRCBufferModel.select(model.IRCBufferModel.id).tuples()
+            days = {buffer_id: self.default_days for buffer_id, in buffer_ids}
+        for retention in RetentionModel.select():
+            days[retention.buffer_id] = retention.days
+        return {buffer_id: now - datetime.timedelta(days=n) for buffer_id, n in days.items() if n is not None}
+
+    @gen.coroutine
+    def run(self, max_batches=20):
+        """ Archive expired lines, at most ``max_batches`` segments' worth per run.
+
+        Returns:
+            Future: Resolves to the number of segments written.
+        """
+        start = time.monotonic()
+        written = 0
+        if not model.line_store.archivable:
+            return 0
+        for buffer_id, horizon in self.horizons().items():
+            while written < max_batches:
+                archived = yield self.archive_batch(buffer_id, horizon)
+                if not archived:
+                    break
+                written += 1
+        self.last_run_seconds = time.monotonic() - start
+        if written:
+            logger.info('Archived %d segments in %.2fs', written, self.last_run_seconds)
+        return written
+
+    @gen.coroutine
+    def archive_batch(self, buffer_id, horizon):
+        """ Move the oldest batch of lines older than ``horizon`` out of a buffer and into a new segment.
+
+        Returns:
+            Future: Resolves to the number of lines archived, 0 when there's nothing left to do.
+        """
+        line_model, = model.line_store.readable(buffer_id)
+        expired = (line_model.buffer == buffer_id) & (line_model.timestamp < horizon)
+        lines = list(line_model.select().where(expired).order_by(line_model.id).limit(self.batch_size))
+        if not lines:
+            return 0
+
+        first, last = lines[0], lines[-1]
+        path = yield self.executor.submit(self._write_segment, buffer_id, first.id, last.id,
+                                          [line.to_dict() for line in lines])
+
+        # The file is safely on disk before anything is removed from the database, if we die in between the next run
+        # just writes the same segment again
+        with model.database.atomic(), line_model._meta.database.atomic():
+            ArchiveSegmentModel.create(buffer=buffer_id,
+                                       first_line=first.id,
+                                       last_line=last.id,
+                                       first_timestamp=first.timestamp,
+                                       last_timestamp=last.timestamp,
+                                       count=len(lines),
+                                       path=path)
+            line_model.delete().where(expired, line_model.id >= first.id, line_model.id <= last.id).execute()
+
+        self.archived_lines += len(lines)
+        self.archived_segments += 1
+        return len(lines)
+
+    def _write_segment(self, buffer_id, first_id, last_id, lines):
+        path = os.path.join(str(buffer_id), '{}-{}.jsonl.gz'.format(first_id, last_id))
+        full_path = os.path.join(self.directory, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+        temp_path = full_path + '.tmp'
+        with open(temp_path, 'wb') as raw_file:
+            with gzip.GzipFile(fileobj=raw_file, mode='wb') as segment_file:
+                for line in lines:
+                    segment_file.write(json.dumps(line).encode())
+                    segment_file.write(b'\n')
+            raw_file.flush()
+            os.fsync(raw_file.fileno())
+        os.replace(temp_path, full_path)
+        return path
+    # =========================================================================
+
+    # =========================================================================
+    # Reading
+    # =========================================================================
+    def _read_segment(self, segment):
+        with gzip.open(os.path.join(self.directory, segment.path), 'rt') as segment_file:
+            return [json.loads(line) for line in segment_file]
+
+    def has_lines(self, buffer_id):
+        return ArchiveSegmentModel.select().where(ArchiveSegmentModel.buffer == buffer_id).exists()
+
+    def read(self, buffer_id, after=None, before=None, kind=None, last=None, first=None):
+        """ Get archived lines from a buffer, filtered the same way as the /line API (``after`` and ``before`` are
+        inclusive).
+
+        Only as many segments as it takes to find ``last`` (or ``first``) lines are read.
+
+        Returns:
+            list: Line dicts, oldest first and at most ``first`` of them, unless ``last`` is given in which case it's
+                the newest ``last`` of them, newest first.
+        """
+        segments = (ArchiveSegmentModel
+                    .select()
+                    .where(ArchiveSegmentModel.buffer == buffer_id)
+                    .order_by(ArchiveSegmentModel.first_line if last is None else -ArchiveSegmentModel.first_line))
+        if after is not None:
+            segments = segments.where(ArchiveSegmentModel.last_line >= after)
+        if before is not None:
+            segments = segments.where(ArchiveSegmentModel.first_line <= before)
+
+        wanted = first if last is None else last
+        lines = []
+        for segment in segments:
+            lines.extend(line for line in self._read_segment(segment)[::1 if last is None else -1]
+                         if _matches(line, after, before, kind))
+            if wanted is not None and len(lines) >= wanted:
+                break
+        return lines[:wanted] if wanted is not None else lines
+
+    def get(self, buffer_id, line_ids):
+        """ Get specific archived lines from a buffer, keyed by id. """
+        line_ids = set(line_ids)
+        segments = ArchiveSegmentModel.select().where(ArchiveSegmentModel.buffer == buffer_id,
+                                                      ArchiveSegmentModel.first_line <= max(line_ids),
+                                                      ArchiveSegmentModel.last_line >= min(line_ids))
+        found = {}
+        for segment in segments:
+            if any(segment.first_line <= line_id <= segment.last_line for line_id in line_ids):
+                found.update((line['id'], line) for line in self._read_segment(segment) if line['id'] in line_ids)
+        return found
+    # =========================================================================
+
+    def stats(self):
+        return {'default_days': self.default_days,
+                'archived_lines': self.archived_lines,
+                'archived_segments': self.archived_segments,
+                'last_run_seconds': self.last_run_seconds,
+                }
+
+
+archiver = Archiver()
+
+
+def set_retention(buffer_id, days):
+    """ Set how many days of lines to keep in the database for a buffer, None for forever. """
+    updated = RetentionModel.update(days=days).where(RetentionModel.buffer == buffer_id).execute()
+    if not updated:
+        RetentionModel.create(buffer=buffer_id, days=days)
+
+
+def get_retention():
+    return {retention.buffer_id: retention.days for retention in RetentionModel.select()}
+
+
+def initialize(directory, default_days):
+    model.database.create_tables([ArchiveSegmentModel, RetentionModel], safe=True)
+    archiver.configure(directory, default_days)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+possel.assets
+-------------
+
+The web client's scripts, templates and styles bundled for production: one script and one stylesheet, minified when
+rjsmin/rcssmin are installed, gzipped, and named after a hash of their contents so browsers can cache them forever. The
+Handlebars templates go in the script bundle rather than being fetched when the page loads.
+
+The server builds them in memory at startup (unless it's running with --debug, which serves the separate files as they
+are for easier hacking). To have a front-end server serve them instead, write them out with:
+
+    python -m possel.assets possel-assets  # then point /assets/ at possel-assets/
+"""
+import argparse
+import collections
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+
+import tornado.web
+
+try:
+    import rjsmin
+except ImportError:  # optional, scripts are just concatenated without it
+    rjsmin = None
+try:
+    import rcssmin
+except ImportError:  # optional, there's a simple fallback below
+    rcssmin = None
+
+logger = logging.getLogger(__name__)
+
+# What goes in each bundle, in order; "templates.html" is turned into a script that registers the templates
+BUNDLES = {'bundle.js': ['linkify.min.js', 'linkify-jquery.min.js', 'templates.html', 'main.js'],
+           'bundle.css': ['main.css'],
+           }
+CONTENT_TYPES = {'.js': 'application/javascript; charset=utf-8',
+                 '.css': 'text/css; charset=utf-8',
+                 }
+CACHE_FOREVER = 'public, max-age=31536000, immutable'
+
+Asset = collections.namedtuple('Asset', 'name content_type content gzipped')
+
+_DIV = re.compile(r'<(/?)div\b([^>]*)>')
+_ID = re.compile(r'\bid="([^"]+)"')
+_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+_CSS_SPACE = re.compile(r'\s*([{};,>])\s*')
+
+
+def templates_script(html):
+    """ Turn templates.html (a <div id="name"> per template) into a script defining ``possel_templates``. """
+    templates = {}
+    depth, name, start = 0, None, None
+    for match in _DIV.finditer(html):
+        if not match.group(1):
+            if depth == 0:
+                name, start = _ID.search(match.group(2)).group(1), match.end()
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0 and name:
+                templates[name] = html[start:match.start()].strip()
+    return 'var possel_templates = {};\n'.format(json.dumps(templates, sort_keys=True))
+
+
+def minify_css(css):
+    if rcssmin is not None:
+        return rcssmin.cssmin(css)
+    return _CSS_SPACE.sub(r'\1', _CSS_COMMENT.sub('', css)).replace(';}', '}').strip()
+
+
+def minify_js(name, script):
+    if rjsmin is None or name.endswith('.min.js'):
+        return script
+    return rjsmin.jsmin(script)
+
+
+def _read_source(static_path, name):
+    with open(os.path.join(static_path, name), encoding='utf-8') as source_file:
+        source = source_file.read()
+    if name == 'templates.html':
+        return templates_script(source)
+    if name.endswith('.css'):
+        return minify_css(source)
+    return minify_js(name, source)
+
+
+def _gzip(content):
+    """ Compress as hard as we can, with mtime=0 so the same content always gzips to the same bytes. """
+    output = io.BytesIO()
+    with gzip.GzipFile(fileobj=output, mode='wb', compresslevel=9, mtime=0) as gzip_file:
+        gzip_file.write(content)
+    return output.getvalue()
+
+
+class Bundles:
+    """ The built bundles, kept in memory along with their gzipped versions. """
+    def __init__(self, static_path):
+        self.urls = {}  # bundle name -> hashed name
+        self.assets = {}  # hashed name -> Asset
+        for name, sources in sorted(BUNDLES.items()):
+            separator = ';\n' if name.endswith('.js') else '\n'
+            content = separator.join(_read_source(static_path, source) for source in sources).encode()
+            base, extension = os.path.splitext(name)
+            hashed_name = '{}.{}{}'.format(base, hashlib.sha256(content).hexdigest()[:16], extension)
+            gzipped = _gzip(content)
+            self.urls[name] = hashed_name
+            self.assets[hashed_name] = Asset(hashed_name, CONTENT_TYPES[extension], content, gzipped)
+
+    def url(self, name):
+        return '/assets/' + self.urls[name]
+
+    def write(self, directory):
+        """ Write the bundles, their .gz variants and a manifest.json mapping names to hashed names. """
+        os.makedirs(directory, exist_ok=True)
+        for asset in self.assets.values():
+            for path, content in ((asset.name, asset.content), (asset.name + '.gz', asset.gzipped)):
+                with open(os.path.join(directory, path), 'wb') as asset_file:
+                    asset_file.write(content)
+        with open(os.path.join(directory, 'manifest.json'), 'w') as manifest_file:
+            json.dump(self.urls, manifest_file, indent=2, sort_keys=True)
+
+    def stats(self):
+        return {asset.name: {'bytes': len(asset.content), 'gzipped_bytes': len(asset.gzipped)}
+                for asset in self.assets.values()}
+
+
+bundles = None
+
+
+def initialize(static_path):
+    global bundles
+    bundles = Bundles(static_path)
+    logger.info('Built assets: %s', ', '.join('{} ({} bytes gzipped)'.format(name, len(asset.gzipped))
+                                              for name, asset in sorted(bundles.assets.items())))
+
+
+class AssetHandler(tornado.web.RequestHandler):
+    """ Serves the bundles from memory. Their names change with their contents, so they can be cached forever. """
+    def get(self, name):
+        asset = bundles.assets.get(name) if bundles is not None else None
+        if asset is None:
+            raise tornado.web.HTTPError(404)
+
+        self.set_header('Content-Type', asset.content_type)
+        self.set_header('Cache-Control', CACHE_FOREVER)
+        self.set_header('Vary', 'Accept-Encoding')
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.set_header('Content-Encoding', 'gzip')
+            self.write(asset.gzipped)
+        else:
+            self.write(asset.content)
+
+    def compute_etag(self):
+        return None  # nothing to revalidate, the URL changes instead
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the web client assets')
+    parser.add_argument('output', help='Directory to write the bundles to')
+    parser.add_argument('--static-path', default=os.path.join(os.path.dirname(__file__), 'data', 'static'),
+                        help='Where the sources are')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    Bundles(args.static_path).write(args.output)
+
+
+if __name__ == '__main__':
+    main()
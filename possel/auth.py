@@ -6,10 +6,6 @@ import functools
 import logging
 import os
 
-import cryptography.exceptions
-from cryptography.hazmat import backends
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf import pbkdf2
 import peewee as p
 import tornado.web
 
@@ -39,6 +35,10 @@ def create_tables():
 
 
 def get_kdf(salt):
+    # cryptography is slow to import and only needed when someone logs in
+    from cryptography.hazmat import backends
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf import pbkdf2
     kdf = pbkdf2.PBKDF2HMAC(algorithm=hashes.SHA224,
                             length=32,
                             salt=salt,
@@ -88,6 +88,7 @@ def create_user(username, password):
 
 
 def check_password(username, password):
+    import cryptography.exceptions
     try:
         user = UserModel.get(username=username)
     except p.DoesNotExist:
@@ -101,8 +102,22 @@ def check_password(username, password):
         return user
 
 
-def cleanup_tokens():
-    TokenModel.delete().where(TokenModel.expiry_date < datetime.datetime.utcnow())
+def cleanup_tokens(batch_size=1000):
+    """ Delete expired tokens, ``batch_size`` at a time so we never hold the database for long.
+
+    Returns:
+        int: How many were deleted.
+    """
+    now = datetime.datetime.utcnow()
+    deleted = 0
+    while True:
+        # Fetched first rather than as a subquery of the delete, MySQL won't take LIMIT in one of those
+        expired = TokenModel.select(TokenModel.id).where(TokenModel.expiry_date < now).limit(batch_size)
+        token_ids = [token_id for token_id, in expired.tuples()]
+        if token_ids:
+            deleted += TokenModel.delete().where(TokenModel.id << token_ids).execute()
+        if len(token_ids) < batch_size:
+            return deleted
 
 
 def delete_token(token):
@@ -125,9 +140,13 @@ def get_new_token(user):
 
 
 def get_user_by_token(token_string):
-    cleanup_tokens()
     try:
-        token = TokenModel.get(token=token_string)
+        token = (TokenModel
+                 .select(TokenModel, UserModel)
+                 .join(UserModel)
+                 .where(TokenModel.token == token_string,
+                        TokenModel.expiry_date >= datetime.datetime.utcnow())  # expired ones are only deleted hourly
+                 .get())
     except p.DoesNotExist:
         return None
     else:
@@ -147,6 +166,18 @@ def required(method):
     return inner_method
 
 
+def admin_required(method):
+    """ Like `required` but the user must also be one of the admins named in the application's ``admins`` setting. """
+    @functools.wraps(method)
+    def inner_method(self, *args, **kwargs):
+        if not self.current_user:
+            raise tornado.web.HTTPError(401)
+        if self.current_user.username not in self.settings.get('admins', ()):
+            raise tornado.web.HTTPError(403)
+        return method(self, *args, **kwargs)
+    return inner_method
+
+
 class LoginFailed(Exception):
     pass
 
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+possel.cache
+------------
+
+In-memory caches of the state clients ask for over and over again, so that the common reads don't have to go anywhere
+near the database.
+
+Nothing in here knows about the database itself; whoever builds a cache hands it a loader for warming it up.
+"""
+import collections
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Rough per-line cost of the dict and its small values, on top of the content itself
+LINE_OVERHEAD_BYTES = 256
+# and of each buffer's ring, so even empty ones count towards the cap
+RING_OVERHEAD_BYTES = 1024
+
+
+def _line_size(line):
+    return LINE_OVERHEAD_BYTES + len(line['content']) + len(line.get('nick') or '')
+
+
+class _Ring:
+    """ The cached tail of a single buffer, oldest line first. """
+    def __init__(self, lines, complete):
+        self.lines = collections.deque(lines)
+        self.bytes = RING_OVERHEAD_BYTES + sum(_line_size(line) for line in self.lines)
+        self.complete = complete  # True if these are *all* the lines the buffer has
+
+
+class RecentLines:
+    """ Per-buffer ring buffers of the most recent lines, kept as dicts ready for serialising.
+
+    Buffers are warmed lazily, using ``loader``, the first time they are read and are kept up to date by ``add``. When
+    everything cached together goes over ``max_bytes`` the least recently used buffers are dropped entirely; they get
+    warmed again on their next read.
+
+    Args:
+        loader (callable): ``loader(buffer_id, count)`` returns up to ``count`` of the newest lines in the buffer as
+            dicts, newest first, or None for a buffer that doesn't exist; those aren't cached.
+        depth (int): How many lines to keep per buffer.
+        max_bytes (int): Rough cap on the memory used by all buffers together.
+    """
+    def __init__(self, loader, depth=500, max_bytes=64 * 1024 * 1024):
+        self.loader = loader
+        self.configure(depth, max_bytes)
+
+    def configure(self, depth, max_bytes):
+        """ Change the limits, dropping anything already cached. """
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self._buffers = collections.OrderedDict()  # buffer id -> _Ring, least recently used first
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, buffer_id, count):
+        """ Get the newest ``count`` lines of a buffer, newest first.
+
+        Returns:
+            list: The lines, or None if they can't be served from memory and the caller should ask the database.
+        """
+        if count > self.depth:
+            self.misses += 1
+            return None
+
+        ring = self._buffers.get(buffer_id)
+        if ring is None:
+            self.misses += 1
+            ring = self._warm(buffer_id)
+            if ring is None:
+                return None
+        elif count > len(ring.lines) and not ring.complete:
+            self.misses += 1
+            return None
+        else:
+            self.hits += 1
+            self._buffers.move_to_end(buffer_id)
+
+        return list(itertools.islice(reversed(ring.lines), count))
+
+    def add(self, line):
+        """ Append a freshly created line to its buffer's ring, if that buffer is warm. """
+        ring = self._buffers.get(line['buffer'])
+        if ring is None:
+            # Cold buffer, the line will come along with everything else when it's warmed
+            return
+
+        if len(ring.lines) >= self.depth:
+            dropped = ring.lines.popleft()
+            ring.bytes -= _line_size(dropped)
+            self._bytes -= _line_size(dropped)
+            ring.complete = False
+
+        ring.lines.append(line)
+        ring.bytes += _line_size(line)
+        self._bytes += _line_size(line)
+        self._enforce_cap(keep=line['buffer'])
+
+    def replace_users(self, user_ids):
+        """ Point cached lines at different users, after their lines were handed over in the database.
+
+        Args:
+            user_ids (dict): Maps the old user ids to the new ones.
+        """
+        for ring in self._buffers.values():
+            for line in ring.lines:
+                line['user'] = user_ids.get(line['user'], line['user'])
+
+    def _warm(self, buffer_id):
+        lines = self.loader(buffer_id, self.depth)
+        if lines is None:
+            return None
+        ring = _Ring(reversed(lines), complete=len(lines) < self.depth)
+        self._buffers[buffer_id] = ring
+        self._bytes += ring.bytes
+        self._enforce_cap(keep=buffer_id)
+        return ring
+
+    def _enforce_cap(self, keep):
+        while self._bytes > self.max_bytes:
+            # Least recently used first, but never the buffer we're in the middle of using
+            victim = next((buffer_id for buffer_id in self._buffers if buffer_id != keep), None)
+            if victim is None:
+                break
+            ring = self._buffers.pop(victim)
+            self._bytes -= ring.bytes
+            self.evictions += 1
+            logger.debug('Evicted buffer %s from the line cache', victim)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+                'buffers': len(self._buffers),
+                'lines': sum(len(ring.lines) for ring in self._buffers.values()),
+                'bytes': self._bytes,
+                'depth': self.depth,
+                'max_bytes': self.max_bytes,
+                }
+
+
+class _Roster:
+    """ The members of a single buffer. """
+    def __init__(self, members, version):
+        self.members = dict(members)  # user id -> mode prefixes, e.g. '@'
+        self.version = version
+        self.oldest = version  # the oldest version we can still give the changes since
+        self.changes = collections.deque()  # (version, user id, modes or None if they left)
+
+
+class Rosters:
+    """ In-memory member lists for buffers, so nicklists don't need a join against the membership table.
+
+    Every change bumps the roster's version and is remembered for a while, so clients holding an older version can ask
+    for just the changes since then rather than the whole list again.
+
+    Rosters are warmed lazily, using ``loader``, when they're first read or when we get NAMES for them. Membership
+    changes to buffers we haven't warmed are ignored, they're already in the database for when we do. Modes only live
+    here, a roster warmed from the loader has none until the next NAMES or MODE.
+
+    Args:
+        loader (callable): ``loader(buffer_id)`` returns the ids of the users in the buffer, or None if there's no such
+            buffer.
+        history (int): How many changes to remember per buffer for the delta form.
+    """
+    def __init__(self, loader, history=256):
+        self.loader = loader
+        self.history = history
+        self._rosters = {}
+        # Versions are shared by all rosters and seeded from the clock so a client holding a version from before a
+        # restart can't mistake it for one of ours
+        self._versions = itertools.count(int(time.time() * 1000))
+
+    def _warm(self, buffer_id):
+        roster = self._rosters.get(buffer_id)
+        if roster is None:
+            user_ids = self.loader(buffer_id)
+            if user_ids is None:
+                return None
+            roster = self._rosters[buffer_id] = _Roster(((user_id, '') for user_id in user_ids), next(self._versions))
+        return roster
+
+    def _record(self, roster, user_id, modes):
+        roster.version = next(self._versions)
+        roster.changes.append((roster.version, user_id, modes))
+        if len(roster.changes) > self.history:
+            roster.oldest = roster.changes.popleft()[0]
+
+    def update(self, buffer_id, user_id, modes=''):
+        """ Add a user to a buffer or change their modes, warming the roster if necessary. """
+        roster = self._warm(buffer_id)
+        if roster.members.get(user_id) != modes:
+            roster.members[user_id] = modes
+            self._record(roster, user_id, modes)
+
+    def add(self, buffer_id, user_id):
+        """ Add a user to a buffer without touching any modes they might already have. """
+        roster = self._rosters.get(buffer_id)
+        if roster is not None and user_id not in roster.members:
+            roster.members[user_id] = ''
+            self._record(roster, user_id, '')
+
+    def change_modes(self, buffer_id, user_id, added='', removed='', order=''):
+        """ Give a member of a warm roster some mode prefixes and take others away, keeping them in ``order``. """
+        roster = self._rosters.get(buffer_id)
+        if roster is None or user_id not in roster.members:
+            return
+        modes = (set(roster.members[user_id]) | set(added)) - set(removed)
+        modes = ''.join(sorted(modes, key=order.find))
+        if roster.members[user_id] != modes:
+            roster.members[user_id] = modes
+            self._record(roster, user_id, modes)
+
+    def remove(self, buffer_id, user_id):
+        roster = self._rosters.get(buffer_id)
+        if roster is not None and roster.members.pop(user_id, None) is not None:
+            self._record(roster, user_id, None)
+
+    def get(self, buffer_id):
+        """ Get a snapshot of a buffer's members.
+
+        Returns:
+            tuple: ``(version, members)`` where members maps user ids to their mode prefixes, or None if there's no such
+                buffer.
+        """
+        roster = self._warm(buffer_id)
+        if roster is None:
+            return None
+        return roster.version, dict(roster.members)
+
+    def changes_since(self, buffer_id, version):
+        """ Get what changed in a buffer since the given version.
+
+        Returns:
+            tuple: ``(version, changes)`` where changes is a list of ``(user id, modes)``, modes being None for users
+                who left. ``changes`` is None if we can't tell (too old, or not a version of ours) and the client
+                should take the whole roster instead. None if there's no such buffer.
+        """
+        roster = self._warm(buffer_id)
+        if roster is None:
+            return None
+        if not roster.oldest <= version <= roster.version:
+            return roster.version, None
+        return roster.version, [(user_id, modes) for change_version, user_id, modes in roster.changes
+                                if change_version > version]
+
+    def stats(self):
+        return {'buffers': len(self._rosters),
+                'members': sum(len(roster.members) for roster in self._rosters.values()),
+                }
@@ -6,7 +6,7 @@ import logging
 
 from pircel import tornado_adapter
 
-from possel import model
+from possel import model, outbound
 
 logger = logging.getLogger(__name__)
 
@@ -135,15 +135,15 @@ class Dispatcher:
     def join(self, args):
         if args.channel is None:
             args.channel = args.buffer.name
-        interface = self.interfaces[args.buffer.server.id]
-        interface.server_handler.join(args.channel, args.password)
+        interface = self.interfaces[args.buffer.server_id]
+        outbound.queues.get(interface).join(args.channel, args.password)
 
     @part_parser.decorate
     def part(self, args):
         if args.channel is None:
             args.channel = args.buffer.name
-        interface = self.interfaces[args.buffer.server.id]
-        interface.server_handler.part(args.channel)
+        interface = self.interfaces[args.buffer.server_id]
+        outbound.queues.get(interface).part(args.channel)
 
     @query_parser.decorate
     def query(self, args):
@@ -151,16 +151,16 @@ class Dispatcher:
 
     def me(self, buffer, rest):
         line = rest[0]
-        interface = self.interfaces[buffer.server.id]
-        interface.server_handler.send_message(buffer.name, '\1ACTION {}\1'.format(line))
+        interface = self.interfaces[buffer.server_id]
+        outbound.queues.get(interface).send_message(buffer.name, line, action=True)
 
     # Doesn't actually use the parser but we want /help to work
     me.parser = me_parser
 
     @nick_parser.decorate
     def nick(self, args):
-        interface = self.interfaces[args.buffer.server.id]
-        interface.server_handler.change_nick(args.new_nick)
+        interface = self.interfaces[args.buffer.server_id]
+        outbound.queues.get(interface).change_nick(args.new_nick)
 
     @connect_parser.decorate
     def connect(self, args):
@@ -1,11 +1,55 @@
 "use strict";
 
+// Collects lookups made within `delay` ms of each other and makes them with a single `?ids=` request.
+// Each lookup's promise resolves with a one element list, the same as fetching it on its own would.
+function batched_lookup(url, delay){
+  var pending = {}, timer = null, max_ids = 500;
+
+  function fetch(batch, ids){
+    $.get(url + '?ids=' + ids.join(',')).then(function(items){
+      var by_id = {};
+      items.forEach(function(item){
+        by_id[item.id] = item;
+      });
+      ids.forEach(function(id){
+        batch[id].resolve(id in by_id ? [by_id[id]] : []);
+      });
+    }, function(){
+      ids.forEach(function(id){
+        batch[id].reject();
+      });
+    });
+  }
+
+  function flush(){
+    var batch = pending, ids = Object.keys(batch), i;
+    pending = {};
+    timer = null;
+    for(i = 0; i < ids.length; i += max_ids){
+      fetch(batch, ids.slice(i, i + max_ids));
+    }
+  }
+
+  return function(id){
+    if(!(id in pending)){
+      pending[id] = $.Deferred();
+    }
+    if(timer === null){
+      timer = setTimeout(flush, delay);
+    }
+    return pending[id].promise();
+  };
+}
+
 var possel = {
   users: [],
   buffers: [],
   get_user: function(id){
     return $.get("/user/" + id);
   },
+  lookup_user: batched_lookup("/user", 50),
+  lookup_buffer: batched_lookup("/buffer", 50),
+  lookup_line: batched_lookup("/line", 50),
   events: {
     submit_event: function(node) {
       $(node).submit(function(event) {
@@ -24,8 +68,16 @@ var possel = {
   get_line_by_id: function(id){
     return $.get("/line?id=" + id);
   },
-  get_last_line: function(){
-    return $.get("/line?last=1");
+  get_activity: function(){
+    return $.get("/activity");
+  },
+  mark_read: function(buffer, line){
+    return $.ajax({
+      type: 'POST',
+      url: '/activity',
+      data: JSON.stringify({buffer: buffer, line: line}),
+      contentType: 'application/json'
+    });
   },
   send_line: function(buffer, content){
     return $.ajax({
@@ -59,6 +111,13 @@ var PosselTemplate = {
   orange: '#C9952E',
   load: function(url){
     var that = this;
+    if(typeof possel_templates !== 'undefined'){
+      // Already in the asset bundle, no need to fetch them
+      $.each(possel_templates, function(name, source){
+        that.templates[name] = Handlebars.compile(source);
+      });
+      return $.when();
+    }
     return $.get(url, function(html, textStatus, jqXhr){
       var obj = $('<div/>').html(html).contents().filter('div');
       obj.each(function(index, template){
@@ -69,74 +128,347 @@ var PosselTemplate = {
 }
 
 $(function(){
-  var users = [], buffers = [];
+  var users = [], buffers = [], ws = null, read_timers = {}, nicklist_timer = null;
 
 
-  function scroll_to_bottom(element){
-    element.scrollTop(element.prop('scrollHeight'));
+  // The same colour possel.web_client gives the nick when it renders the page
+  function user_color(user_id){
+    return 'hsl(' + (user_id * 137 % 360) + ', 65%, 40%)';
   }
 
   function new_user(user){
     users[user.id] = user;
-    user.color = Please.make_color();
+    user.color = user_color(user.id);
   }
 
-  function prepopulate_line_buffer(line_id, buffer_id){
-    $('#' + buffer_id).append(PosselTemplate.templates.prepopulate_line({line_id: line_id}));
-  }
+  // Each buffer's lines are kept in a Scrollback, and only a window of them (the newest, unless we're scrolling back
+  // through history) is in the DOM, and only for the buffer we're looking at. Lines arriving in a hurry are rendered
+  // together once per animation frame.
+  var MAX_MODEL_LINES = 5000,  // lines kept in memory per buffer while we're following along at the bottom
+      MAX_RENDERED_LINES = 300,  // lines kept in the DOM
+      RENDER_PAGE = 100,  // lines added or dropped at a time while scrolling through history
+      SCROLL_MARGIN = 200;  // pixels from the top or bottom at which we start rendering more
+
+  var scrollbacks = {}, render_queued = false, scroll_queued = false;
 
-  function new_line(line){
-    var buffer = buffers[line.buffer], user = users[line.user], use_user, line_element;
-    use_user = user;
-    if(user == null){
-      use_user = {
-        color: PosselTemplate.orange,
+  function sorted_index(ids, id){
+    var lo = 0, hi = ids.length, mid;
+    while(lo < hi){
+      mid = (lo + hi) >> 1;
+      if(ids[mid] < id){
+        lo = mid + 1;
+      }else{
+        hi = mid;
       }
     }
+    return lo;
+  }
+
+  function line_row(line){
+    var orange = PosselTemplate.orange, nick = line.nick, content = line.content,
+        nick_color = line.user ? user_color(line.user) : orange, row_color = null;
     switch(line.kind){
       case 'action':
       case 'join':
       case 'quit':
       case 'part':
-        use_user = {
-          color: PosselTemplate.orange,
-        };
-        line.content = line.nick + ' ' + line.content;
-        line.nick = '-*-';
+        content = nick + ' ' + content;
+        nick = '-*-';
+        nick_color = orange;
         break;
     }
-
-    line_element = $('#line-' + line.id);
-    line_element.addClass('buffer-line-' + line.kind);
-
-    line_element.append(PosselTemplate.templates.line({
-      line: line,
-      user: use_user,
-      timestamp: moment.unix(line.timestamp).format('HH:mm:ss'),
-    }));
-
-    // Do some colouring
     switch(line.kind){
       case 'action':
-        line_element.attr('style', 'color: ' + user.color + ';');
+        row_color = line.user ? user_color(line.user) : orange;
         break;
       case 'notice':
-        line_element.attr('style', 'color: ' + PosselTemplate.orange + ';');
+        row_color = orange;
         break;
       case 'join':
       case 'part':
       case 'quit':
-        line_element.attr('style', 'color: gray;');
+        row_color = 'gray';
         break;
     }
-    line_element.linkify({target: '_blank'});
-    scroll_to_bottom($('#message-pane'));
+    return PosselTemplate.templates.line_row({
+      line: line,
+      color: row_color,
+      html: PosselTemplate.templates.line({
+        line: {nick: nick, content: content},
+        user: {color: nick_color},
+        timestamp: moment.unix(line.timestamp).format('HH:mm:ss'),
+      }),
+    });
+  }
+
+  function Scrollback(buffer_id){
+    this.buffer_id = buffer_id;
+    this.ids = [];  // every line id we have, in order
+    this.lines = {};  // id -> line
+    this.first = 0;  // the rendered window, as indexes into ids; [first, last)
+    this.last = 0;
+    this.following = true;  // stuck to the bottom, rendering new lines as they come
+    this.stale = true;  // the DOM doesn't match the window, render it all again
+    this.fetching = false;
+    this.exhausted = false;  // the server has no older lines
+  }
+
+  Scrollback.prototype.add = function(lines){
+    var that = this, dropped;
+    lines.forEach(function(line){
+      var index;
+      if(line.id in that.lines){
+        return;
+      }
+      that.lines[line.id] = line;
+      index = sorted_index(that.ids, line.id);
+      that.ids.splice(index, 0, line.id);
+      if(index < that.first){
+        that.first += 1;
+        that.last += 1;
+      }else if(index < that.last){
+        that.stale = true;
+      }
+    });
+
+    // Forget the oldest lines, unless someone's reading them
+    dropped = this.ids.length - MAX_MODEL_LINES;
+    if(this.following && dropped > 0 && dropped <= this.first){
+      this.ids.splice(0, dropped).forEach(function(id){
+        delete that.lines[id];
+      });
+      this.first -= dropped;
+      this.last -= dropped;
+      this.exhausted = false;
+    }
+  };
+
+  Scrollback.prototype.rows = function(first, last){
+    var rows = $(this.ids.slice(first, last).map(function(id){
+      return line_row(this.lines[id]);
+    }, this).join('')).filter('.buffer-line');
+    rows.linkify({target: '_blank'});
+    return rows;
+  };
+
+  Scrollback.prototype.render = function(pane, scroller){
+    var extra;
+    if(this.stale){
+      if(this.following || this.last > this.ids.length){
+        this.last = this.ids.length;
+      }
+      this.first = Math.max(this.last - MAX_RENDERED_LINES, 0);
+      pane.empty().append(this.rows(this.first, this.last));
+      this.stale = false;
+    }else if(this.following && this.last < this.ids.length){
+      pane.append(this.rows(this.last, this.ids.length));
+      this.last = this.ids.length;
+      extra = this.last - this.first - MAX_RENDERED_LINES;
+      if(extra > 0){
+        pane.children().slice(0, extra).remove();
+        this.first += extra;
+      }
+    }
+    if(this.following){
+      scroller.scrollTop(scroller.prop('scrollHeight'));
+    }
+  };
+
+  // Render older lines at the top, dropping the newest if there are too many, without moving what's on screen
+  Scrollback.prototype.page_up = function(pane, scroller){
+    var count = Math.min(RENDER_PAGE, this.first), height = scroller.prop('scrollHeight'), extra;
+    pane.prepend(this.rows(this.first - count, this.first));
+    this.first -= count;
+    scroller.scrollTop(scroller.scrollTop() + scroller.prop('scrollHeight') - height);
+    extra = this.last - this.first - MAX_RENDERED_LINES;
+    if(extra > 0){
+      pane.children().slice(-extra).remove();
+      this.last -= extra;
+    }
+  };
+
+  // And newer lines at the bottom, dropping the oldest
+  Scrollback.prototype.page_down = function(pane, scroller){
+    var count = Math.min(RENDER_PAGE, this.ids.length - this.last), height, extra;
+    pane.append(this.rows(this.last, this.last + count));
+    this.last += count;
+    extra = this.last - this.first - MAX_RENDERED_LINES;
+    if(extra > 0){
+      height = scroller.prop('scrollHeight');
+      pane.children().slice(0, extra).remove();
+      this.first += extra;
+      scroller.scrollTop(scroller.scrollTop() - (height - scroller.prop('scrollHeight')));
+    }
+  };
+
+  Scrollback.prototype.fetch_older = function(){
+    var that = this, url = '/line?buffer=' + this.buffer_id + '&last=' + RENDER_PAGE;
+    if(this.fetching || this.exhausted){
+      return;
+    }
+    if(this.ids.length){
+      url += '&before=' + (this.ids[0] - 1);
+    }
+    this.fetching = true;
+    $.get(url).then(function(lines){
+      that.fetching = false;
+      that.exhausted = lines.length < RENDER_PAGE;
+      that.add(lines);
+      queue_scroll();
+    }, function(){
+      that.fetching = false;
+    });
+  };
+
+  function scrollback(buffer_id){
+    if(!(buffer_id in scrollbacks)){
+      scrollbacks[buffer_id] = new Scrollback(buffer_id);
+    }
+    return scrollbacks[buffer_id];
+  }
+
+  function active_buffer_id(){
+    return $('.buffer.active').attr('id');
+  }
+
+  function render(){
+    var buffer_id = active_buffer_id();
+    render_queued = false;
+    if(buffer_id in scrollbacks){
+      scrollbacks[buffer_id].render($('#' + buffer_id), $('#message-pane'));
+    }
   }
 
-  function new_buffer(buffer){
+  function queue_render(){
+    if(!render_queued){
+      render_queued = true;
+      window.requestAnimationFrame(render);
+    }
+  }
+
+  function add_lines(buffer_id, lines){
+    scrollback(buffer_id).add(lines);
+    if(buffer_id == active_buffer_id()){
+      queue_render();
+    }
+  }
+
+  function on_scroll(){
+    var buffer_id = active_buffer_id(), scroller = $('#message-pane'), pane = $('#' + buffer_id), lines, top, bottom;
+    scroll_queued = false;
+    if(!(buffer_id in scrollbacks)){
+      return;
+    }
+    lines = scrollbacks[buffer_id];
+    top = scroller.scrollTop();
+    bottom = scroller.prop('scrollHeight') - top - scroller.innerHeight();
+    if(top < SCROLL_MARGIN){
+      if(lines.first > 0){
+        lines.page_up(pane, scroller);
+      }else{
+        lines.fetch_older();
+      }
+    }else if(bottom < SCROLL_MARGIN && lines.last < lines.ids.length){
+      lines.page_down(pane, scroller);
+    }
+    bottom = scroller.prop('scrollHeight') - scroller.scrollTop() - scroller.innerHeight();
+    lines.following = bottom < 5 && lines.last == lines.ids.length;
+  }
+
+  function queue_scroll(){
+    if(!scroll_queued){
+      scroll_queued = true;
+      window.requestAnimationFrame(on_scroll);
+    }
+  }
+
+  // We want everything from the buffer we're looking at and just activity from the rest
+  function subscribe(){
+    var buffer_id = $('.buffer.active').attr('id'), subscription = {};
+    if(ws === null || buffer_id === undefined){
+      return;
+    }
+    subscription[buffer_id] = 'full';
+    ws.send(JSON.stringify({type: 'subscribe', buffers: subscription, default: 'activity'}));
+  }
+
+  function show_activity(buffer_id, activity){
+    var link = $('#bufferlist a[href="#' + buffer_id + '"]');
+    link.toggleClass('buffer-unread', activity.unread > 0);
+    link.toggleClass('buffer-mentioned', activity.mentions > 0);
+    link.find('.badge').text(activity.unread > 0 ? activity.unread : '');
+  }
+
+  // Lines can arrive in a hurry, only tell the server where we've read up to once they've calmed down
+  function read_up_to(buffer_id, line_id){
+    show_activity(buffer_id, {unread: 0, mentions: 0});
+    clearTimeout(read_timers[buffer_id]);
+    read_timers[buffer_id] = setTimeout(function(){
+      possel.mark_read(buffer_id, line_id).then(function(activity){
+        show_activity(buffer_id, activity);
+      });
+    }, 1000);
+  }
+
+  function render_nicklist(roster){
+    var members = roster.members.filter(function(member){
+      return member[0] in users;
+    });
+    members.sort(function(a, b){
+      var a_nick = users[a[0]].nick.toLowerCase(), b_nick = users[b[0]].nick.toLowerCase();
+      if(!a[1] != !b[1]){
+        return a[1] ? -1 : 1;
+      }
+      return a_nick < b_nick ? -1 : a_nick > b_nick ? 1 : 0;
+    });
+    $('#nicklist').html(members.map(function(member){
+      return PosselTemplate.templates.nicklist_item({user: users[member[0]], prefix: member[1].charAt(0)});
+    }).join(''));
+  }
+
+  // Fetch a buffer's members and any of them we haven't seen yet, then show them
+  function load_nicklist(buffer_id){
+    $.get('/roster/' + buffer_id).then(function(roster){
+      var unknown = roster.members.filter(function(member){
+        return !(member[0] in users);
+      }).map(function(member){
+        return possel.lookup_user(member[0]).then(function(data){
+          data.forEach(new_user);
+        });
+      });
+      $.when.apply($, unknown).always(function(){
+        if(buffer_id == active_buffer_id()){
+          render_nicklist(roster);
+        }
+      });
+    });
+  }
+
+  // Membership changes come in bursts (netsplits, joining a big channel), only refetch once they've calmed down
+  function nicklist_changed(buffer_id){
+    if(buffer_id != active_buffer_id()){
+      return;
+    }
+    clearTimeout(nicklist_timer);
+    nicklist_timer = setTimeout(function(){
+      load_nicklist(buffer_id);
+    }, 500);
+  }
+
+  function catch_up(buffer_id){
+    $.get('/line?buffer=' + buffer_id + '&last=' + MAX_RENDERED_LINES).then(function(lines){
+      if(lines.length > 0){
+        read_up_to(buffer_id, lines[0].id);
+      }
+      add_lines(buffer_id, lines);
+    });
+  }
+
+  // `rendered` buffers are already in the page the server sent
+  function new_buffer(buffer, show, rendered){
       var buffer_link, nav_item = PosselTemplate.templates.nav_item;
       buffers[buffer.id] = buffer;
-      switch(buffer.kind){
+      switch(rendered ? null : buffer.kind){
         case "system":
           $('#bufferlist').append(nav_item({
             buffer: buffer,
@@ -150,78 +482,138 @@ $(function(){
           }));
           break;
       }
-      $("#message-pane").append(PosselTemplate.templates.buffer_pane({buffer: buffer}));
+      if(!rendered){
+        $("#message-pane").append(PosselTemplate.templates.buffer_pane({buffer: buffer}));
+      }
       buffer_link = $('#bufferlist a[href="#' + buffer.id + '"]');
       buffer_link.on('shown.bs.tab', function(event){
-        scroll_to_bottom($('#message-pane'));
+        var lines = scrollback(buffer.id);
+        lines.following = true;
+        lines.stale = true;
+        subscribe();
+        queue_render();
+        catch_up(buffer.id);
+        load_nicklist(buffer.id);
       });
-      buffer_link.tab('show');
-  }
-
-  function prepopulate_lines(last_line_data, nlines){
-    if (last_line_data.length == 0) {
-      console.warn("no lines found.");
-      return 0;
-    }
-    var last_line = last_line_data[0];
-    $.get("/line?after=" + (last_line.id - nlines)).then(function(lines){
-      lines.forEach(function(line){
-        prepopulate_line_buffer(line.id, line.buffer);
-        new_line(line);
+      // Only the buffer we're looking at keeps its lines in the DOM
+      buffer_link.on('hidden.bs.tab', function(event){
+        $('#' + buffer.id).empty();
+        $('#nicklist').empty();
+        scrollback(buffer.id).stale = true;
       });
-    });
+      if(show){
+        buffer_link.tab('show');
+      }
   }
 
   function handle_push(event){
     var msg = JSON.parse(event.data);
     switch(msg.type){
     case "line":
-      prepopulate_line_buffer(msg.line, msg.buffer);
-      possel.get_line_by_id(msg.line).then(function(data) {
-        var line = data[0];
-        new_line(line);
+      if(msg.buffer == $('.buffer.active').attr('id')){
+        read_up_to(msg.buffer, msg.line);
+      }
+      possel.lookup_line(msg.line).then(function(data) {
+        add_lines(msg.buffer, data);
       });
       break;
+    case "activity":
+      show_activity(msg.buffer, msg);
+      break;
     case "buffer":
-      possel.get_buffer(msg.buffer).then(function(buffer_data){
-        new_buffer(buffer_data[0]);
+      possel.lookup_buffer(msg.buffer).then(function(buffer_data){
+        new_buffer(buffer_data[0], true);
       });
       break;
     case "user":
-      possel.get_user(msg.user).then(function(user_data){
+      possel.lookup_user(msg.user).then(function(user_data){
         new_user(user_data[0]);
       });
+      break;
+    case "membership":
+    case "delete_membership":
+      nicklist_changed(msg.buffer);
+      break;
     }
   }
 
-  function init(){
-    console.log('Initializing');
+  function listen(){
     possel.events.submit_event('#message-input-form');
     $(document).keypress(function(e){
       $('#message-input').focus();
     });
+    $('#message-pane').on('scroll', queue_scroll);
+    // So the server can render times the way we would
+    Cookies.set('tz_offset', new Date().getTimezoneOffset());
+  }
+
+  function connect(){
+    ws = new ReconnectingWebSocket(ws_url);
+    ws.onopen = function() {
+      var buffer_id = active_buffer_id();
+      console.log("connected");
+      subscribe();
+      // Pick up anything we missed while we weren't connected
+      if(buffer_id !== undefined){
+        catch_up(buffer_id);
+      }
+    };
+    ws.onclose = function() {
+      console.log("disconnected");
+    };
+    ws.onmessage = handle_push;
+  }
+
+  function report_interactive(){
+    window.requestAnimationFrame(function(){
+      if(window.performance && performance.mark){
+        performance.mark('possel-interactive');
+        console.log('Interactive after ' + Math.round(performance.now()) + 'ms');
+      }
+    });
+  }
+
+  // Pick up from the state the server rendered the page with, see possel.web_client
+  function hydrate(state){
+    console.log('Hydrating');
+    listen();
+    state.users.forEach(new_user);
+    state.buffers.forEach(function(buffer){
+      new_buffer(buffer, false, true);
+    });
+    $.each(state.activity, show_activity);
+    if(state.active !== null){
+      // Re-render the server's rows so they get linkified, it's all in one frame
+      add_lines(state.active, state.lines);
+      if(state.lines.length){
+        read_up_to(state.active, state.lines[state.lines.length - 1].id);
+      }
+      render_nicklist(state.roster);
+    }
+    connect();
+    report_interactive();
+  }
+
+  function init(){
+    console.log('Initializing');
+    listen();
     $.when(possel.get_user("all"),
         possel.get_buffer("all"),
-        possel.get_last_line(),
+        possel.get_activity(),
         PosselTemplate.load('/static/templates.html')
         )
-      .done(function(user_data, buffer_data, last_line_data){
+      .done(function(user_data, buffer_data, activity_data){
         console.log('done preparing');
         user_data[0].forEach(function(user){
           new_user(user);
         });
         buffer_data[0].forEach(function(buffer) {
-          new_buffer(buffer);
+          new_buffer(buffer, false);
         });
-        var ws = new ReconnectingWebSocket(ws_url);
-        ws.onopen = function() {
-          console.log("connected");
-        };
-        ws.onclose = function() {
-          console.log("disconnected");
-        };
-        ws.onmessage = handle_push;
-        prepopulate_lines(last_line_data[0], 3000);
+        connect();
+        $.each(activity_data[0], show_activity);
+        $('#bufferlist a').last().tab('show');
+        report_interactive();
       });
   }
 
@@ -233,7 +625,11 @@ $(function(){
     });
   }
 
-  if(Cookies.get('token')){
+  if(possel_state !== null){
+    PosselTemplate.load('/static/templates.html').done(function(){
+      hydrate(possel_state);
+    });
+  }else if(Cookies.get('token')){
     possel.verify_token().done(init).fail(do_login);
   }else{
     do_login();
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+possel.debug
+------------
+
+Looking inside a running server without restarting it: a sampling CPU profiler, tracemalloc snapshots and counts of the
+objects we tend to leak. Driven through the admin-only /debug endpoints, or with signals when the web side is the
+problem:
+
+    kill -USR1 <pid>  # start profiling, again to stop and write the results to the log and a file
+    kill -USR2 <pid>  # log the top allocation sites and live object counts
+"""
+import collections
+import gc
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+import peewee as p
+from tornado import ioloop
+
+from possel import activity, highlights, model, push
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    """ Samples the IOLoop thread's stack from a background thread.
+
+    Unlike cProfile this costs the profiled code nothing but the odd GIL handover, so it's fine to leave running on a
+    busy server.
+    """
+    def __init__(self):
+        self._thread = None
+        self._stop = threading.Event()
+        self.running = False
+
+    def start(self, interval=0.005, thread_id=None):
+        """
+        Args:
+            interval (float): Seconds between samples.
+            thread_id (int): The thread to profile, by default the one calling this.
+        """
+        if self.running:
+            raise ValueError('Already profiling')
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.stacks = collections.Counter()  # tuple of "file:function:line", outermost first -> samples
+        self.samples = 0
+        self.started = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='possel-profiler', daemon=True)
+        self._thread.start()
+        self.running = True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}:{}'.format(code.co_filename, code.co_name, frame.f_lineno))
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self, limit=30):
+        """ Stop profiling and summarise where the time went.
+
+        Returns:
+            dict: The functions we were most often in ("self") and under ("total"), and the stacks in the collapsed
+                format flamegraph.pl reads.
+        """
+        if not self.running:
+            raise ValueError('Not profiling')
+        self._stop.set()
+        self._thread.join()
+        self.running = False
+
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for location in set(stack):
+                total[location] += count
+
+        return {'seconds': round(time.monotonic() - self.started, 3),
+                'samples': self.samples,
+                'self': own.most_common(limit),
+                'total': total.most_common(limit),
+                'collapsed': '\n'.join('{} {}'.format(';'.join(stack), count) for stack, count in self.stacks.items()),
+                }
+
+
+profiler = SamplingProfiler()
+
+
+# =========================================================================
+# Memory
+# =========================================================================
+_last_snapshot = None
+
+
+def memory_start(frames=10):
+    tracemalloc.start(frames)
+
+
+def memory_stop():
+    global _last_snapshot
+    tracemalloc.stop()
+    _last_snapshot = None
+
+
+def memory_snapshot(limit=25):
+    """ Get the top allocation sites, and the biggest changes since the last snapshot if there was one. """
+    global _last_snapshot
+    if not tracemalloc.is_tracing():
+        raise ValueError('tracemalloc is not running')
+
+    snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    current, peak = tracemalloc.get_traced_memory()
+    report = {'current_bytes': current,
+              'peak_bytes': peak,
+              'top': [{'site': str(stat.traceback), 'bytes': stat.size, 'count': stat.count}
+                      for stat in snapshot.statistics('lineno')[:limit]],
+              }
+    if _last_snapshot is not None:
+        report['changes'] = [{'site': str(stat.traceback), 'bytes': stat.size_diff, 'count': stat.count_diff}
+                             for stat in snapshot.compare_to(_last_snapshot, 'lineno')[:limit]]
+    _last_snapshot = snapshot
+    return report
+
+
+def live_objects():
+    """ Count the things that pile up when we leak: model instances, push sockets and signal receivers. """
+    models = collections.Counter(type(obj).__name__ for obj in gc.get_objects() if isinstance(obj, p.Model))
+
+    signal_names = [model.NEW_USER, model.NEW_LINE, model.NEW_BUFFER, model.NEW_SERVER, model.NEW_MEMBERSHIP,
+                    model.DELETED_MEMBERSHIP, highlights.NEW_MENTION]
+    receivers = {name: len(model.signal_factory(name).receivers) for name in signal_names}
+    receivers[activity.UNREAD_CHANGED] = len(activity.signal_factory(activity.UNREAD_CHANGED).receivers)
+
+    return {'models': dict(models),
+            'pushers': len(push.subscriptions.everyone()),
+            'receivers': receivers,
+            'gc_counts': gc.get_count(),
+            }
+# =========================================================================
+
+
+# =========================================================================
+# Signal handlers
+# =========================================================================
+def _toggle_profiler():
+    if not profiler.running:
+        profiler.start()
+        logger.warning('Started profiling')
+        return
+
+    report = profiler.stop()
+    path = 'possel-profile-{}.txt'.format(int(time.time()))
+    with open(path, 'w') as profile_file:
+        profile_file.write(report['collapsed'])
+    logger.warning('Profiled %d samples over %.1fs, collapsed stacks written to %s',
+                   report['samples'], report['seconds'], os.path.abspath(path))
+    for location, count in report['self']:
+        logger.warning('    %6d  %s', count, location)
+
+
+def _log_memory():
+    if not tracemalloc.is_tracing():
+        memory_start()
+        logger.warning('Started tracemalloc, send the signal again for a snapshot')
+    else:
+        for stat in memory_snapshot()['top']:
+            logger.warning('    %10d bytes  %6d blocks  %s', stat['bytes'], stat['count'], stat['site'])
+    logger.warning('Live objects: %s', live_objects())
+
+
+def install_signal_handlers():
+    io_loop = ioloop.IOLoop.current()
+    # Signals can arrive in the middle of anything, so do the actual work from the IOLoop
+    signal.signal(signal.SIGUSR1, lambda signum, frame: io_loop.add_callback_from_signal(_toggle_profiler))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: io_loop.add_callback_from_signal(_log_memory))
+# =========================================================================
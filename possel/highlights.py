@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+possel.highlights
+-----------------
+
+Spots lines that mention us (our nick on the line's server or any of the configured highlight words) as they arrive and
+records them in an index, so "what did I miss?" never has to scan every line we've ever stored.
+"""
+import collections
+import logging
+import re
+
+import peewee as p
+from playhouse import migrate
+
+from possel import archive, model
+
+logger = logging.getLogger(__name__)
+
+
+# Callback signal definitions
+NEW_MENTION = 'new_mention'
+
+# Joins, quits and the like don't get to highlight us
+HIGHLIGHT_KINDS = {'message', 'notice', 'action'}
+
+# Anything that could be part of a nick, so "possel:" and "<possel>" still match but "posselbot" doesn't
+_WORD = re.compile(r'[\w\[\]\\`^{}|-]+')
+
+
+class MentionModel(model.BaseModel):
+    """ A line that mentioned us.
+
+    The line is just its id rather than a foreign key: it may have been archived, or be kept outside the main database
+    altogether by another line store, and the mention has to outlive it either way.
+    """
+    line = p.IntegerField(db_column='line_id', index=True)
+    buffer = p.ForeignKeyField(model.IRCBufferModel, related_name='mentions', on_delete='CASCADE')
+    server = p.ForeignKeyField(model.IRCServerModel, related_name='mentions', on_delete='CASCADE')
+    timestamp = p.DateTimeField()
+
+    class Meta:
+        indexes = ((('server', 'line'), False),  # they're paged through newest line first
+                   (('buffer', 'line'), False),
+                   )
+
+
+class Matcher:
+    """ Checks text for any of a set of words, ignoring case.
+
+    Rather than searching the text for each word in turn we split it into words once and look each of those up in a
+    set, so the cost depends on the length of the line and not on how many words we're looking for.
+    """
+    def __init__(self, words):
+        self.words = frozenset(word.casefold() for word in words if word)
+
+    def __call__(self, text):
+        return any(word.casefold() in self.words for word in _WORD.findall(text))
+
+
+class Highlighter:
+    def __init__(self):
+        self.interfaces = {}
+        self.words = ()
+        self._matchers = {}  # server id -> (nick, Matcher)
+
+    def configure(self, interfaces, words):
+        self.interfaces = interfaces
+        self.words = tuple(words)
+        self._matchers = {}
+
+    def matcher(self, server_id):
+        """ Get the matcher for a server, rebuilding it if our nick there has changed since we last built it. """
+        interface = self.interfaces.get(server_id)
+        nick = interface.identity.nick if interface is not None else None
+
+        cached_nick, matcher = self._matchers.get(server_id, (None, None))
+        if matcher is None or cached_nick != nick:
+            matcher = Matcher(self.words + ((nick,) if nick else ()))
+            self._matchers[server_id] = (nick, matcher)
+        return matcher
+
+    def on_new_line(self, _, line, server):
+        if server is None or line.kind not in HIGHLIGHT_KINDS or line.nick == model.SYSNICK:
+            return
+        if not self.matcher(server.id)(line.content):
+            return
+
+        mention = MentionModel.create(line=line.id, buffer=line.buffer_id, server=server, timestamp=line.timestamp)
+        model.signal_factory(NEW_MENTION).send(None, mention=mention, line=line)
+
+
+highlighter = Highlighter()
+model.signal_factory(model.NEW_LINE).connect(highlighter.on_new_line)
+
+
+def get_mentions(before=None, server=None, limit=50):
+    """ Get the lines that mentioned us, newest first, as dicts.
+
+    Lines that have since been archived are fetched from the archive.
+
+    Args:
+        before (int): Only get mentions in lines with ids lower than this, for paging back through them.
+        server (int): Only get mentions on this server.
+    """
+    mentions = MentionModel.select().order_by(-MentionModel.line).limit(limit)
+    if before is not None:
+        mentions = mentions.where(MentionModel.line < before)
+    if server is not None:
+        mentions = mentions.where(MentionModel.server == server)
+    mentions = list(mentions)
+
+    line_ids = [mention.line for mention in mentions]
+    lines = {}
+    if line_ids:
+        lines = {line['id']: line for line in model.line_store.lines(ids=line_ids)}
+
+    archived = collections.defaultdict(list)
+    for mention in mentions:
+        if mention.line not in lines:
+            archived[mention.buffer_id].append(mention.line)
+    for buffer_id, buffer_line_ids in archived.items():
+        lines.update(archive.archiver.get(buffer_id, buffer_line_ids))
+
+    return [lines[line_id] for line_id in line_ids if line_id in lines]
+
+
+def _drop_line_constraint():
+    """ Mentions used to have a foreign key to their line, which took them with it when the line was archived. SQLite
+    never enforced it (we don't turn foreign keys on), other databases need it dropping.
+    """
+    table = MentionModel._meta.db_table
+    if not any(foreign_key.column == 'line_id' for foreign_key in model.database.get_foreign_keys(table)):
+        return
+    if isinstance(model.database.obj, p.PostgresqlDatabase):
+        logger.info('Dropping the foreign key from %s to lines', table)
+        model.database.execute_sql('ALTER TABLE "{0}" DROP CONSTRAINT IF EXISTS "{0}_line_id_fkey"'.format(table))
+    elif isinstance(model.database.obj, p.MySQLDatabase):
+        logger.info('Dropping the foreign key from %s to lines', table)
+        migrator = migrate.SchemaMigrator.from_database(model.database.obj)
+        migrate.migrate(migrator.drop_foreign_key_constraint(table, 'line_id'))
+
+
+def _upgrade_indexes():
+    """ Mentions used to be indexed by (server, timestamp), which doesn't help page through them by line. """
+    table = MentionModel._meta.db_table
+    existing = {tuple(index.columns): index.name for index in model.database.get_indexes(table)}
+    if ('server_id', 'timestamp') in existing:
+        logger.info('Replacing the timestamp index on %s', table)
+        migrator = migrate.SchemaMigrator.from_database(model.database.obj)
+        migrate.migrate(migrator.drop_index(table, existing['server_id', 'timestamp']))
+    for fields in ([MentionModel.line], [MentionModel.server, MentionModel.line]):
+        if tuple(field.db_column for field in fields) not in existing:
+            model.database.create_index(MentionModel, fields)
+
+
+def initialize(interfaces, words=()):
+    model.database.create_tables([MentionModel], safe=True)
+    _drop_line_constraint()
+    _upgrade_indexes()
+    highlighter.configure(interfaces, words)
@@ -0,0 +1,683 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+possel.linelog
+--------------
+
+An append-only line store. Lines never change once they're written, so rather than paying for a B-tree insert per line
+each buffer gets a directory of segment files that lines are only ever appended to, plus for each segment a fixed-width
+index of (line id, offset, length, kind) that reads bisect through memory-mapped.
+
+    <dir>/<buffer id>/<first line id>.log  # one line per record: "<crc32 in hex> <the line as JSON>"
+    <dir>/<buffer id>/<first line id>.idx  # 24 bytes per line, in id order
+
+Writes go straight to the files but are only fsynced every so often (and every ``sync_lines`` lines), on a thread of
+its own so the IOLoop never waits on the disk, and a crash loses at most the last second or so of lines. Whatever state
+a crash leaves the newest segment in is put right when it's next opened: index entries for data that never made it to
+disk are dropped, records that did but weren't indexed are indexed and a half-written record at the end is cut off.
+To check or rebuild everything, with the server stopped:
+
+    python -m possel.linelog verify possel-lines
+    python -m possel.linelog rebuild possel-lines
+"""
+import argparse
+import atexit
+import concurrent.futures
+import datetime
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+
+from tornado import ioloop
+
+from possel import linestore, model
+
+logger = logging.getLogger(__name__)
+
+ENTRY = struct.Struct('<QQIB3x')  # line id, offset of the record in the segment, length of the record, kind
+KIND_CODES = {kind: code for code, (kind, _) in enumerate(model.LINE_TYPES)}
+UNKNOWN_KIND = 255
+
+SEGMENT_BYTES = 16 * 1024 * 1024  # start a new segment once the current one is this big
+INDEX_CAPACITY = 4096  # entries to make room for in a new index, it doubles from there as needed
+READ_GAP = 4096  # read records this close together in one go rather than one at a time
+CHUNK = 1000  # lines to read at a time when streaming a whole buffer
+
+
+def _encode(line):
+    payload = json.dumps(line, separators=(',', ':')).encode()
+    return b'%08x %s\n' % (zlib.crc32(payload), payload)
+
+
+def _decode(record):
+    """ Parse a record, checking it's all there and its checksum matches.
+
+    Raises:
+        ValueError: If it's been damaged or cut short.
+    """
+    if len(record) < 11 or record[8:9] != b' ' or not record.endswith(b'\n'):
+        raise ValueError('truncated record')
+    payload = record[9:-1]
+    if int(record[:8], 16) != zlib.crc32(payload):
+        raise ValueError('checksum mismatch')
+    return json.loads(payload.decode())
+
+
+def _scan(data, offset=0):
+    """ Split segment data into records.
+
+    Yields:
+        (offset, length, line) for each record, with line None if the record couldn't be decoded.
+    """
+    while offset < len(data):
+        end = data.find(b'\n', offset)
+        end = len(data) if end == -1 else end + 1
+        try:
+            line = _decode(data[offset:end])
+        except ValueError:
+            line = None
+        yield offset, end - offset, line
+        offset = end
+
+
+def _to_timestamp(dt):
+    return dt.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def _sync_segments(segments):
+    for segment in segments:
+        segment.sync()
+
+
+class Segment:
+    """ One of a buffer's segment files and its index.
+
+    Only the newest segment of each buffer is written to; it keeps its data file open and its index mapped read/write
+    with room to grow. Older ones are sealed, their indexes trimmed to size and mapped read-only the first time they're
+    read.
+    """
+    def __init__(self, directory, first_id):
+        self.first_id = first_id
+        base = os.path.join(directory, '{:020d}'.format(first_id))
+        self.data_path = base + '.log'
+        self.index_path = base + '.idx'
+        self.size = 0
+        self.dirty = False
+        self._count = None
+        self._index = None
+        self._fd = None  # only while we're appending to it
+        self._lock = threading.Lock()  # syncs happen off the IOLoop, don't let them see the files closed or remapped
+
+    # =========================================================================
+    # Index
+    # =========================================================================
+    def _map(self):
+        fd = os.open(self.index_path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            self._index = mmap.mmap(fd, size, access=mmap.ACCESS_READ) if size else b''
+        finally:
+            os.close(fd)
+        # Sealed indexes are trimmed to size, but don't trust that
+        count = len(self._index) // ENTRY.size
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ENTRY.unpack_from(self._index, mid * ENTRY.size)[0]:
+                lo = mid + 1
+            else:
+                hi = mid
+        self._count = lo
+
+    @property
+    def count(self):
+        if self._count is None:
+            self._map()
+        return self._count
+
+    def entry(self, position):
+        if self._index is None:
+            self._map()
+        return ENTRY.unpack_from(self._index, position * ENTRY.size)
+
+    @property
+    def last_id(self):
+        return self.entry(self.count - 1)[0] if self.count else None
+
+    def search(self, line_id):
+        """ Find the position of the first line with an id of at least ``line_id``. """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[0] < line_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def kind_codes(self, start, stop):
+        if self._index is None:
+            self._map()
+        return [code for _, _, _, code in
+                struct.iter_unpack(ENTRY.format, self._index[start * ENTRY.size:stop * ENTRY.size])]
+    # =========================================================================
+
+    # =========================================================================
+    # Writing
+    # =========================================================================
+    def open_for_append(self):
+        """ Get ready to append, first repairing any damage a crash did to the end of the segment.
+
+        Returns:
+            int: How many index entries had to be dropped or added.
+        """
+        self._fd = os.open(self.data_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self.capacity = max(os.fstat(index_fd).st_size // ENTRY.size, INDEX_CAPACITY)
+            os.ftruncate(index_fd, self.capacity * ENTRY.size)
+            self._index = mmap.mmap(index_fd, self.capacity * ENTRY.size)
+        finally:
+            os.close(index_fd)
+        return self._recover()
+
+    def _recover(self):
+        data_size = os.fstat(self._fd).st_size
+
+        # Keep index entries while they follow on from each other and point at data that's really there
+        count, end, previous_id = 0, 0, 0
+        while count < self.capacity:
+            line_id, offset, length, _ = self.entry(count)
+            if line_id <= previous_id or offset != end or end + length > data_size:
+                break
+            count, end, previous_id = count + 1, end + length, line_id
+        dropped = sum(1 for position in range(count, self.capacity) if self.entry(position)[0])
+        self._index[count * ENTRY.size:] = bytes((self.capacity - count) * ENTRY.size)
+        self._count, self.size = count, end
+
+        # Then index any whole records after the last entry and cut off anything after those
+        added = 0
+        for _, length, line in _scan(os.pread(self._fd, data_size - end, end)):
+            if line is None or line['id'] <= previous_id:
+                break
+            self._add_entry(line['id'], KIND_CODES.get(line['kind'], UNKNOWN_KIND), length)
+            previous_id = line['id']
+            added += 1
+        if self.size < data_size:
+            os.ftruncate(self._fd, self.size)
+
+        if dropped or added or self.size < data_size:
+            self.dirty = True
+            self.sync()
+        return dropped + added
+
+    def _add_entry(self, line_id, kind_code, length):
+        if self._count == self.capacity:
+            self._grow()
+        ENTRY.pack_into(self._index, self._count * ENTRY.size, line_id, self.size, length, kind_code)
+        self._count += 1
+        self.size += length
+
+    def _grow(self):
+        with self._lock:
+            self._index.flush()
+            self._index.close()
+            self.capacity *= 2
+            index_fd = os.open(self.index_path, os.O_RDWR)
+            try:
+                os.ftruncate(index_fd, self.capacity * ENTRY.size)
+                self._index = mmap.mmap(index_fd, self.capacity * ENTRY.size)
+            finally:
+                os.close(index_fd)
+
+    def append(self, line_id, kind_code, record):
+        os.write(self._fd, record)
+        self._add_entry(line_id, kind_code, len(record))
+        self.dirty = True
+
+    def sync(self):
+        """ Get everything appended so far onto disk, the data before the index that points into it.
+
+        Safe to call from another thread while the IOLoop appends; a segment that's been sealed since is already synced.
+        """
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        if self.dirty and self._fd is not None:
+            # Cleared first so anything appended while we're at it gets synced next time
+            self.dirty = False
+            os.fsync(self._fd)
+            self._index.flush()
+
+    def seal(self):
+        """ Stop appending to the segment and trim its index to size. """
+        with self._lock:
+            self._sync()
+            self._index.close()
+            self._index = None
+            os.truncate(self.index_path, self._count * ENTRY.size)
+            os.close(self._fd)
+            self._fd = None
+            self._count = None
+    # =========================================================================
+
+    # =========================================================================
+    # Reading
+    # =========================================================================
+    def read(self, positions):
+        """ Read the lines at some positions in the index, which must be in ascending order. """
+        entries = [self.entry(position) for position in positions]
+        if not entries:
+            return []
+
+        # Read runs of records that are close together with one call each
+        runs = [[entries[0]]]
+        for entry in entries[1:]:
+            _, offset, length, _ = runs[-1][-1]
+            if entry[1] - (offset + length) <= READ_GAP:
+                runs[-1].append(entry)
+            else:
+                runs.append([entry])
+
+        def read_runs(fd):
+            lines = []
+            for run in runs:
+                start = run[0][1]
+                data = os.pread(fd, run[-1][1] + run[-1][2] - start, start)
+                lines.extend(json.loads(data[offset - start + 9:offset - start + length - 1].decode())
+                             for _, offset, length, _ in run)
+            return lines
+
+        if self._fd is not None:
+            return read_runs(self._fd)
+        with open(self.data_path, 'rb') as data_file:
+            return read_runs(data_file.fileno())
+    # =========================================================================
+
+
+class BufferLog:
+    """ All of a buffer's segments, oldest first. """
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        first_ids = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.log'))
+        self.segments = [Segment(directory, first_id) for first_id in first_ids]
+        self.recovered = 0
+        if self.segments:
+            self.recovered = self.segments[-1].open_for_append()
+            if not self.segments[-1].count:
+                # Nothing survived, drop it so the next segment is named after the line that's really first in it
+                empty = self.segments.pop()
+                empty.seal()
+                os.remove(empty.data_path)
+                os.remove(empty.index_path)
+                if self.segments:
+                    self.segments[-1].open_for_append()
+
+    @property
+    def last_id(self):
+        return self.segments[-1].last_id if self.segments else None
+
+    def append(self, line_id, kind_code, record):
+        """ Returns:
+            Segment: The segment the line went in, which will want syncing.
+        """
+        active = self.segments[-1] if self.segments else None
+        if active is None or active.size >= self.segment_bytes:
+            if active is not None:
+                active.seal()
+            active = Segment(self.directory, line_id)
+            active.open_for_append()
+            directory_fd = os.open(self.directory, os.O_RDONLY)  # so the new files survive a crash too
+            try:
+                os.fsync(directory_fd)
+            finally:
+                os.close(directory_fd)
+            self.segments.append(active)
+        active.append(line_id, kind_code, record)
+        return active
+
+    def select(self, after=None, before=None, kind=None, last=None, ids=None, first=None):
+        """ Get lines as dicts, like LineStore.lines. """
+        if last is not None and last <= 0:
+            return []
+        code = KIND_CODES.get(kind, UNKNOWN_KIND) if kind is not None else None
+        ids = sorted(set(ids)) if ids is not None else None
+        segments = reversed(self.segments) if last is not None else self.segments
+        wanted = last
+        lines = []
+
+        for segment in segments:
+            if not segment.count:
+                continue
+            first_id, last_id = segment.first_id, segment.last_id
+            if after is not None and last_id < after:
+                continue
+            if before is not None and first_id > before:
+                continue
+            if ids is not None and (not ids or ids[-1] < first_id or ids[0] > last_id):
+                continue
+
+            lo = segment.search(after) if after is not None else 0
+            hi = segment.search(before + 1) if before is not None else segment.count
+            if ids is not None:
+                positions = []
+                for line_id in ids:
+                    if first_id <= line_id <= last_id:
+                        position = segment.search(line_id)
+                        if lo <= position < hi and segment.entry(position)[0] == line_id:
+                            positions.append(position)
+            else:
+                positions = range(lo, hi)
+            if code is not None:
+                codes = segment.kind_codes(lo, hi)
+                positions = [position for position in positions if codes[position - lo] == code]
+
+            if last is not None:
+                positions = list(positions)[-wanted:]
+                lines.extend(reversed(segment.read(positions)))
+                wanted -= len(positions)
+                if not wanted:
+                    break
+            else:
+                if first is not None:
+                    positions = list(positions)[:first - len(lines)]
+                lines.extend(segment.read(positions))
+                if first is not None and len(lines) >= first:
+                    break
+
+        if kind is not None and code == UNKNOWN_KIND:
+            lines = [line for line in lines if line['kind'] == kind]
+        return lines
+
+    def count(self, after=0, kinds=None):
+        codes = {KIND_CODES.get(kind, UNKNOWN_KIND) for kind in kinds} if kinds is not None else None
+        total = 0
+        for segment in self.segments:
+            if not segment.count or segment.last_id <= after:
+                continue
+            lo = segment.search(after + 1)
+            if codes is None:
+                total += segment.count - lo
+            else:
+                total += sum(1 for code in segment.kind_codes(lo, segment.count) if code in codes)
+        return total
+
+    def iter_lines(self, since=None, until=None):
+        for segment in self.segments:
+            for start in range(0, segment.count, CHUNK):
+                for line in segment.read(range(start, min(start + CHUNK, segment.count))):
+                    if (since is None or line['timestamp'] >= since) and (until is None or line['timestamp'] < until):
+                        yield line
+
+
+class LogLineStore(model.LineStore):
+    sharded = True
+    queryable = False
+    archivable = False  # segments are already compact, and there's no deleting lines from the middle of one
+
+    def __init__(self, directory, sync_interval=1.0, sync_lines=1000, segment_bytes=SEGMENT_BYTES):
+        """
+        Args:
+            directory (str): Where to keep the buffers' logs.
+            sync_interval (float): Seconds between syncs once started, at most this much is lost in a crash.
+            sync_lines (int): Sync after this many lines even if it's not time to yet.
+            segment_bytes (int): How big to let a segment get before starting a new one.
+        """
+        self.directory = directory
+        self.sync_interval = sync_interval
+        self.sync_lines = sync_lines
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self._logs = {}  # buffer id -> BufferLog
+        for name in os.listdir(directory):
+            if name.isdigit():
+                self._log(int(name))
+        recovered = sum(log.recovered for log in self._logs.values())
+        if recovered:
+            logger.warning('Repaired %d index entries left inconsistent by a crash', recovered)
+
+        if model.IRCLineModel.select().exists():
+            logger.warning("The main database has lines, they won't be visible with the line log; export them and "
+                           'import them with --line-log to move them over')
+
+        last_ids = [log.last_id for log in self._logs.values()]
+        last_ids.append(super(LogLineStore, self).last_id())
+        self._last_id = max([line_id for line_id in last_ids if line_id is not None] or [0])
+        self._ids = itertools.count(self._last_id + 1)
+        self._dirty = set()  # segments written to since the last sync
+        self._unsynced = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._syncing = None  # the background sync in progress, if any
+        self.appended = 0
+        self.syncs = 0
+
+    def _log(self, buffer_id):
+        log = self._logs.get(buffer_id)
+        if log is None:
+            log = self._logs[buffer_id] = BufferLog(os.path.join(self.directory, str(buffer_id)), self.segment_bytes)
+        return log
+
+    def start(self):
+        """ Sync every ``sync_interval`` seconds from the IOLoop. """
+        ioloop.PeriodicCallback(self.sync_soon, self.sync_interval * 1000).start()
+
+    def _take_dirty(self):
+        segments, self._dirty = self._dirty, set()
+        self._unsynced = 0
+        if segments:
+            self.syncs += 1
+        return segments
+
+    def sync_soon(self):
+        """ Start syncing in the background, unless a sync still is; what's written meanwhile waits for the next one.
+
+        Returns:
+            Future: The sync in progress, or None if there's nothing to sync.
+        """
+        if self._syncing is not None and not self._syncing.done():
+            return self._syncing
+        segments = self._take_dirty()
+        self._syncing = self.executor.submit(_sync_segments, segments) if segments else None
+        return self._syncing
+
+    def sync(self):
+        """ Sync everything now and wait for it, for imports and shutting down. """
+        if self._syncing is not None:
+            self._syncing.result()
+            self._syncing = None
+        _sync_segments(self._take_dirty())
+
+    # =========================================================================
+    # Writing
+    # =========================================================================
+    def _append(self, line):
+        kind_code = KIND_CODES.get(line['kind'], UNKNOWN_KIND)
+        segment = self._log(line['buffer']).append(line['id'], kind_code, _encode(line))
+        self._dirty.add(segment)
+        self.appended += 1
+        self._unsynced += 1
+        if self._unsynced >= self.sync_lines:
+            self.sync_soon()
+
+    def create(self, server_id, **fields):
+        fields['id'] = self._last_id = next(self._ids)
+        line = linestore.LineShardModel(**fields)
+        self._append(line.to_dict())
+        return line
+
+    def insert_many(self, server_id, rows, rows_per_insert=None):
+        for row in rows:
+            row['id'] = self._last_id = next(self._ids)
+            self._append(linestore.LineShardModel(**row).to_dict())
+        self.sync()
+
+    def flush(self):
+        self.sync()
+    # =========================================================================
+
+    # =========================================================================
+    # Reading
+    # =========================================================================
+    def readable(self, buffer_id=None):
+        return []  # the line log isn't a database, there's nothing to query
+
+    def lines(self, buffer_id=None, line_id=None, ids=None, after=None, before=None, kind=None, last=None,
+              first=None):
+        if line_id is not None:
+            ids = [line_id] if ids is None else [i for i in ids if i == line_id]
+        if buffer_id is not None:
+            logs = [self._logs[buffer_id]] if buffer_id in self._logs else []
+        else:
+            logs = list(self._logs.values())
+
+        lines = []
+        for log in logs:
+            lines.extend(log.select(after, before, kind, last, ids, first))
+        if len(logs) > 1:
+            lines.sort(key=lambda line: line['id'], reverse=last is not None)
+        if last is not None:
+            return lines[:last]
+        return lines[:first] if first is not None else lines
+
+    def iter_lines(self, buffer_id, since=None, until=None):
+        log = self._logs.get(buffer_id)
+        if log is not None:
+            yield from log.iter_lines(_to_timestamp(since) if since is not None else None,
+                                      _to_timestamp(until) if until is not None else None)
+
+    def count(self, buffer_id, after=0, kinds=None):
+        log = self._logs.get(buffer_id)
+        return log.count(after, kinds) if log is not None else 0
+
+    def counts(self, kinds=None, exclude=()):
+        exclude = set(exclude)
+        counts = ((buffer_id, log.count(0, kinds)) for buffer_id, log in self._logs.items()
+                  if buffer_id not in exclude)
+        return [(buffer_id, count) for buffer_id, count in counts if count]
+
+    def last_id(self):
+        return self._last_id or None
+    # =========================================================================
+
+    def stats(self):
+        return {'sharded': True,
+                'log': True,
+                'buffers': len(self._logs),
+                'segments': sum(len(log.segments) for log in self._logs.values()),
+                'appended': self.appended,
+                'syncs': self.syncs,
+                'unsynced': self._unsynced,
+                }
+
+
+def initialize(directory, sync_interval=1.0):
+    """ Keep lines in append-only logs under ``directory`` from now on, call ``model.line_store.start()`` once the
+    IOLoop is going. """
+    model.line_store = LogLineStore(directory, sync_interval)
+    atexit.register(model.line_store.sync)
+
+
+# =========================================================================
+# Checking and repairing
+# =========================================================================
+def _segment_paths(directory):
+    for buffer_name in sorted(os.listdir(directory), key=lambda name: (len(name), name)):
+        buffer_directory = os.path.join(directory, buffer_name)
+        if not buffer_name.isdigit() or not os.path.isdir(buffer_directory):
+            continue
+        for name in sorted(os.listdir(buffer_directory)):
+            if name.endswith('.log'):
+                yield int(buffer_name), os.path.join(buffer_directory, name[:-4])
+
+
+def _expected_entries(data_path, buffer_id, problems):
+    """ Work out what a segment's index should hold from its data, noting any damaged records. """
+    with open(data_path, 'rb') as data_file:
+        data = data_file.read()
+    entries = []
+    previous_id = 0
+    for offset, length, line in _scan(data):
+        if line is None:
+            problems.append('{}: damaged record at offset {}'.format(data_path, offset))
+        elif line['buffer'] != buffer_id or line['id'] <= previous_id:
+            problems.append('{}: line {} at offset {} is out of place'.format(data_path, line['id'], offset))
+        else:
+            entries.append((line['id'], offset, length, KIND_CODES.get(line['kind'], UNKNOWN_KIND)))
+            previous_id = line['id']
+    return entries, len(data)
+
+
+def verify(directory):
+    """ Check every record's checksum and that every index matches its data.
+
+    Returns:
+        list: Descriptions of the problems found.
+    """
+    problems = []
+    for buffer_id, base in _segment_paths(directory):
+        expected, _ = _expected_entries(base + '.log', buffer_id, problems)
+        try:
+            with open(base + '.idx', 'rb') as index_file:
+                index = index_file.read()
+        except FileNotFoundError:
+            problems.append('{}.idx: missing'.format(base))
+            continue
+        actual = [entry for entry in struct.iter_unpack(ENTRY.format, index[:len(index) // ENTRY.size * ENTRY.size])
+                  if entry[0]]
+        if actual != expected:
+            problems.append('{}.idx: has {} entries where the data has {} records{}'.format(
+                base, len(actual), len(expected), '' if len(actual) != len(expected) else ' (which differ)'))
+    return problems
+
+
+def rebuild(directory):
+    """ Rewrite every index from its data, skipping damaged records. Only run this with the server stopped.
+
+    Returns:
+        list: Descriptions of the damaged records skipped.
+    """
+    problems = []
+    for buffer_id, base in _segment_paths(directory):
+        entries, _ = _expected_entries(base + '.log', buffer_id, problems)
+        temp_path = base + '.idx.tmp'
+        with open(temp_path, 'wb') as index_file:
+            for entry in entries:
+                index_file.write(ENTRY.pack(*entry))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.replace(temp_path, base + '.idx')
+    return problems
+# =========================================================================
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(description='Check or repair a line log')
+    parser.add_argument('command', choices=['verify', 'rebuild'])
+    parser.add_argument('directory', help='The line log directory, as given to possel --line-log')
+    return parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    problems = verify(args.directory) if args.command == 'verify' else rebuild(args.directory)
+    for problem in problems:
+        print(problem)
+    logger.info('%s found %d problems', args.command.capitalize(), len(problems))
+    sys.exit(1 if problems and args.command == 'verify' else 0)
+
+
+if __name__ == '__main__':
+    main()
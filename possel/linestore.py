@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+possel.linestore
+----------------
+
+Optional per-server line storage. With one SQLite file every network's lines queue up behind the same write lock; here
+each server's lines go in their own database file instead, written by that file's own thread, while everything else
+(servers, buffers, users, read markers...) stays in the main database.
+
+Line ids are still handed out in one sequence across every shard, so they stay unique and in order and clients can
+keep using them as cursors. Lines for buffers without a server stay in the main database.
+
+Lines are announced as soon as they're queued. Until its writer has committed them a shard keeps them in memory and
+reads include them from there, so nothing waits on the writer; if a commit fails the writer keeps retrying it.
+"""
+import atexit
+import collections
+import datetime
+import glob
+import itertools
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+import peewee as p
+from playhouse import shortcuts
+
+from possel import model
+
+logger = logging.getLogger(__name__)
+
+ROWS_PER_INSERT = 100  # keeps us under SQLite's limit on bound parameters
+MAX_BATCH = 5000  # most lines a writer commits in one transaction
+MAX_RETRY_DELAY = 60  # seconds, writers back off up to this long between attempts at a failing commit
+
+
+class LineShardModel(p.Model):
+    """ IRCLineModel's twin in a shard, the buffer and user are plain ids because their tables are in the main database.
+
+    Subclassed for each shard to bind it to the shard's database.
+    """
+    buffer = p.IntegerField(db_column='buffer_id', index=True)
+    timestamp = p.DateTimeField(default=datetime.datetime.utcnow)
+    user = p.IntegerField(db_column='user_id', null=True)
+    nick = p.TextField(null=True)
+    kind = p.CharField(max_length=20, default='message', choices=model.LINE_TYPES)
+    content = p.TextField()
+
+    @property
+    def buffer_id(self):
+        return self.buffer
+
+    @property
+    def user_id(self):
+        return self.user
+
+    def to_dict(self):
+        d = shortcuts.model_to_dict(self, recurse=False)
+        d['timestamp'] = d['timestamp'].replace(tzinfo=datetime.timezone.utc).timestamp()
+        return d
+
+
+class Shard:
+    """ One server's lines, and the thread that writes them. """
+    def __init__(self, server_id, path):
+        self.server_id = server_id
+        self.path = path
+        self.database = p.SqliteDatabase(path, threadlocals=True, timeout=30,
+                                         pragmas=[('journal_mode', 'wal'), ('synchronous', 'normal')])
+
+        class Meta:
+            database = self.database
+            db_table = model.IRCLineModel._meta.db_table
+
+        self.model = type('LineShard{}Model'.format(server_id), (LineShardModel,),
+                          {'Meta': Meta, '__module__': __name__})
+        self.database.create_tables([self.model], safe=True)
+
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self._pending = collections.OrderedDict()  # line id -> line dict, for everything queued but not committed
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_forever, name='possel-lines-{}'.format(server_id),
+                                        daemon=True)
+        self._thread.start()
+
+    def put(self, line):
+        row = dict(line._data)
+        with self._lock:
+            self._pending[row['id']] = line.to_dict()
+        self._queue.put(row)
+
+    def pending(self):
+        """ The lines queued but not yet committed, oldest first. """
+        with self._lock:
+            return list(self._pending.values())
+
+    def flush(self):
+        """ Wait until everything queued so far is in the database. Blocks, so only for shutting down and imports. """
+        self._queue.join()
+
+    def _commit(self, rows):
+        delay = 1
+        while True:
+            try:
+                with self.database.atomic():
+                    for start in range(0, len(rows), ROWS_PER_INSERT):
+                        self.model.insert_many(rows[start:start + ROWS_PER_INSERT]).execute()
+                return
+            except Exception:
+                self.failures += 1
+                logger.exception('Failed writing %d lines to %s, trying again in %ds', len(rows), self.path, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    def _write_forever(self):
+        while True:
+            rows = [self._queue.get()]
+            while len(rows) < MAX_BATCH:
+                try:
+                    rows.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self._commit(rows)
+            self.written += len(rows)
+            self.batches += 1
+            with self._lock:
+                for row in rows:
+                    self._pending.pop(row['id'], None)
+            for _ in rows:
+                self._queue.task_done()
+
+    def last_id(self):
+        lines = self.model.select(self.model.id).order_by(-self.model.id).limit(1).tuples()
+        return lines[0][0] if lines else None
+
+    def stats(self):
+        return {'queued': self._queue.qsize(),
+                'written': self.written,
+                'batches': self.batches,
+                'failures': self.failures,
+                }
+
+
+_SHARD_NAME = re.compile(r'lines-(\d+)\.db$')
+
+
+class ShardedLineStore(model.LineStore):
+    sharded = True
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._shards = {}  # server id -> Shard
+        self._buffer_servers = {}  # buffer id -> server id, buffers never move
+
+        for path in glob.glob(os.path.join(directory, 'lines-*.db')):
+            self._shard(int(_SHARD_NAME.search(path).group(1)))
+
+        last_ids = [super(ShardedLineStore, self).last_id()]
+        last_ids.extend(shard.last_id() for shard in self._shards.values())
+        self._last_id = max([line_id for line_id in last_ids if line_id is not None] or [0])
+        self._ids = itertools.count(self._last_id + 1)
+
+        stranded = (model.IRCLineModel
+                    .select()
+                    .join(model.IRCBufferModel)
+                    .where(model.IRCBufferModel.server.is_null(False))
+                    .exists())
+        if stranded:
+            logger.warning("The main database has lines for servers' buffers, they won't be visible with line shards; "
+                           'export them and import them with --line-shards to move them over')
+
+    def _shard(self, server_id):
+        shard = self._shards.get(server_id)
+        if shard is None:
+            path = os.path.join(self.directory, 'lines-{}.db'.format(server_id))
+            shard = self._shards[server_id] = Shard(server_id, path)
+        return shard
+
+    def _server_of(self, buffer_id):
+        """ Raises:
+            DoesNotExist: For a buffer we don't know.
+        """
+        try:
+            return self._buffer_servers[buffer_id]
+        except KeyError:
+            server_id, = (model.IRCBufferModel
+                          .select(model.IRCBufferModel.server)
+                          .where(model.IRCBufferModel.id == buffer_id)
+                          .tuples()
+                          .get())
+            self._buffer_servers[buffer_id] = server_id
+            return server_id
+
+    def _sources(self, buffer_id=None):
+        if buffer_id is None:
+            return [(model.IRCLineModel, [])] + [(shard.model, shard.pending()) for shard in self._shards.values()]
+
+        try:
+            server_id = self._server_of(int(buffer_id))
+        except p.DoesNotExist:
+            return []
+        if server_id is None:
+            return [(model.IRCLineModel, [])]
+        shard = self._shard(server_id)
+        return [(shard.model, shard.pending())]
+
+    def readable(self, buffer_id=None):
+        return [line_model for line_model, _ in self._sources(buffer_id)]
+
+    def create(self, server_id, **fields):
+        """ Make a line with the next id and queue it for its shard's writer.
+
+        Returns:
+            The line, which won't be in the database until the writer gets to it, though reads will see it.
+        """
+        fields['id'] = self._last_id = next(self._ids)
+        if server_id is None:
+            return model.IRCLineModel.create(**fields)
+
+        self._buffer_servers[fields['buffer']] = server_id
+        shard = self._shard(server_id)
+        line = shard.model(**fields)
+        shard.put(line)
+        return line
+
+    def insert_many(self, server_id, rows, rows_per_insert=ROWS_PER_INSERT):
+        for row in rows:
+            row['id'] = self._last_id = next(self._ids)
+        if server_id is None:
+            return super(ShardedLineStore, self).insert_many(server_id, rows, rows_per_insert)
+
+        shard = self._shard(server_id)
+        shard.flush()
+        for start in range(0, len(rows), rows_per_insert):
+            shard.model.insert_many(rows[start:start + rows_per_insert]).execute()
+
+    def last_id(self):
+        return self._last_id or None
+
+    def databases(self):
+        return [model.database] + [shard.database for shard in self._shards.values()]
+
+    def flush(self):
+        for shard in self._shards.values():
+            shard.flush()
+
+    def stats(self):
+        return {'sharded': True,
+                'shards': {server_id: shard.stats() for server_id, shard in self._shards.items()},
+                }
+
+
+def initialize(directory):
+    """ Keep lines in per-server databases under ``directory`` from now on. """
+    model.line_store = ShardedLineStore(directory)
+    atexit.register(model.line_store.flush)  # the writers are daemon threads, don't lose what's queued on the way out
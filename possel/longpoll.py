@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+possel.longpoll
+---------------
+
+For clients that can't use the websocket: ``GET /line/wait?after=N`` parks until there are lines newer than N (or the
+timeout passes) and then answers from a ring of the most recent lines kept in memory, so however many clients are
+waiting the database doesn't notice. Only a client that has fallen further behind than the ring reaches costs a query.
+"""
+import collections
+import logging
+
+import tornado.concurrent
+
+from possel import model
+
+logger = logging.getLogger(__name__)
+
+
+class LineFeed:
+    """ The most recent lines across every buffer, oldest first, and the requests waiting for more. """
+    def __init__(self, size=10000):
+        self.lines = collections.deque(maxlen=size)
+        self.floor = 0  # lines with ids up to this may be missing from the ring
+        self.last_id = 0
+        self._waiters = collections.defaultdict(set)  # buffer id, or None for any buffer -> futures
+        self.woken = 0
+
+    def configure(self, size, last_id):
+        """
+        Args:
+            size (int): How many lines to keep.
+            last_id (int): The newest line from before we started listening.
+        """
+        self.lines = collections.deque(self.lines, maxlen=size)
+        self.floor = self.last_id = last_id or 0
+
+    def on_new_line(self, _, line, server):
+        line = line.to_dict()
+        if len(self.lines) == self.lines.maxlen:
+            self.floor = self.lines[0]['id']
+        self.lines.append(line)
+        self.last_id = line['id']
+
+        for key in (line['buffer'], None):
+            for future in self._waiters.pop(key, ()):
+                if not future.done():
+                    future.set_result(None)
+                    self.woken += 1
+
+    def since(self, after, buffer_id=None, limit=None):
+        """ Get the lines newer than ``after``, oldest first.
+
+        Returns:
+            list: The lines, or None if the ring doesn't go back that far.
+        """
+        if after < self.floor:
+            return None
+        lines = []
+        for line in reversed(self.lines):
+            if line['id'] <= after:
+                break
+            if buffer_id is None or line['buffer'] == buffer_id:
+                lines.append(line)
+        lines.reverse()
+        return lines[:limit] if limit is not None else lines
+
+    def replace_users(self, user_ids):
+        """ Point lines at different users, like RecentLines.replace_users. """
+        for line in self.lines:
+            line['user'] = user_ids.get(line['user'], line['user'])
+
+    def wait(self, buffer_id=None):
+        """ Get a future that's resolved when the next line arrives (in a particular buffer). """
+        future = tornado.concurrent.Future()
+        self._waiters[buffer_id].add(future)
+        return future
+
+    def cancel(self, future, buffer_id=None):
+        waiters = self._waiters.get(buffer_id)
+        if waiters is not None:
+            waiters.discard(future)
+            if not waiters:
+                del self._waiters[buffer_id]
+
+    def stats(self):
+        return {'lines': len(self.lines),
+                'size': self.lines.maxlen,
+                'floor': self.floor,
+                'waiting': sum(len(waiters) for waiters in self._waiters.values()),
+                'woken': self.woken,
+                }
+
+
+feed = LineFeed()
+model.signal_factory(model.NEW_LINE).connect(feed.on_new_line)
+
+
+def initialize(size):
+    feed.configure(size, model.line_store.last_id())
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+possel.maintenance
+------------------
+
+Housekeeping that shouldn't happen on the request path: expiring tokens, archiving old lines, clearing out users left
+behind by nick changes and keeping the database in shape. Each job runs on its own interval with a little jitter so
+they don't all land on the same IOLoop iteration.
+"""
+import logging
+import random
+import time
+
+import peewee as p
+from tornado import concurrent, gen, ioloop
+
+from possel import archive, auth, longpoll, model, monitor
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    def __init__(self, name, function, interval, jitter):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.jitter = jitter
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None
+        self.last_seconds = None
+        self.total_seconds = 0.0
+        self.last_result = None
+
+    def to_dict(self):
+        return {'interval': self.interval,
+                'runs': self.runs,
+                'failures': self.failures,
+                'last_run': self.last_run,
+                'last_seconds': self.last_seconds,
+                'mean_seconds': self.total_seconds / self.runs if self.runs else None,
+                'last_result': self.last_result,
+                }
+
+
+class Scheduler:
+    def __init__(self):
+        self.jobs = {}
+
+    def add(self, name, function, interval, jitter=0.1):
+        """ Run ``function`` every ``interval`` seconds, give or take ``jitter`` (a fraction of the interval).
+
+        Whatever the function returns is kept as the job's ``last_result`` in the stats. Coroutines (functions returning
+        a Future) give the IOLoop a turn whenever they yield, and their result is what the Future resolves to.
+        """
+        self.jobs[name] = Job(name, function, interval, jitter)
+
+    def start(self):
+        for job in self.jobs.values():
+            if job.interval:
+                self._schedule(job)
+
+    def _schedule(self, job):
+        delay = job.interval * (1 + random.uniform(-job.jitter, job.jitter))
+        ioloop.IOLoop.current().call_later(delay, self.run, job.name)
+
+    @gen.coroutine
+    def run(self, name):
+        job = self.jobs[name]
+        start, queries = time.monotonic(), monitor.monitor.queries
+        blocking = True
+        try:
+            result = job.function()
+            if concurrent.is_future(result):
+                blocking = False
+                result = yield result
+            job.last_result = result
+        except Exception:
+            logger.exception('Maintenance job %s failed', name)
+            job.failures += 1
+        finally:
+            seconds = time.monotonic() - start
+            job.runs += 1
+            job.last_run = time.time()
+            job.last_seconds = seconds
+            job.total_seconds += seconds
+            if blocking:  # otherwise the time and queries include whatever else ran while it yielded
+                monitor.monitor.record('maintenance job {}'.format(name), seconds, monitor.monitor.queries - queries)
+            self._schedule(job)
+
+    def stats(self):
+        return {name: job.to_dict() for name, job in self.jobs.items()}
+
+
+scheduler = Scheduler()
+
+
+# =========================================================================
+# Jobs
+# ----
+#
+# The database ones only make sense for SQLite, other databases look after
+# themselves (or want a DBA to).
+# =========================================================================
+def _is_sqlite(database):
+    return isinstance(getattr(database, 'obj', database), p.SqliteDatabase)
+
+
+def _pragma(database, statement):
+    row = database.execute_sql('PRAGMA {}'.format(statement)).fetchone()
+    return row[0] if row else None
+
+
+def _each_database(function):
+    """ Run a job on the main database and any line shards.
+
+    Returns:
+        The job's result for the main database, or when there are shards a dict of results keyed by database.
+    """
+    databases = model.line_store.databases()
+    if len(databases) == 1:
+        return function(databases[0])
+    return {getattr(database, 'obj', database).database: function(database) for database in databases}
+
+
+def expire_tokens():
+    return auth.cleanup_tokens()
+
+
+def _optimize(database):
+    if _is_sqlite(database):
+        database.execute_sql('PRAGMA optimize')
+    else:
+        database.execute_sql('ANALYZE')
+
+
+def optimize():
+    """ Refresh the query planner's statistics. """
+    return _each_database(_optimize)
+
+
+def _incremental_vacuum(database, pages):
+    if not _is_sqlite(database) or _pragma(database, 'auto_vacuum') != 2:
+        return 'skipped'
+    free_before = _pragma(database, 'freelist_count')
+    database.execute_sql('PRAGMA incremental_vacuum({:d})'.format(pages))
+    return free_before - _pragma(database, 'freelist_count')
+
+
+def incremental_vacuum(pages=2000):
+    """ Give back up to ``pages`` free pages to the filesystem.
+
+    Only does anything if the database has ``auto_vacuum = INCREMENTAL``, which needs a one-off full VACUUM to turn on
+    for an existing database.
+    """
+    return _each_database(lambda database: _incremental_vacuum(database, pages))
+
+
+def _wal_checkpoint(database):
+    if not _is_sqlite(database) or _pragma(database, 'journal_mode') != 'wal':
+        return 'skipped'
+    busy, log_pages, checkpointed = database.execute_sql('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+    return {'log_pages': log_pages, 'checkpointed': checkpointed}
+
+
+def wal_checkpoint():
+    """ Copy the write-ahead log back into the database so it doesn't grow without bound. """
+    return _each_database(_wal_checkpoint)
+
+
+def archive_lines():
+    return archive.archiver.run()
+
+
+@gen.coroutine
+def _referenced_users(step=50000):
+    """ The ids of every user a line refers to, for line stores that can't be joined against the users.
+
+    Reads ``step`` line ids at a time, giving the IOLoop a turn in between, along with whatever the store hasn't written
+    yet; lines added meanwhile are read too.
+
+    Returns:
+        Future: Resolves to the set of ids.
+    """
+    referenced = set()
+    start = 0
+    while start <= (model.line_store.last_id() or 0):
+        referenced.update(line['user'] for line in model.line_store.unwritten() if line['user'] is not None)
+        for line_model in model.line_store.readable():
+            users = (line_model
+                     .select(line_model.user)
+                     .where(line_model.id > start, line_model.id <= start + step, line_model.user.is_null(False))
+                     .distinct()
+                     .tuples())
+            referenced.update(user_id for user_id, in users.iterator())
+        start += step
+        yield gen.moment
+    return referenced
+
+
+@gen.coroutine
+def _merge_history(history):
+    """ Hand the lines of historical users sharing a nick key over to the newest of them, a nick key at a time.
+
+    Returns:
+        Future: Resolves to the number of users merged away.
+    """
+    groups = (model.IRCUserModel
+              .select(model.IRCUserModel.server, model.IRCUserModel.nick_key, p.fn.MAX(model.IRCUserModel.id))
+              .where(history)
+              .group_by(model.IRCUserModel.server, model.IRCUserModel.nick_key)
+              .having(p.fn.COUNT(model.IRCUserModel.id) > 1))
+    merged = 0
+    for server_id, key, newest in list(groups.tuples()):
+        others = (model.IRCUserModel
+                  .select(model.IRCUserModel.id)
+                  .where(model.IRCUserModel.server == server_id, model.IRCUserModel.nick_key == key, history,
+                         model.IRCUserModel.id != newest))
+        other_ids = [user_id for user_id, in others.tuples()]
+        with model.database.atomic():
+            for i in range(0, len(other_ids), 500):
+                (model.IRCLineModel
+                 .update(user=newest)
+                 .where(model.IRCLineModel.user << other_ids[i:i + 500])
+                 .execute())
+
+        # The lines in memory were copied before the update
+        replaced = dict.fromkeys(other_ids, newest)
+        model.recent_lines.replace_users(replaced)
+        longpoll.feed.replace_users(replaced)
+        merged += len(other_ids)
+        yield gen.moment
+    return merged
+
+
+@gen.coroutine
+def compact_users(batch_size=500):
+    """ Merge and delete the users left behind by nick changes and quits.
+
+    When lines are kept in the main database, historical (not current) users with the same nick key on a server are
+    merged into the newest of them, which takes over their lines. Then any historical users that no line or membership
+    refers to are deleted, ``batch_size`` at a time with the IOLoop getting a turn between batches. Archived lines keep
+    their nicks but may end up with the ids of deleted users.
+
+    Returns:
+        Future: Resolves to a dict of how many users were merged and deleted, with ``skipped`` set if the line store
+        can't be searched by user.
+    """
+    if not model.line_store.queryable:
+        return {'skipped': True, 'merged': 0, 'deleted': 0}
+
+    history = model.IRCUserModel.current == False  # noqa: E712
+    members = model.IRCBufferMembershipRelation.select(model.IRCBufferMembershipRelation.user)
+    unused = [history, model.IRCUserModel.id.not_in(members)]
+    merged, referenced = 0, set()
+    if model.line_store.sharded:
+        referenced = yield _referenced_users()
+    else:
+        merged = yield _merge_history(history)
+        lines = (model.IRCLineModel
+                 .select(p.SQL('1'))
+                 .where(model.IRCLineModel.user == model.IRCUserModel.id))
+        unused.append(~p.fn.EXISTS(lines))
+
+    deleted, last_id = 0, 0
+    while True:
+        candidates = (model.IRCUserModel
+                      .select(model.IRCUserModel.id)
+                      .where(model.IRCUserModel.id > last_id, *unused)
+                      .order_by(model.IRCUserModel.id)
+                      .limit(batch_size))
+        user_ids = [user_id for user_id, in candidates.tuples()]
+        if not user_ids:
+            break
+        last_id = user_ids[-1]
+
+        unused_ids = [user_id for user_id in user_ids if user_id not in referenced]
+        if unused_ids:
+            deleted += model.IRCUserModel.delete().where(model.IRCUserModel.id << unused_ids).execute()
+        if len(user_ids) < batch_size:
+            break
+        yield gen.moment
+    return {'skipped': False, 'merged': merged, 'deleted': deleted}
+# =========================================================================
+
+
+# Seconds between runs of each job, 0 to never run it
+DEFAULT_INTERVALS = {'expire_tokens': 60 * 60,
+                     'optimize': 24 * 60 * 60,
+                     'incremental_vacuum': 60 * 60,
+                     'wal_checkpoint': 5 * 60,
+                     'archive': 10 * 60,
+                     'compact_users': 24 * 60 * 60,
+                     }
+
+JOBS = {'expire_tokens': expire_tokens,
+        'optimize': optimize,
+        'incremental_vacuum': incremental_vacuum,
+        'wal_checkpoint': wal_checkpoint,
+        'archive': archive_lines,
+        'compact_users': compact_users,
+        }
+
+
+def initialize(intervals=None):
+    """ Add the standard jobs and start them.
+
+    Args:
+        intervals (dict): Job name -> seconds between runs, overriding DEFAULT_INTERVALS.
+    """
+    intervals = dict(DEFAULT_INTERVALS, **(intervals or {}))
+    for name, function in JOBS.items():
+        scheduler.add(name, function, intervals[name])
+    scheduler.start()
@@ -8,14 +8,19 @@ This module defines an API for storing the state of an IRC server and probably i
 """
 import collections
 import datetime
+import functools
 import logging
+import operator
+import string
 
 import peewee as p
 
 import pircel
 from pircel import protocol, signals
 
-from playhouse import shortcuts
+from playhouse import migrate, shortcuts
+
+from possel import cache, monitor, queries
 
 
 logger = logging.getLogger(__name__)
@@ -57,6 +62,38 @@ class KeyDefaultDict(collections.defaultdict):
 database = p.Proxy()
 
 
+# =========================================================================
+# Casemapping
+# -----------
+#
+# Nicks are case insensitive, but what counts as the same letter is up to
+# the server's CASEMAPPING (from RPL_ISUPPORT); under rfc1459 "[]\~" are the
+# upper case of "{}|^". Users are looked up by their nick's key, the nick
+# folded to lower case under their server's casemapping.
+# =========================================================================
+DEFAULT_CASEMAPPING = 'rfc1459'  # what servers that don't say are meant to use
+_CASEMAP_TABLES = {'ascii': str.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+                   'rfc1459': str.maketrans(string.ascii_uppercase + '[]\\~', string.ascii_lowercase + '{}|^'),
+                   'strict-rfc1459': str.maketrans(string.ascii_uppercase + '[]\\', string.ascii_lowercase + '{}|'),
+                   }
+_casemappings = {}  # server id -> casemapping, for servers not using the default
+
+
+def nick_key(nick, casemapping=DEFAULT_CASEMAPPING):
+    """ Fold a nick to lower case under a casemapping, unknown ones (e.g. rfc7613) get Unicode case folding. """
+    table = _CASEMAP_TABLES.get(casemapping)
+    if table is None:
+        return nick.casefold()
+    return nick.translate(table)
+
+
+def server_nick_key(nick, server):
+    """ Fold a nick under a server's (given as a model or id) casemapping. """
+    server_id = server.id if isinstance(server, IRCServerModel) else server
+    return nick_key(nick, _casemappings.get(server_id, DEFAULT_CASEMAPPING))
+# =========================================================================
+
+
 class BaseModel(p.Model):
     class Meta:
         database = database
@@ -103,6 +140,8 @@ class IRCServerModel(BaseModel):
     user = p.ForeignKeyField(UserDetails)
     # =========================================================================
 
+    casemapping = p.CharField(max_length=20, default=DEFAULT_CASEMAPPING)  # from RPL_ISUPPORT
+
     class Meta:
         indexes = ((('host', 'port'), True),
                    )
@@ -114,14 +153,17 @@ class IRCUserModel(UserDetails):
     Inherits most of its fields from UserDetails.
 
     Don't delete user models, they're needed for line models.
+
+    There's at most one current user per nick key on a server, enforced by a partial unique index (see
+    PARTIAL_INDEXES) where the database has them.
     """
     host = p.TextField(null=True)  # where they're coming from
     server = p.ForeignKeyField(IRCServerModel, related_name='users', on_delete='CASCADE')
     current = p.BooleanField()  # are they connected?
+    nick_key = p.CharField(default='')  # the nick under the server's casemapping, see server_nick_key
 
     class Meta:
-        indexes = ((('server', 'nick'), False),
-                   (('server', 'nick', 'current'), False),
+        indexes = ((('server', 'nick_key', 'current'), False),
                    )
 
 
@@ -180,6 +222,204 @@ class IRCLineModel(BaseModel):
         return d
 
 
+def _line_matches(line, buffer_id=None, line_id=None, ids=None, after=None, before=None, kinds=None, since=None,
+                  until=None):
+    """ Whether a line (as a dict) passes the filters LineStore puts on its queries; ``after`` and ``before`` are
+    inclusive, ``since`` and ``until`` are datetimes making the range [since, until).
+    """
+    if buffer_id is not None and line['buffer'] != buffer_id:
+        return False
+    if line_id is not None and line['id'] != line_id:
+        return False
+    if ids is not None and line['id'] not in ids:
+        return False
+    if after is not None and line['id'] < after:
+        return False
+    if before is not None and line['id'] > before:
+        return False
+    if kinds is not None and line['kind'] not in kinds:
+        return False
+    if since is not None and line['timestamp'] < since.replace(tzinfo=datetime.timezone.utc).timestamp():
+        return False
+    if until is not None and line['timestamp'] >= until.replace(tzinfo=datetime.timezone.utc).timestamp():
+        return False
+    return True
+
+
+class LineStore:
+    """ Where lines are kept; by default the IRCLineModel table, possel.linestore and possel.linelog can swap in
+    something else.
+
+    Anything reading lines should go through ``lines``, ``count`` and friends rather than querying IRCLineModel
+    directly. Stores kept in SQL databases also give the models to query with ``readable``, they all have the same
+    fields and ``to_dict``; check ``queryable`` before asking for them.
+    """
+    sharded = False  # can lines be joined against the other tables?
+    queryable = True  # does readable give models for the lines?
+    archivable = True  # can possel.archive move old lines out of it? (only if it's queryable)
+
+    def readable(self, buffer_id=None):
+        """ Get the line models to query for a buffer's lines (none for a buffer we don't know), or for all lines.
+
+        Lines a store hasn't written yet may not be in them; ``lines`` and friends include those too.
+        """
+        return [IRCLineModel]
+
+    def _sources(self, buffer_id=None):
+        """ What to read for a buffer's lines, or all lines: (line model, unwritten lines) pairs.
+
+        The unwritten lines are dicts, oldest first, that the model doesn't have yet or is in the middle of getting;
+        readers only ask the model for lines older than the first of them.
+        """
+        return [(line_model, []) for line_model in self.readable(buffer_id)]
+
+    def unwritten(self):
+        """ The lines, as dicts, that the models from ``readable`` don't have yet. """
+        return [line for _, pending in self._sources() for line in pending]
+
+    def lines(self, buffer_id=None, line_id=None, ids=None, after=None, before=None, kind=None, last=None,
+              first=None):
+        """ Get lines as dicts, oldest first (at most ``first`` of them), or with ``last`` the newest ``last`` of them
+        newest first.
+
+        ``after`` and ``before`` are inclusive.
+        """
+        lines = []
+        sources = self._sources(buffer_id)
+        for line_model, pending in sources:
+            query = line_model.select()
+            if line_id is not None:
+                query = query.where(line_model.id == line_id)
+            if ids is not None:
+                query = query.where(line_model.id << ids)
+            if before is not None:
+                query = query.where(line_model.id <= before)
+            if after is not None:
+                query = query.where(line_model.id >= after)
+            if kind is not None:
+                query = query.where(line_model.kind == kind)
+            if buffer_id is not None:
+                query = query.where(line_model.buffer == buffer_id)
+            if pending:
+                query = query.where(line_model.id < pending[0]['id'])
+            if last is not None:
+                query = query.order_by(-line_model.id).limit(last)
+            else:
+                query = query.order_by(line_model.id)
+                if first is not None:
+                    query = query.limit(first)
+            lines.extend(line.to_dict() for line in query)
+            lines.extend(line for line in pending
+                         if _line_matches(line, buffer_id, line_id, ids, after, before, [kind] if kind else None))
+
+        if len(sources) > 1 or any(pending for _, pending in sources):
+            lines.sort(key=lambda line: line['id'], reverse=last is not None)
+        if last is not None:
+            return lines[:last]
+        return lines[:first] if first is not None else lines
+
+    def iter_lines(self, buffer_id, since=None, until=None):
+        """ Stream a buffer's lines as dicts, oldest first, optionally only those from the datetimes [since, until). """
+        for line_model, pending in self._sources(buffer_id):
+            query = (line_model
+                     .select(line_model.id, line_model.buffer, line_model.timestamp, line_model.user, line_model.nick,
+                             line_model.kind, line_model.content)
+                     .where(line_model.buffer == buffer_id)
+                     .order_by(line_model.id))
+            if since is not None:
+                query = query.where(line_model.timestamp >= since)
+            if until is not None:
+                query = query.where(line_model.timestamp < until)
+            if pending:
+                query = query.where(line_model.id < pending[0]['id'])
+
+            for line_id, buffer, timestamp, user, nick, kind, content in query.tuples().iterator():
+                yield {'id': line_id,
+                       'buffer': buffer,
+                       'timestamp': timestamp.replace(tzinfo=datetime.timezone.utc).timestamp(),
+                       'user': user,
+                       'nick': nick,
+                       'kind': kind,
+                       'content': content,
+                       }
+
+            for line in pending:
+                if _line_matches(line, buffer_id, since=since, until=until):
+                    yield line
+
+    def count(self, buffer_id, after=0, kinds=None):
+        """ Count a buffer's lines with ids above ``after``, optionally only those of some kinds. """
+        total = 0
+        for line_model, pending in self._sources(buffer_id):
+            query = line_model.select().where(line_model.buffer == buffer_id, line_model.id > after)
+            if kinds is not None:
+                query = query.where(line_model.kind << kinds)
+            if pending:
+                query = query.where(line_model.id < pending[0]['id'])
+            total += query.count()
+            total += sum(1 for line in pending if _line_matches(line, buffer_id, after=after + 1, kinds=kinds))
+        return total
+
+    def counts(self, kinds=None, exclude=()):
+        """ Count every buffer's lines, optionally only those of some kinds.
+
+        Args:
+            exclude (iterable): Buffer ids not to bother counting.
+
+        Returns:
+            list: (buffer id, count) tuples, for buffers with any lines.
+        """
+        exclude = list(exclude)
+        counts = collections.Counter()
+        for line_model, pending in self._sources():
+            query = line_model.select(line_model.buffer, p.fn.COUNT(line_model.id)).group_by(line_model.buffer)
+            if kinds is not None:
+                query = query.where(line_model.kind << kinds)
+            if exclude:
+                query = query.where(line_model.buffer.not_in(exclude))
+            if pending:
+                query = query.where(line_model.id < pending[0]['id'])
+            counts.update(dict(query.tuples()))
+            counts.update(line['buffer'] for line in pending
+                          if line['buffer'] not in exclude and _line_matches(line, kinds=kinds))
+        return list(counts.items())
+
+    def create(self, server_id, **fields):
+        return IRCLineModel.create(**fields)
+
+    def insert_many(self, server_id, rows, rows_per_insert=100):
+        """ Insert lots of lines for a server at once, ``rows_per_insert`` per statement. """
+        for start in range(0, len(rows), rows_per_insert):
+            IRCLineModel.insert_many(rows[start:start + rows_per_insert]).execute()
+
+    def last_id(self):
+        lines = IRCLineModel.select(IRCLineModel.id).order_by(-IRCLineModel.id).limit(1).tuples()
+        return lines[0][0] if lines else None
+
+    def databases(self):
+        return [database]
+
+    def flush(self):
+        pass
+
+    def stats(self):
+        return {'sharded': False}
+
+
+line_store = LineStore()
+
+
+def _load_recent_lines(buffer_id, count):
+    lines = line_store.lines(buffer_id, last=count)
+    if not lines and not IRCBufferModel.select().where(IRCBufferModel.id == buffer_id).exists():
+        return None  # so the cache doesn't fill up with made up buffer ids
+    return lines
+
+
+# The last few hundred lines of each buffer, since that's what nearly every read asks for
+recent_lines = cache.RecentLines(_load_recent_lines)
+
+
 class IRCBufferMembershipRelation(BaseModel):
     """ Buffers and Users have a many-to-many relationship, this handles that. """
     buffer = p.ForeignKeyField(IRCBufferModel, related_name='memberships', on_delete='CASCADE')
@@ -190,6 +430,22 @@ class IRCBufferMembershipRelation(BaseModel):
                    )
 
 
+def _load_roster(buffer_id):
+    # Joined from the buffer so that one that doesn't exist gives no rows at all, and an empty one a row of NULL
+    memberships = (IRCBufferModel
+                   .select(IRCBufferMembershipRelation.user)
+                   .join(IRCBufferMembershipRelation, p.JOIN.LEFT_OUTER)
+                   .where(IRCBufferModel.id == buffer_id))
+    rows = list(memberships.tuples())
+    if not rows:
+        return None
+    return [user_id for user_id, in rows if user_id is not None]
+
+
+# Who's in each buffer, kept up to date from the membership signals below
+rosters = cache.Rosters(_load_roster)
+
+
 def initialize():
     database.create_tables([UserDetails,
                             IRCServerModel,
@@ -198,6 +454,12 @@ def initialize():
                             IRCLineModel,
                             IRCBufferMembershipRelation,
                             ], safe=True)
+    _upgrade_schema()
+    _create_partial_indexes()
+    _casemappings.update(IRCServerModel
+                         .select(IRCServerModel.id, IRCServerModel.casemapping)
+                         .where(IRCServerModel.casemapping != DEFAULT_CASEMAPPING)
+                         .tuples())
     try:
         logger.info('Getting')
         IRCBufferModel.get(name='System Buffer', kind='system')
@@ -206,6 +468,60 @@ def initialize():
         create_buffer(name='System Buffer', server=None, kind='system')
 
 
+def _upgrade_schema():
+    """ Bring tables made by older versions up to date. """
+    migrator = migrate.SchemaMigrator.from_database(database.obj)
+    added = set()
+    for field in (IRCServerModel.casemapping, IRCUserModel.nick_key):
+        table = field.model_class._meta.db_table
+        if field.db_column not in {column.name for column in database.get_columns(table)}:
+            logger.info('Adding %s.%s', table, field.db_column)
+            with database.atomic():
+                migrate.migrate(migrator.add_column(table, field.db_column, field))
+            added.add(field)
+
+    if IRCUserModel.nick_key in added:
+        # Users used to be looked up by (server, nick[, current]), now it's by nick key
+        table = IRCUserModel._meta.db_table
+        for index in database.get_indexes(table):
+            if index.columns in (['server_id', 'nick'], ['server_id', 'nick', 'current']):
+                migrate.migrate(migrator.drop_index(table, index.name))
+        database.create_index(IRCUserModel, [IRCUserModel.server, IRCUserModel.nick_key, IRCUserModel.current])
+        logger.info('Computed nick keys for %d users', rekey_users())
+
+
+# Most user lookups are for current users, who are a small part of the table once it's built up some history. The first
+# also stops two current users sharing a nick key: (name, columns, unique)
+PARTIAL_INDEXES = (('ircusermodel_unique_current_nick_key', ('server_id', 'nick_key'), True),
+                   ('ircusermodel_current_id', ('id',), False),
+                   )
+REPLACED_INDEXES = ('ircusermodel_current_nick_key',)  # the non-unique version of the first
+
+
+def _create_partial_indexes():
+    """ Index just the current users; peewee can't declare these so they're made by hand. """
+    if isinstance(database.obj, p.SqliteDatabase):
+        condition = '"current" = 1'
+    elif isinstance(database.obj, p.PostgresqlDatabase):
+        condition = '"current"'
+    else:
+        return  # MySQL doesn't do partial indexes, the (server, nick_key, current) one will have to do
+
+    table = IRCUserModel._meta.db_table
+    existing = {index.name for index in database.get_indexes(table)}
+    for name in REPLACED_INDEXES:
+        if name in existing:
+            database.execute_sql('DROP INDEX {}'.format(name))
+    for name, columns, unique in PARTIAL_INDEXES:
+        if name in existing:
+            continue
+        if unique:
+            merge_duplicate_users()  # from before there was anything stopping them
+        database.execute_sql('CREATE {}INDEX {} ON {} ({}) WHERE {}'.format(
+            'UNIQUE ' if unique else '', name, table, ', '.join('"{}"'.format(column) for column in columns),
+            condition))
+
+
 # Callback signal definitions
 NEW_USER = 'new_user'
 NEW_LINE = 'new_line'
@@ -215,67 +531,139 @@ NEW_MEMBERSHIP = 'new_membership'
 DELETED_MEMBERSHIP = 'deleted_membership'
 
 
+def _roster_add(_, membership, buffer, user):
+    rosters.add(buffer.id, user.id)
+
+
+def _roster_remove(_, membership, buffer, user):
+    rosters.remove(buffer.id, user.id)
+
+
+signal_factory(NEW_MEMBERSHIP).connect(_roster_add)
+signal_factory(DELETED_MEMBERSHIP).connect(_roster_remove)
+
+
 # =========================================================================
 # Controller functions
 # ------------------
 #
 # Because we really don't need a controller class for this
 # =========================================================================
-def _ensure_no_current_user(nick, server, current=True, realname=None, username=None, host=None):
-    """ Raises an integrity error if there already exists a current user with the given details. """
-    if current:
-        try:
-            user = get_user(nick, server, current, realname, username, host)
-        except p.DoesNotExist:
-            pass
-        else:
-            if user.current:
-                raise p.IntegrityError()
+def _has_partial_indexes():
+    """ Whether the database can have PARTIAL_INDEXES, and so stops two current users sharing a nick key itself. """
+    return isinstance(database.obj, (p.SqliteDatabase, p.PostgresqlDatabase))
+
+
+def _ensure_no_current_user(nick, server):
+    """ Raises an integrity error if there already exists a current user with the given nick.
+
+    Only needed where the database doesn't have the unique partial index to do it for us.
+    """
+    query = IRCUserModel.select().where(IRCUserModel.nick_key == server_nick_key(nick, server),
+                                        IRCUserModel.server == server,
+                                        IRCUserModel.current == True)  # noqa: E712
+    if query.exists():
+        raise p.IntegrityError()
+
+
+def _insert_or_ignore(model_class, fields):
+    """ Insert a row unless a unique index already has one like it, as a single statement.
+
+    peewee can only write SQLite's version of this, so the others have theirs spliced in.
+
+    Returns:
+        The new row's id, or None if there already was one.
+    """
+    query = model_class.insert(**fields)
+    if isinstance(database.obj, p.SqliteDatabase):
+        cursor = database.execute_sql(*query.on_conflict('IGNORE').sql())
+    else:
+        sql, params = query.sql()
+        if isinstance(database.obj, p.PostgresqlDatabase):
+            sql = sql.replace(' RETURNING ', ' ON CONFLICT DO NOTHING RETURNING ', 1)
+            row = database.execute_sql(sql, params).fetchone()
+            return row[0] if row else None
+        cursor = database.execute_sql(sql.replace('INSERT INTO', 'INSERT IGNORE INTO', 1), params)
+    return cursor.lastrowid if cursor.rowcount == 1 else None
+
+
+def _get_or_create(model_class, defaults=None, **kwargs):
+    """ Get the row matching ``kwargs``, inserting it (along with ``defaults``) if there isn't one.
+
+    The common case, where the row already exists, costs a single SELECT. Otherwise the INSERT skips itself if a
+    concurrent writer beat us to it, and we just fetch their row instead. Every model used with this has a unique index
+    over ``kwargs``, except on MySQL where current users can't have theirs.
+
+    Returns:
+        tuple: ``(instance, created)``
+    """
+    try:
+        return model_class.get(**kwargs), False
+    except p.DoesNotExist:
+        pass
+
+    instance = model_class(**dict(defaults or {}, **kwargs))
+    inserted_id = _insert_or_ignore(model_class, dict(instance._data))
+    if inserted_id is None:
+        return model_class.get(**kwargs), False
+    instance._data[model_class._meta.primary_key.name] = inserted_id
+    instance._dirty.clear()
+    return instance, True
 
 
 def create_user(nick, server, current=True, realname=None, username=None, host=None):
-    # First we ensure that we don't already have a current user that matches
-    _ensure_no_current_user(nick, server, current, realname, username, host)
+    if current and not _has_partial_indexes():
+        _ensure_no_current_user(nick, server)
 
-    # Then we actually create a user
-    user = IRCUserModel.create(nick=nick, realname=realname, username=username, host=host, server=server,
-                               current=current)
+    # The unique index rejects a second current user with the nick key
+    with database.atomic():
+        user = IRCUserModel.create(nick=nick, nick_key=server_nick_key(nick, server), realname=realname,
+                                   username=username, host=host, server=server, current=current)
     signal_factory(NEW_USER).send(None, user=user, server=user.server)
     return user
 
 
 def update_user(user, nick=None, realname=None, username=None, host=None, current=None):
-    # Ensure no current user exists with the target details
-    _ensure_no_current_user(nick, user.server, current or user.current, realname, username, host)
-
+    """ Raises:
+        IntegrityError: If it would make a second current user with the nick key; ``user`` is left as it was.
+    """
+    changes = {name: value
+               for name, value in (('nick', nick), ('realname', realname), ('username', username), ('host', host),
+                                   ('current', current))
+               if value is not None}
     if nick is not None:
-        user.nick = nick
-
-    if realname is not None:
-        user.realname = realname
-
-    if username is not None:
-        user.username = username
+        changes['nick_key'] = server_nick_key(nick, user.server_id)
 
-    if host is not None:
-        user.host = host
+    target_current = changes.get('current', user.current)
+    claiming = target_current and (changes.get('nick_key', user.nick_key) != user.nick_key or not user.current)
+    if claiming and not _has_partial_indexes():
+        _ensure_no_current_user(changes.get('nick', user.nick), user.server_id)
 
-    if current is not None:
-        user.current = current
+    if changes:
+        with database.atomic():
+            IRCUserModel.update(**changes).where(IRCUserModel.id == user.id).execute()
+        for name, value in changes.items():
+            setattr(user, name, value)
 
-    user.save()
     signal_factory(NEW_USER).send(None, user=user, server=user.server)
     return user
 
 
-def create_line(buffer, content, kind, user=None, nick=None):
-    if nick is not None:
-        line = IRCLineModel.create(buffer=buffer, content=content, kind=kind, user=user, nick=nick)
-    elif user is not None:
-        line = IRCLineModel.create(buffer=buffer, content=content, kind=kind, user=user, nick=user.nick)
-    else:
-        line = IRCLineModel.create(buffer=buffer, content=content, kind=kind, user=user)
-    server = line.buffer.server
+def create_line(buffer, content, kind, user=None, nick=None, server=None):
+    """ Args:
+        server (IRCServerModel): The buffer's server, if the caller has it to hand; saves looking it up.
+    """
+    if nick is None and user is not None:
+        nick = user.nick
+    line = line_store.create(buffer.server_id,
+                             buffer=buffer.id,
+                             content=content,
+                             kind=kind,
+                             user=user.id if user is not None else None,
+                             nick=nick)
+    recent_lines.add(line.to_dict())
+    if server is None and buffer.server_id is not None:
+        server = buffer.server
     signal_factory(NEW_LINE).send(None, line=line, server=server)
     return line
 
@@ -306,6 +694,99 @@ def create_server(host, port, secure, nick, realname, username):
     server = IRCServerModel.create(host=host, port=port, secure=secure, user=user)
     signal_factory(NEW_SERVER).send(None, server=server)
     return server
+
+
+def set_casemapping(server, casemapping):
+    """ Record a server's CASEMAPPING and, if it's changed, re-key its users and merge any that now share a nick. """
+    if server.casemapping == casemapping:
+        return
+    server.casemapping = casemapping
+    server.save()
+    if casemapping == DEFAULT_CASEMAPPING:
+        _casemappings.pop(server.id, None)
+    else:
+        _casemappings[server.id] = casemapping
+    rekey_users(server.id)
+
+
+def rekey_users(server_id=None):
+    """ Recompute users' nick keys (all of them, or just one server's) under their server's casemapping.
+
+    Current users whose nicks now have the same key are merged first, as merge_duplicate_users does, since the unique
+    index wouldn't let them share it.
+
+    Returns:
+        int: How many changed.
+    """
+    users = IRCUserModel.select(IRCUserModel.id, IRCUserModel.nick, IRCUserModel.server, IRCUserModel.nick_key,
+                                IRCUserModel.current)
+    if server_id is not None:
+        users = users.where(IRCUserModel.server == server_id)
+
+    rekeyed = collections.defaultdict(list)  # new key -> user ids
+    current = collections.defaultdict(list)  # (server id, new key) -> current user ids
+    for user_id, nick, user_server_id, key, is_current in users.tuples().iterator():
+        new_key = server_nick_key(nick, user_server_id)
+        if new_key != key:
+            rekeyed[new_key].append(user_id)
+        if is_current:
+            current[user_server_id, new_key].append(user_id)
+
+    with database.atomic():
+        for user_ids in current.values():
+            if len(user_ids) > 1:
+                keep, *others = list(IRCUserModel
+                                     .select()
+                                     .where(IRCUserModel.id << user_ids)
+                                     .order_by(IRCUserModel.id.desc()))
+                _merge_users(keep, others)
+        for key, user_ids in rekeyed.items():
+            for i in range(0, len(user_ids), 500):
+                IRCUserModel.update(nick_key=key).where(IRCUserModel.id << user_ids[i:i + 500]).execute()
+    return sum(len(user_ids) for user_ids in rekeyed.values())
+
+
+def merge_duplicate_users(server_id=None):
+    """ Leave at most one current user per nick key on each server.
+
+    Nicks that differ only in case (say "Foo" and "foo") used to get a current user each. The newest stays current and
+    takes over the others' buffer memberships, the others become history like any user that's changed nick or left.
+
+    Returns:
+        int: How many users were merged away.
+    """
+    current = IRCUserModel.current == True  # noqa: E712
+    duplicates = (IRCUserModel
+                  .select(IRCUserModel.server, IRCUserModel.nick_key)
+                  .where(current)
+                  .group_by(IRCUserModel.server, IRCUserModel.nick_key)
+                  .having(p.fn.COUNT(IRCUserModel.id) > 1))
+    if server_id is not None:
+        duplicates = duplicates.where(IRCUserModel.server == server_id)
+
+    merged = 0
+    for user_server_id, key in list(duplicates.tuples()):
+        keep, *others = list(IRCUserModel
+                             .select()
+                             .where(IRCUserModel.server == user_server_id, IRCUserModel.nick_key == key, current)
+                             .order_by(IRCUserModel.id.desc()))
+        with database.atomic():
+            _merge_users(keep, others)
+        merged += len(others)
+    return merged
+
+
+def _merge_users(keep, others):
+    """ Hand current users' buffer memberships over to ``keep`` and make them history. """
+    for other in others:
+        buffers = (IRCBufferModel
+                   .select()
+                   .join(IRCBufferMembershipRelation)
+                   .where(IRCBufferMembershipRelation.user == other))
+        for buffer in list(buffers):
+            delete_membership(other, buffer)
+            ensure_membership(buffer, keep)
+        update_user(other, current=False)
 # =========================================================================
 
 
@@ -316,63 +797,92 @@ def create_server(host, port, secure, nick, realname, username):
 # Not calling them "view" because they can modify stuff
 # =========================================================================
 def get_user(nick, server, current=True, realname=None, username=None, host=None):
-    kwargs = {'nick': nick, 'server': server, 'current': current}
+    kwargs = {'nick_key': server_nick_key(nick, server), 'server': server, 'current': current}
     if realname is not None:
         kwargs['realname'] = realname
     if username is not None:
         kwargs['username'] = username
     if host is not None:
         kwargs['host'] = host
-    return IRCUserModel.get(**kwargs)
+    user = IRCUserModel.get(**kwargs)
+    if isinstance(server, IRCServerModel):
+        user.server = server  # saves fetching it again, e.g. for the NEW_USER signal
+    return user
 
 
 def ensure_user(nick, server, realname=None, username=None, host=None):
-    """ Gets a user by (nick, server) and updates the other properties. """
-    try:
-        user = create_user(nick=nick, server=server)
-    except p.IntegrityError:
-        user = IRCUserModel.get(nick=nick, server=server)
+    """ Gets the current user by (nick, server), creating them if necessary, and updates the other properties (including
+    the nick, which may have changed case).
+    """
+    details = {name: value
+               for name, value in (('nick', nick), ('realname', realname), ('username', username), ('host', host))
+               if value is not None}
+
+    user, created = _get_or_create(IRCUserModel, details, nick_key=server_nick_key(nick, server), server=server,
+                                   current=True)
+    if created:
+        signal_factory(NEW_USER).send(None, user=user, server=user.server)
+        return user
 
-    changed = False
-    if realname is not None:
-        user.realname = realname
-        changed = True
-    if username is not None:
-        user.username = username
-        changed = True
-    if host is not None:
-        user.host = host
-        changed = True
+    changed = {name: value for name, value in details.items() if getattr(user, name) != value}
     if changed:
+        for name, value in changed.items():
+            setattr(user, name, value)
         user.save()
 
     return user
 
 
 def ensure_buffer(name, server, kind=None):
-    try:
-        buffer = create_buffer(name=name, server=server, kind=kind)
-    except p.IntegrityError:
-        buffer = IRCBufferModel.get(name=name, server=server)
+    defaults = {'current': True}
+    if kind is not None:
+        defaults['kind'] = kind
+
+    buffer, created = _get_or_create(IRCBufferModel, defaults, name=name, server=server)
+    if created:
+        signal_factory(NEW_BUFFER).send(None, buffer=buffer, server=buffer.server)
     return buffer
 
 
 def ensure_membership(buffer, user):
-    try:
-        membership = create_membership(buffer, user)
-    except p.IntegrityError:
-        membership = IRCBufferMembershipRelation.get(buffer=buffer, user=user)
+    membership, created = _get_or_create(IRCBufferMembershipRelation, buffer=buffer, user=user)
+    if created:
+        signal_factory(NEW_MEMBERSHIP).send(None, membership=membership, buffer=buffer, user=user)
     return membership
 # =========================================================================
 
 
 SYSNICK = '-*-'
+NICK_PREFIXES = '~&@%+'  # Channel mode prefixes NAMES might put in front of a nick
+PREFIX_MODES = dict(zip('qaohv', NICK_PREFIXES))  # and the modes that give them
+PARAMETER_MODES = 'beIk'  # other channel modes that always take a parameter
+SET_PARAMETER_MODES = 'l'  # and ones that only do when they're being set
 
 
 class IRCServerInterface:
-    def __init__(self, server_model):
+    """ Args:
+        server_model (IRCServerModel): The server to interface with.
+        system_buffer (IRCBufferModel): Its system buffer if we already have it, otherwise it's fetched (or created).
+            Clients put the server's other buffers next to it, so it has to exist before any of them do.
+    """
+    # Most queries each IRC event may make, see possel.queries. NAMES, NICK, QUIT and ISUPPORT (CASEMAPPING) aren't
+    # here, they make a few queries per name given or per buffer the user is in.
+    query_budgets = {'join': 8,
+                     'part': 6,
+                     'privmsg': 5,
+                     'notice': 5,
+                     'rpl_welcome': 0,
+                     'rpl_motd': 1,
+                     'rpl_topic': 4,
+                     'rpl_topicwhotime': 4,
+                     'rpl_notopic': 0,
+                     }
+
+    def __init__(self, server_model, system_buffer=None):
         self.server_model = server_model
-        self.system_buffer = ensure_buffer(name=self.server_model.host, server=self.server_model, kind='system')
+        if system_buffer is None:
+            system_buffer = ensure_buffer(name=server_model.host, server=server_model, kind='system')
+        self.system_buffer = system_buffer
         self._user = server_model.user
         self._server_handler = None
         self.protocol_callbacks = {'privmsg': self._handle_privmsg,
@@ -387,6 +897,8 @@ class IRCServerInterface:
                                    'rpl_topic': self._handle_rpl_topic,
                                    'rpl_topicwhotime': self._handle_rpl_topicwhotime,
                                    'rpl_notopic': self._handle_rpl_notopic,
+                                   'rpl_isupport': self._handle_rpl_isupport,
+                                   'mode': self._handle_mode,
                                    }
 
     @property
@@ -399,7 +911,9 @@ class IRCServerInterface:
             raise ServerAlreadyAttachedError()
 
         for signal, callback in self.protocol_callbacks.items():
-            new_server_handler.add_callback(signal, callback)
+            name = '{} on {}'.format(callback.__name__, self.server_model.host)
+            callback = queries.scoped(name, callback, self.query_budgets.get(signal))
+            new_server_handler.add_callback(signal, monitor.monitor.timed(name, callback))
 
         self._server_handler = new_server_handler
 
@@ -420,7 +934,7 @@ class IRCServerInterface:
 
         buffer = ensure_buffer(channel, self.server_model)
 
-        if nick == self._user.nick:  # *We* are joining a channel
+        if self._is_us(nick):  # *We* are joining a channel
             buffer.current = True
             buffer.save()
 
@@ -429,7 +943,7 @@ class IRCServerInterface:
                            host=host,
                            server=self.server_model)
         ensure_membership(buffer, user)
-        create_line(buffer=buffer, user=user, kind='join', content='has joined the channel')
+        create_line(buffer=buffer, server=self.server_model, user=user, kind='join', content='has joined the channel')
 
     def _handle_notice(self, _, **kwargs):
         who_from = kwargs['prefix']
@@ -444,7 +958,7 @@ class IRCServerInterface:
         else:
             user = ensure_user(nick=nick, username=username, host=host, server=self.server_model)
 
-        if to == self._user.nick:
+        if self._is_us(to):
             # We may have to do more parsing ¬_¬
             if msg.startswith('[') and msg[1] in '#&+!':
                 # Might be a private channel notice
@@ -465,18 +979,18 @@ class IRCServerInterface:
             # It's a public channel notice
             buffer = ensure_buffer(name=to, server=self.server_model)
 
-        create_line(buffer=buffer, user=user, kind='notice', content=msg)
+        create_line(buffer=buffer, server=self.server_model, user=user, kind='notice', content=msg)
 
     def _handle_server_notice(self, msg):
         buffer = self.system_buffer
-        create_line(buffer=buffer, kind='notice', nick=SYSNICK, content=msg)
+        create_line(buffer=buffer, server=self.server_model, kind='notice', nick=SYSNICK, content=msg)
 
     def _handle_privmsg(self, _, **kwargs):
         who_from = kwargs['prefix']
         to, msg = kwargs['args']
         nick, username, host = protocol.parse_identity(who_from)
 
-        if to == self._user.nick:  # Private Message
+        if self._is_us(to):  # Private Message
             buffer = ensure_buffer(name=nick, server=self.server_model)
         else:  # Hopefully a channel message?
             buffer = ensure_buffer(name=to, server=self.server_model)
@@ -488,15 +1002,17 @@ class IRCServerInterface:
             msg = msg[len(action_prefix):-1]
             kind = 'action'
 
-        create_line(buffer=buffer, user=user, kind=kind, content=msg)
+        create_line(buffer=buffer, server=self.server_model, user=user, kind=kind, content=msg)
 
     def _handle_rpl_namreply(self, _, **kwargs):
         to, channel_privacy, channel, space_sep_names = kwargs['args']
         names = space_sep_names.split(' ')
         buffer = ensure_buffer(name=channel, server=self.server_model)
         for name in names:
-            user = self.get_user_by_nick(name)
+            nick = name.lstrip(NICK_PREFIXES)
+            user = self.get_user_by_nick(nick)
             ensure_membership(user=user, buffer=buffer)
+            rosters.update(buffer.id, user.id, modes=name[:len(name) - len(nick)])
 
     def _handle_nick(self, _, **kwargs):
         old_nick, username, host = protocol.parse_identity(kwargs['prefix'])
@@ -504,7 +1020,8 @@ class IRCServerInterface:
 
         logger.debug('%s, %s', old_nick, self.server_handler.identity.nick)
 
-        if new_nick == self.server_handler.identity.nick:
+        identity_key = server_nick_key(self.server_handler.identity.nick, self.server_model)
+        if server_nick_key(new_nick, self.server_model) == identity_key:
             # The protocol handler will update its own state as it uses the database model without saving it for storage
             # We save it because we're the database bit.
             # We want to wait until confirmation that the nick change happens from the server.
@@ -520,9 +1037,9 @@ class IRCServerInterface:
             update_user(old_user, current=False)  # un-current the user currently using the nick
             update_user(user, nick=new_nick)  # make the change
 
-        for relation in user.memberships:
-            buffer = relation.buffer
+        for buffer in self._buffers_with(user):
             create_line(buffer=buffer,
+                        server=self.server_model,
                         user=user,
                         nick=old_nick,
                         kind='nick',
@@ -535,26 +1052,26 @@ class IRCServerInterface:
         user = get_user(nick, self.server_model, current=True)
         buffer = IRCBufferModel.get(name=channel, server=self.server_model)
 
-        if nick == self._user.nick:
+        if self._is_us(nick):
             buffer.current = False
             buffer.save()
 
         delete_membership(user, buffer)
-        create_line(buffer=buffer, user=user, kind='part', content='has left the channel')
+        create_line(buffer=buffer, server=self.server_model, user=user, kind='part', content='has left the channel')
 
     def _handle_quit(self, _, **kwargs):
         nick, username, host = protocol.parse_identity(kwargs['prefix'])
         *other_args, reason = kwargs['args']
 
-        user = IRCUserModel.get(nick=nick, server=self.server_model)
-        for relation in user.memberships:
-            buffer = relation.buffer
-            if nick == self._user.nick:
+        user = get_user(nick, self.server_model)
+        for buffer in self._buffers_with(user):
+            if self._is_us(nick):
                 buffer.current = False
                 buffer.save()
 
             delete_membership(user, buffer)
-            create_line(buffer=buffer, user=user, kind='quit', content='has quit ({})'.format(reason))
+            create_line(buffer=buffer, server=self.server_model, user=user, kind='quit',
+                        content='has quit ({})'.format(reason))
 
     def _handle_rpl_welcome(self, _, **kwargs):
         # Maybe put channel autojoin in here?
@@ -562,30 +1079,65 @@ class IRCServerInterface:
 
     def _handle_rpl_motd(self, _, **kwargs):
         _, line, *other_args = kwargs['args']
-        create_line(buffer=self.system_buffer, nick=SYSNICK, kind='other', content=line)
+        create_line(buffer=self.system_buffer, server=self.server_model, nick=SYSNICK, kind='other', content=line)
 
     def _handle_topic(self, _, **kwargs):
         nick, username, host = protocol.parse_identity(kwargs['prefix'])
         channel, topic = kwargs['args']
         buffer = ensure_buffer(name=channel, server=self.server_model)
-        create_line(buffer=buffer, nick=SYSNICK, server=self.server_model,
+        create_line(buffer=buffer, server=self.server_model, nick=SYSNICK,
                     content='{} changed the topic for {} to: {}'.format(nick, channel, topic))
 
     def _handle_rpl_topic(self, _, **kwargs):
         _, channel, topic = kwargs['args']
         buffer = ensure_buffer(name=channel, server=self.server_model)
-        create_line(buffer=buffer, nick=SYSNICK, kind='topic',
+        create_line(buffer=buffer, server=self.server_model, nick=SYSNICK, kind='topic',
                     content='Topic for {}: {}'.format(channel, topic))
 
     def _handle_rpl_topicwhotime(self, _, **kwargs):
         _, channel, user, timestamp = kwargs['args']
         nick, username, host = protocol.parse_identity(user)
         buffer = ensure_buffer(name=channel, server=self.server_model)
-        create_line(buffer=buffer, nick=SYSNICK, kind='topic',
+        create_line(buffer=buffer, server=self.server_model, nick=SYSNICK, kind='topic',
                     content='Topic set by {}'.format(nick))
 
     def _handle_rpl_notopic(self, _, **kwargs):
         pass
+
+    def _handle_mode(self, _, **kwargs):
+        target, modes, *params = kwargs['args']
+        if self._is_us(target):  # our user modes
+            return
+        buffer = IRCBufferModel.select().where(IRCBufferModel.name == target,
+                                               IRCBufferModel.server == self.server_model).first()
+        if buffer is None:
+            return
+
+        params = iter(params)
+        adding = True
+        for mode in modes:
+            if mode in '+-':
+                adding = mode == '+'
+            elif mode in PREFIX_MODES:
+                nick = next(params, None)
+                if nick is None:
+                    break
+                try:
+                    user = get_user(nick, self.server_model)
+                except IRCUserModel.DoesNotExist:
+                    continue
+                prefix = PREFIX_MODES[mode]
+                rosters.change_modes(buffer.id, user.id, added=prefix if adding else '',
+                                     removed='' if adding else prefix, order=NICK_PREFIXES)
+            elif mode in PARAMETER_MODES or (adding and mode in SET_PARAMETER_MODES):
+                next(params, None)
+
+    def _handle_rpl_isupport(self, _, **kwargs):
+        _, *tokens, _ = kwargs['args']  # our nick, then the tokens, then "are supported by this server"
+        for token in tokens:
+            name, _, value = token.partition('=')
+            if name == 'CASEMAPPING' and value:
+                set_casemapping(self.server_model, value.lower())
     # =========================================================================
 
     # =========================================================================
@@ -594,6 +1146,16 @@ class IRCServerInterface:
     #
     # Yes, normally we don't do getters in Python but these have parameters.
     # =========================================================================
+    def _is_us(self, nick):
+        return server_nick_key(nick, self.server_model) == server_nick_key(self._user.nick, self.server_model)
+
+    def _buffers_with(self, user):
+        """ All the buffers a user is in, fetched in one go rather than through each of their memberships. """
+        return list(IRCBufferModel
+                    .select()
+                    .join(IRCBufferMembershipRelation)
+                    .where(IRCBufferMembershipRelation.user == user))
+
     def get_user_by_nick(self, nick):
         """ Return the user object from just the nick.
 
@@ -620,11 +1182,8 @@ class IRCServerInterface:
 
     @property
     def channels(self):
-        n = IRCBufferModel.name
-        return self.server_model.buffers.where(n.startswith('#') |
-                                               n.startswith('&') |
-                                               n.startswith('+') |
-                                               n.startswith('!'))
+        is_channel = functools.reduce(operator.or_, [IRCBufferModel.name.startswith(prefix) for prefix in '#&+!'])
+        return self.server_model.buffers.where(is_channel)
     # =========================================================================
 
     # =========================================================================
@@ -642,13 +1201,19 @@ class IRCServerInterface:
 
     @classmethod
     def get_all(cls):
-        models = IRCServerModel.select()
-        return {model.id: cls(model) for model in models}
+        """ Make interfaces for every server, loading their details and system buffers in a couple of queries rather
+        than a couple per server. Only servers missing their system buffer get one made for them.
+        """
+        servers = list(IRCServerModel.select(IRCServerModel, UserDetails).join(UserDetails))
+        system_buffers = {(buffer.server_id, buffer.name): buffer
+                          for buffer in IRCBufferModel.select().where(IRCBufferModel.kind == 'system')}
+        return {server.id: cls(server, system_buffers.get((server.id, server.host))) for server in servers}
     # =========================================================================
 
 
 def main():
     pass
 
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+possel.monitor
+--------------
+
+Everything happens on one IOLoop, so one slow callback holds up everything else. This keeps an eye on how late the loop
+is running and times IRC protocol callbacks and HTTP requests, logging (and remembering) any that take too long along
+with how many queries they made.
+"""
+import collections
+import functools
+import logging
+import time
+
+from tornado import ioloop
+from tornado.log import access_log
+
+logger = logging.getLogger(__name__)
+
+
+class Monitor:
+    def __init__(self):
+        self.queries = 0  # every query we've made, callbacks' counts are the difference before and after
+        self.configure()
+
+    def configure(self, threshold=0.1, lag_interval=0.5, history=50):
+        """
+        Args:
+            threshold (float): Callbacks and requests taking longer than this many seconds are logged as slow.
+            lag_interval (float): How often to check how late the IOLoop is running, in seconds.
+            history (int): How many slow callbacks and lag samples to keep for /stats.
+        """
+        self.threshold = threshold
+        self.lag_interval = lag_interval
+        self.slow = collections.deque(maxlen=history)
+        self.lag = collections.deque(maxlen=history)
+        self.max_lag = 0.0
+        self._expected = None
+
+    # =========================================================================
+    # IOLoop lag
+    # ----------
+    #
+    # We ask to be called back every ``lag_interval`` seconds; however late
+    # the call comes is how long anything else would have had to wait too.
+    # =========================================================================
+    def start(self):
+        self._expected = time.monotonic() + self.lag_interval
+        ioloop.IOLoop.current().call_later(self.lag_interval, self._check_lag)
+
+    def _check_lag(self):
+        now = time.monotonic()
+        lag = max(now - self._expected, 0.0)
+        self.lag.append(lag)
+        self.max_lag = max(self.max_lag, lag)
+        if lag > self.threshold:
+            logger.warning('IOLoop running %.0fms behind', lag * 1000)
+
+        self._expected = now + self.lag_interval
+        ioloop.IOLoop.current().call_later(self.lag_interval, self._check_lag)
+    # =========================================================================
+
+    # =========================================================================
+    # Timing
+    # =========================================================================
+    def watch_database(self, database):
+        """ Count every query made through a (real, not proxy) peewee database. """
+        execute_sql = database.execute_sql
+
+        @functools.wraps(execute_sql)
+        def counting_execute_sql(*args, **kwargs):
+            self.queries += 1
+            return execute_sql(*args, **kwargs)
+
+        database.execute_sql = counting_execute_sql
+
+    def record(self, name, seconds, queries):
+        if seconds <= self.threshold:
+            return
+        logger.warning('Slow: %s took %.0fms and %d queries', name, seconds * 1000, queries)
+        self.slow.append({'name': name,
+                          'ms': round(seconds * 1000, 1),
+                          'queries': queries,
+                          'at': time.time(),
+                          })
+
+    def timed(self, name, function):
+        """ Wrap a callback so each call is timed and its queries counted under ``name``. """
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            start, queries = time.monotonic(), self.queries
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, time.monotonic() - start, self.queries - queries)
+        return timed_function
+
+    def request_started(self, handler):
+        handler._monitor_queries = self.queries
+
+    def log_request(self, handler):
+        """ Tornado ``log_function``, does the usual access logging as well as timing the request. """
+        status = handler.get_status()
+        if status < 400:
+            log_method = access_log.info
+        elif status < 500:
+            log_method = access_log.warning
+        else:
+            log_method = access_log.error
+        seconds = handler.request.request_time()
+        log_method('%d %s %.2fms', status, handler._request_summary(), seconds * 1000)
+
+        # Handlers that wait on purpose (long polls) say for how long, so that doesn't count as slow
+        seconds -= getattr(handler, 'monitor_idle', 0)
+        queries = self.queries - getattr(handler, '_monitor_queries', self.queries)
+        self.record('{} {}'.format(type(handler).__name__, handler._request_summary()), seconds, queries)
+    # =========================================================================
+
+    def stats(self):
+        return {'queries': self.queries,
+                'lag_ms': round(self.lag[-1] * 1000, 1) if self.lag else None,
+                'mean_lag_ms': round(sum(self.lag) / len(self.lag) * 1000, 1) if self.lag else None,
+                'max_lag_ms': round(self.max_lag * 1000, 1),
+                'threshold_ms': self.threshold * 1000,
+                'slow': list(self.slow),
+                }
+
+
+monitor = Monitor()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+possel.outbound
+---------------
+
+Everything we say to a server goes through its outbound queue, which paces it the way ircds pace us so that a pasted
+wall of text comes out steadily instead of getting us killed for flooding.
+
+The pacing copies ircu's penalty clock: each message costs a couple of seconds plus a second for every 120 bytes, and we
+may run up to ten seconds ahead of the wall clock before we have to wait. Lines typed by a person jump ahead of anything
+queued in bulk (pastes and scripts).
+"""
+import collections
+import logging
+import time
+
+from tornado import ioloop
+
+logger = logging.getLogger(__name__)
+
+
+# Priorities, lowest first
+INTERACTIVE = 0
+BULK = 1
+PRIORITIES = {'interactive': INTERACTIVE, 'bulk': BULK}
+
+# Posts that split into more lines than this are treated as pastes
+PASTE_LINES = 3
+
+MAX_LINE_BYTES = 512  # including the trailing CRLF
+PREFIX_ALLOWANCE = 100  # room for the ":nick!user@host " the server adds when relaying our messages to everyone else
+
+
+def _split_line(line, limit):
+    """ Split a line into chunks of at most ``limit`` bytes of UTF-8, on a space if there's one near the end.
+
+    A character wider than ``limit`` gets a chunk to itself, over the limit, rather than never being sent.
+    """
+    while len(line.encode()) > limit:
+        chunk = line.encode()[:limit].decode(errors='ignore') or line[0]
+        space = chunk.rfind(' ')
+        if space > len(chunk) // 2:
+            chunk = chunk[:space]
+        yield chunk
+        line = line[len(chunk):].lstrip(' ')
+    if line:
+        yield line
+
+
+def split_message(command, target, content, prefix='', suffix=''):
+    """ Split content into lines that will fit in an IRC message each, however the server relays them.
+
+    Args:
+        prefix (str): Wrapped around every line, e.g. for CTCP ACTIONs.
+        suffix (str): As ``prefix``.
+
+    Returns:
+        list: The lines to send, with ``prefix`` and ``suffix`` applied.
+    """
+    overhead = len('{} {} :{}{}\r\n'.format(command, target, prefix, suffix).encode()) + PREFIX_ALLOWANCE
+    limit = max(MAX_LINE_BYTES - overhead, 1)
+    return [prefix + chunk + suffix
+            for line in content.splitlines()
+            for chunk in _split_line(line, limit)]
+
+
+class OutboundQueue:
+    """ Paced queue of things to say to a single server.
+
+    Args:
+        interface (model.IRCServerInterface): The interface to the server, its ``server_handler`` does the sending.
+        penalty (float): Seconds each message costs.
+        bytes_per_second (int): Each this many bytes of a message costs another second.
+        burst (float): How many seconds of penalty we can build up before we have to wait.
+    """
+    def __init__(self, interface, penalty=2.0, bytes_per_second=120, burst=10.0, clock=time.monotonic):
+        self.interface = interface
+        self.penalty = penalty
+        self.bytes_per_second = bytes_per_second
+        self.burst = burst
+        self.clock = clock
+
+        self._queues = (collections.deque(), collections.deque())  # indexed by priority
+        self._penalty_until = 0.0  # when the server will think we've stopped talking
+        self._timeout = None
+        self.sent = 0
+        self.dropped = 0
+        self.waited = 0  # times we've had to hold back to stay under the limit
+
+    def put(self, wire_line, function, *args, priority=INTERACTIVE):
+        """ Queue up a call to the server handler.
+
+        Args:
+            wire_line (str): The line this'll put on the wire, for working out what it costs.
+            function (str): Name of the server handler method to call.
+        """
+        self._queues[priority].append((wire_line, function, args))
+        if self._timeout is None:  # otherwise we're already waiting to send
+            self.flush()
+
+    def _cost(self, wire_line):
+        return self.penalty + len(wire_line.encode()) / self.bytes_per_second
+
+    def flush(self):
+        """ Send as much as the rate limit allows right now, and arrange to come back for the rest. """
+        self._timeout = None
+        while any(self._queues):
+            now = self.clock()
+            start = max(self._penalty_until, now)
+            if start - now > self.burst:
+                self.waited += 1
+                self._timeout = ioloop.IOLoop.current().call_later(start - now - self.burst, self.flush)
+                return
+
+            queue = self._queues[INTERACTIVE] or self._queues[BULK]
+            wire_line, function, args = queue.popleft()
+
+            server_handler = self.interface.server_handler
+            if server_handler is None:
+                logger.warning('Not connected to %s, dropping "%s"', self.interface.server_model.host, wire_line)
+                self.dropped += 1
+                continue
+
+            getattr(server_handler, function)(*args)
+            self._penalty_until = start + self._cost(wire_line)
+            self.sent += 1
+
+    # =========================================================================
+    # Commands
+    # --------
+    #
+    # Queued equivalents of the server handler methods we use.
+    # =========================================================================
+    def send_message(self, target, content, priority=None, action=False):
+        """ Queue a message, split into as many lines as it takes.
+
+        Args:
+            priority (int): INTERACTIVE or BULK, by default messages longer than PASTE_LINES lines are BULK.
+            action (bool): Send it as a CTCP ACTION (/me).
+        """
+        prefix, suffix = ('\1ACTION ', '\1') if action else ('', '')
+        lines = split_message('PRIVMSG', target, content, prefix, suffix)
+        if priority is None:
+            priority = BULK if len(lines) > PASTE_LINES else INTERACTIVE
+        for line in lines:
+            self.put('PRIVMSG {} :{}'.format(target, line), 'send_message', target, line, priority=priority)
+        return len(lines)
+
+    def join(self, channel, password=None):
+        self.put('JOIN {} {}'.format(channel, password or ''), 'join', channel, password)
+
+    def part(self, channel):
+        self.put('PART {}'.format(channel), 'part', channel)
+
+    def change_nick(self, nick):
+        self.put('NICK {}'.format(nick), 'change_nick', nick)
+    # =========================================================================
+
+    def stats(self):
+        return {'interactive': len(self._queues[INTERACTIVE]),
+                'bulk': len(self._queues[BULK]),
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'waited': self.waited,
+                'penalty_seconds': max(self._penalty_until - self.clock(), 0.0),
+                }
+
+
+class Queues:
+    """ The outbound queue for each server, made the first time something's said to it. """
+    def __init__(self):
+        self._queues = {}  # server id -> OutboundQueue
+
+    def get(self, interface):
+        server_id = interface.server_model.id
+        queue = self._queues.get(server_id)
+        if queue is None:
+            queue = self._queues[server_id] = OutboundQueue(interface)
+        return queue
+
+    def stats(self):
+        return {server_id: queue.stats() for server_id, queue in self._queues.items()}
+
+
+queues = Queues()
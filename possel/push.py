@@ -1,15 +1,236 @@
 # -*- coding: utf-8 -*-
+import collections
+import json
 import logging
+import time
 
-from tornado import websocket
+from tornado import ioloop, websocket
 import tornado.web
 
-from possel import auth, model
+from possel import activity, auth, highlights, model, queries
 
 
 logger = logging.getLogger(__name__)
 
 
+# Subscription levels for buffers
+FULL = 'full'  # every event for the buffer
+ACTIVITY = 'activity'  # just the unread and mention counts
+NONE = 'none'  # nothing at all
+LEVELS = {FULL, ACTIVITY, NONE}
+
+# Most queries opening a push connection may make (after authenticating it), see possel.queries. The first one since
+# startup also counts the unread lines of buffers it has no read markers in.
+OPEN_QUERY_BUDGET = 5
+
+
+class Subscriptions:
+    """ Index of which pushers want to hear about which servers and buffers.
+
+    Pushers that have never sent a subscription get everything, which is what clients got before subscriptions existed.
+    """
+    def __init__(self):
+        self._everything = set()  # pushers with no subscription at all
+        self._defaults = {FULL: set(), ACTIVITY: set()}  # level -> pushers using it for buffers they didn't name
+        self._buffers = collections.defaultdict(dict)  # buffer id -> {pusher: level}
+        self._servers = collections.defaultdict(set)  # server id -> pushers that named it
+        self._all_servers = set()  # pushers that didn't name any servers
+        self._subscriptions = {}  # pusher -> (server ids or None, {buffer id: level})
+
+    def add(self, pusher):
+        self._everything.add(pusher)
+
+    def remove(self, pusher):
+        self._everything.discard(pusher)
+        for pushers in self._defaults.values():
+            pushers.discard(pusher)
+        self._all_servers.discard(pusher)
+
+        servers, buffers = self._subscriptions.pop(pusher, (None, {}))
+        for server_id in servers or ():
+            self._servers[server_id].discard(pusher)
+            if not self._servers[server_id]:
+                del self._servers[server_id]
+        for buffer_id in buffers:
+            del self._buffers[buffer_id][pusher]
+            if not self._buffers[buffer_id]:
+                del self._buffers[buffer_id]
+
+    def subscribe(self, pusher, servers=None, buffers=None, default=NONE):
+        """ Replace a pusher's subscription.
+
+        Args:
+            servers (iterable): Ids of the servers to hear about new buffers and users for, None for all of them. Only
+                those server level events are filtered by it, what happens in buffers goes by ``buffers`` and
+                ``default`` whichever server they're on.
+            buffers (dict): Maps buffer ids to the level of interest in them.
+            default (str): The level of interest in buffers not named in ``buffers``.
+        """
+        self.remove(pusher)
+
+        buffers = buffers or {}
+        for buffer_id, level in buffers.items():
+            self._buffers[buffer_id][pusher] = level
+        if default != NONE:
+            self._defaults[default].add(pusher)
+
+        if servers is None:
+            self._all_servers.add(pusher)
+        else:
+            servers = set(servers)
+            for server_id in servers:
+                self._servers[server_id].add(pusher)
+
+        self._subscriptions[pusher] = (servers, buffers)
+
+    def for_buffer(self, buffer_id):
+        """ Get the pushers interested in a buffer and how interested they are.
+
+        Yields:
+            (pusher, level) for each of them, never with level NONE.
+        """
+        named = self._buffers.get(buffer_id, {})
+        for pusher in self._everything:
+            yield pusher, FULL
+        for level, pushers in self._defaults.items():
+            for pusher in pushers:
+                if pusher not in named:
+                    yield pusher, level
+        for pusher, level in named.items():
+            if level != NONE:
+                yield pusher, level
+
+    def for_server(self, server_id):
+        """ Get the pushers interested in server level events (new buffers and users). """
+        return self._everything | self._all_servers | self._servers.get(server_id, set())
+
+    def everyone(self):
+        return self._everything | set(self._subscriptions)
+
+    def stats(self):
+        return {'pushers': len(self.everyone()),
+                'unsubscribed': len(self._everything),
+                'indexed_buffers': len(self._buffers),
+                }
+
+
+subscriptions = Subscriptions()
+
+
+class Heartbeat:
+    """ Pings every pusher regularly and drops the ones that stop answering.
+
+    A client that vanishes without closing its connection (laptop lid shut, phone off the wifi) would otherwise have
+    everything queued up for it until the kernel gives up on the socket, which can take hours.
+    """
+    def __init__(self):
+        self.configure()
+
+    def configure(self, interval=30, timeout=90):
+        """
+        Args:
+            interval (float): Seconds between pings.
+            timeout (float): Seconds without hearing anything from a client before we give up on it.
+        """
+        self.interval = interval
+        self.timeout = timeout
+        self.reaped = 0
+
+    def start(self):
+        ioloop.PeriodicCallback(self.beat, self.interval * 1000).start()
+
+    def beat(self):
+        now = time.monotonic()
+        for pusher in subscriptions.everyone():
+            if now - pusher.last_seen > self.timeout:
+                self.reap(pusher, 'nothing heard for {:.0f}s'.format(now - pusher.last_seen))
+                continue
+            try:
+                pusher.ping(b'')
+            except websocket.WebSocketClosedError:
+                self.reap(pusher, 'connection already closed')
+
+    def reap(self, pusher, reason):
+        logger.info('Dropping push client %s, %s', pusher.request.remote_ip, reason)
+        # Stop sending it anything now rather than whenever the close handshake times out
+        subscriptions.remove(pusher)
+        self.reaped += 1
+        pusher.close()
+
+    def stats(self):
+        return {'live': len(subscriptions.everyone()),
+                'reaped': self.reaped,
+                'ping_interval': self.interval,
+                'ping_timeout': self.timeout,
+                }
+
+
+heartbeat = Heartbeat()
+
+
+# =========================================================================
+# Signal receivers
+# ----------------
+#
+# Connected once for everyone rather than once per pusher, they look up who
+# is interested in the index above.
+# =========================================================================
+def _push_line(_, line, server):
+    for pusher, level in subscriptions.for_buffer(line.buffer_id):
+        if level == FULL:
+            pusher.send_line_id(line)
+
+
+def _push_activity(_, user_id, buffer_id, line_id, activity):
+    for pusher, level in subscriptions.for_buffer(buffer_id):
+        if level == ACTIVITY and pusher.user_id == user_id:
+            pusher.send_activity(buffer_id, line_id, activity)
+
+
+def _push_mention(_, mention, line):
+    for pusher, _ in subscriptions.for_buffer(line.buffer_id):
+        pusher.send_mention(line)
+
+
+def _push_buffer(_, buffer, server):
+    server_id = server.id if server is not None else None
+    for pusher in subscriptions.for_server(server_id):
+        pusher.send_buffer_id(buffer, server)
+
+
+def _push_user(_, user, server):
+    for pusher in subscriptions.for_server(server.id):
+        pusher.send_user_id(user, server)
+
+
+def _push_server(_, server):
+    for pusher in subscriptions.everyone():
+        pusher.send_server_id(server)
+
+
+def _push_membership(_, membership, user, buffer):
+    for pusher, level in subscriptions.for_buffer(buffer.id):
+        if level == FULL:
+            pusher.send_membership(membership, user, buffer)
+
+
+def _push_deleted_membership(_, membership, user, buffer):
+    for pusher, level in subscriptions.for_buffer(buffer.id):
+        if level == FULL:
+            pusher.send_deleted_membership(membership, user, buffer)
+
+
+model.signal_factory(model.NEW_LINE).connect(_push_line)
+activity.signal_factory(activity.UNREAD_CHANGED).connect(_push_activity)
+model.signal_factory(highlights.NEW_MENTION).connect(_push_mention)
+model.signal_factory(model.NEW_BUFFER).connect(_push_buffer)
+model.signal_factory(model.NEW_USER).connect(_push_user)
+model.signal_factory(model.NEW_SERVER).connect(_push_server)
+model.signal_factory(model.NEW_MEMBERSHIP).connect(_push_membership)
+model.signal_factory(model.DELETED_MEMBERSHIP).connect(_push_deleted_membership)
+# =========================================================================
+
+
 class ResourcePusher(websocket.WebSocketHandler):
     def get_current_user(self):
         token = self.get_secure_cookie('token')
@@ -19,7 +240,7 @@ class ResourcePusher(websocket.WebSocketHandler):
 
     @tornado.web.asynchronous
     def get(self, *args, **kwargs):
-        if not self.get_current_user():
+        if not self.current_user:
             self.set_status(401)
             self.finish('Unauthorized.')
             return
@@ -29,33 +250,40 @@ class ResourcePusher(websocket.WebSocketHandler):
         return True
 
     def send_last_line_id(self):
-        try:
-            line = model.IRCLineModel.select().order_by(-model.IRCLineModel.id).limit(1)[0]
-        except IndexError:
-            self.write_message({'type': 'last_line', 'line': -1})
-        else:
-            self.write_message({'type': 'last_line', 'line': line.id})
+        line_id = model.line_store.last_id()
+        self.write_message({'type': 'last_line', 'line': line_id if line_id is not None else -1})
+
+    def send_line_id(self, line):
+        self.write_message({'type': 'line', 'line': line.id, 'buffer': line.buffer_id})
+
+    def send_activity(self, buffer_id, line_id, activity):
+        self.write_message({'type': 'activity',
+                            'line': line_id,
+                            'buffer': buffer_id,
+                            'unread': activity.unread,
+                            'mentions': activity.mentions,
+                            })
 
-    def send_line_id(self, _, line, server):
-        self.write_message({'type': 'line', 'line': line.id, 'buffer': line.buffer.id})
+    def send_mention(self, line):
+        self.write_message({'type': 'mention', 'line': line.id, 'buffer': line.buffer_id})
 
-    def send_buffer_id(self, _, buffer, server):
-        self.write_message({'type': 'buffer', 'buffer': buffer.id, 'server': server.id})
+    def send_buffer_id(self, buffer, server):
+        self.write_message({'type': 'buffer', 'buffer': buffer.id, 'server': buffer.server_id})
 
-    def send_user_id(self, _, user, server):
+    def send_user_id(self, user, server):
         self.write_message({'type': 'user', 'user': user.id, 'server': server.id})
 
-    def send_server_id(self, _, server):
+    def send_server_id(self, server):
         self.write_message({'type': 'server', 'server': server.id})
 
-    def send_membership(self, _, membership, user, buffer):
+    def send_membership(self, membership, user, buffer):
         self.write_message({'type': 'membership',
                             'membership': membership.id,
                             'user': user.id,
                             'buffer': buffer.id,
                             })
 
-    def send_deleted_membership(self, _, membership, user, buffer):
+    def send_deleted_membership(self, membership, user, buffer):
         self.write_message({'type': 'delete_membership',
                             'membership': membership.id,
                             'user': user.id,
@@ -64,19 +292,48 @@ class ResourcePusher(websocket.WebSocketHandler):
 
     def initialize(self, interfaces):
         self.interfaces = interfaces
-        self.signals = {model.NEW_LINE: self.send_line_id,
-                        model.NEW_BUFFER: self.send_buffer_id,
-                        model.NEW_USER: self.send_user_id,
-                        model.NEW_SERVER: self.send_server_id,
-                        model.NEW_MEMBERSHIP: self.send_membership,
-                        model.DELETED_MEMBERSHIP: self.send_deleted_membership,
-                        }
 
     def open(self):
-        for signal, handler in self.signals.items():
-            model.signal_factory(signal).connect(handler)
-        self.send_last_line_id()
+        with queries.Scope('ResourcePusher open', OPEN_QUERY_BUDGET):
+            self.last_seen = time.monotonic()
+            self.user_id = self.current_user.id
+            activity.counters.load(self.user_id)  # so we get told about their unread counts from now on
+            subscriptions.add(self)
+            self.send_last_line_id()
+
+    def on_pong(self, data):
+        self.last_seen = time.monotonic()
+
+    def on_message(self, message):
+        self.last_seen = time.monotonic()
+        try:
+            msg = json.loads(message)
+            if msg['type'] != 'subscribe':
+                raise ValueError('Unknown message type {}'.format(msg['type']))
+            self.subscribe(msg)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning('Bad message from push client: %s', e)
+
+    def subscribe(self, msg):
+        """ Handle a subscription message, e.g.::
+
+            {"type": "subscribe", "servers": [1], "buffers": {"3": "full"}, "default": "activity"}
+        """
+        servers = msg.get('servers')
+        if servers is not None:
+            if not isinstance(servers, list):
+                raise ValueError('servers should be a list of server ids')
+            servers = [int(server_id) for server_id in servers]
+
+        buffers = msg.get('buffers', {})
+        if not isinstance(buffers, dict):
+            raise ValueError('buffers should map buffer ids to levels')
+        buffers = {int(buffer_id): level for buffer_id, level in buffers.items()}
+        default = msg.get('default', NONE)
+        if not LEVELS.issuperset(buffers.values()) or default not in LEVELS:
+            raise ValueError('Unknown subscription level')
+
+        subscriptions.subscribe(self, servers, buffers, default)
 
     def on_close(self):
-        for signal, handler in self.signals.items():
-            model.signal_factory(signal).disconnect(handler)
+        subscriptions.remove(self)
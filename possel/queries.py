@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+possel.queries
+--------------
+
+Query accounting for debug mode and tests. Every IRC event and HTTP request runs in a scope that counts the queries it
+makes and, once enabled, records every foreign key peewee had to load lazily (the usual cause of one query per row).
+Scopes can declare a budget; going over it is logged, or in strict mode (for tests) raises BudgetExceededError.
+
+    queries.enable(strict_budgets=True)
+    with queries.Scope('posting a line', budget=4):
+        ...
+"""
+import collections
+import functools
+import logging
+import traceback
+
+import peewee as p
+
+from possel import monitor
+
+logger = logging.getLogger(__name__)
+
+
+class BudgetExceededError(Exception):
+    pass
+
+
+enabled = False
+strict = False
+_scopes = []  # open scopes, innermost last
+violations = collections.deque(maxlen=100)  # (scope name, problem) for tests to check
+
+
+class Scope:
+    def __init__(self, name, budget=None):
+        self.name = name
+        self.budget = budget
+        self.lazy_loads = collections.Counter()  # "Model.field at file:line" -> times loaded
+        self.queries = 0
+
+    def start(self):
+        self._queries_at_start = monitor.monitor.queries
+        _scopes.append(self)
+        return self
+
+    def finish(self):
+        """ Close the scope and report what it did wrong, if anything.
+
+        Returns:
+            list: Descriptions of the problems.
+        """
+        _scopes.remove(self)
+        self.queries = monitor.monitor.queries - self._queries_at_start
+
+        problems = []
+        if self.lazy_loads:
+            problems.append('lazily loaded {} relations: {}'.format(
+                sum(self.lazy_loads.values()),
+                ', '.join('{} (x{})'.format(where, count) for where, count in self.lazy_loads.most_common())))
+        if self.budget is not None and self.queries > self.budget:
+            problems.append('made {} queries, over its budget of {}'.format(self.queries, self.budget))
+
+        for problem in problems:
+            logger.warning('%s %s', self.name, problem)
+            violations.append((self.name, problem))
+        return problems
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        problems = self.finish()
+        if strict and problems and exc_type is None:
+            raise BudgetExceededError('{} {}'.format(self.name, '; '.join(problems)))
+
+
+def scoped(name, function, budget=None):
+    """ Wrap a callback so each call runs in its own scope. """
+    @functools.wraps(function)
+    def scoped_function(*args, **kwargs):
+        with Scope(name, budget):
+            return function(*args, **kwargs)
+    return scoped_function
+
+
+# =========================================================================
+# Lazy load detection
+# -------------------
+#
+# Peewee fetches a foreign key's object the first time the attribute is
+# read, unless a join or an assignment already put it in the instance's
+# object cache.
+# =========================================================================
+def _record_lazy_load(descriptor):
+    caller = traceback.extract_stack(limit=4)[0]  # whoever read the attribute
+    where = '{}.{} at {}:{}'.format(descriptor.field.model_class.__name__, descriptor.field.name,
+                                    caller.filename, caller.lineno)
+    for scope in _scopes:
+        scope.lazy_loads[where] += 1
+    if not _scopes:
+        logger.debug('Lazy load outside any scope: %s', where)
+
+
+def enable(strict_budgets=False):
+    """ Start recording lazy loads, and with ``strict_budgets`` make scopes raise when they go wrong. """
+    global enabled, strict
+    strict = strict_budgets
+    if enabled:
+        return
+    enabled = True
+
+    get_object_or_id = p.RelationDescriptor.get_object_or_id
+
+    @functools.wraps(get_object_or_id)
+    def recording_get_object_or_id(descriptor, instance):
+        loaded = descriptor.att_name in instance._obj_cache
+        if not loaded and instance._data.get(descriptor.att_name) is not None:
+            _record_lazy_load(descriptor)
+        return get_object_or_id(descriptor, instance)
+
+    p.RelationDescriptor.get_object_or_id = recording_get_object_or_id
+# =========================================================================
@@ -8,19 +8,49 @@ system over HTTP. This is coupled with a real time push mechanism that will be u
 resources.
 """
 
+import datetime
 import json
 import logging
 
 from pircel import tornado_adapter
+from tornado import gen
 import tornado.web
 
-from possel import auth, commands, model
+from possel import (activity, archive, auth, commands, debug, highlights, longpoll, maintenance, model, monitor,
+                    outbound, push, queries)
 
 logger = logging.getLogger(__name__)
 insecure_logger = logging.getLogger('insecure.{}'.format(__name__))
 
+# Most ids we'll look up in one go; keeps us well under SQLite's limit on bound parameters
+MAX_IDS = 500
+
+# Most lines a read of a buffer without ?last= returns, so asking for a whole buffer can't pull in all of its archive
+MAX_RANGE_LINES = 5000
+
+# Long polling: how long /line/wait waits by default and at most, in seconds, and the most lines it returns at once
+DEFAULT_WAIT = 30
+MAX_WAIT = 120
+MAX_WAIT_LINES = 500
+
+# Historical users from /user/all?history=1, how many per page by default and at most
+USER_PAGE = 1000
+MAX_USER_PAGE = 5000
+
+# Mentions from /mentions, how many per page by default and at most
+MENTION_PAGE = 50
+MAX_MENTION_PAGE = 500
+
+# The profiler's sampling interval in milliseconds, by default and the range it's allowed
+PROFILE_INTERVAL_MS = 5
+MIN_PROFILE_INTERVAL_MS = 1
+MAX_PROFILE_INTERVAL_MS = 1000
+
 
 class BaseAPIHandler(tornado.web.RequestHandler):
+    # Most queries a request may make, by method, see possel.queries
+    query_budgets = {}
+
     def initialize(self, interfaces):
         self.set_header('Content-Type', 'application/json')
         self.set_header('Access-Control-Allow-Origin', '*')
@@ -28,16 +58,49 @@ class BaseAPIHandler(tornado.web.RequestHandler):
         self.interfaces = interfaces
 
     def prepare(self):
+        monitor.monitor.request_started(self)
+        self.query_scope = queries.Scope('{} {} {}'.format(type(self).__name__, self.request.method, self.request.uri),
+                                         self.query_budgets.get(self.request.method)).start()
         if self.request.headers.get('Content-Type', '').startswith('application/json'):
             self.json = json.loads(self.request.body.decode())
-        token = self.get_secure_cookie('token')
-        insecure_logger.debug('Given token:     %s', token)
-        insecure_logger.debug('Have tokens: %s', [(t.user.id, t.token) for t in auth.TokenModel.select()])
-        if token is not None:
-            insecure_logger.debug('Given token in database: %s',
-                                  token.decode() in {t.token for t in auth.TokenModel.select()})
-        user = self.get_current_user()
-        insecure_logger.debug('Current user(?): %s', user.username if user else None)
+        # Dumping every token is a table scan per request, only do it when someone's going to read it
+        if insecure_logger.isEnabledFor(logging.DEBUG):
+            token = self.get_secure_cookie('token')
+            insecure_logger.debug('Given token:     %s', token)
+            insecure_logger.debug('Have tokens: %s', [(t.user_id, t.token) for t in auth.TokenModel.select()])
+            if token is not None:
+                insecure_logger.debug('Given token in database: %s',
+                                      auth.TokenModel.select().where(auth.TokenModel.token == token.decode()).exists())
+            user = self.get_current_user()
+            insecure_logger.debug('Current user(?): %s', user.username if user else None)
+
+    def on_finish(self):
+        query_scope = getattr(self, 'query_scope', None)
+        if query_scope is not None:
+            query_scope.finish()
+
+    def get_int_argument(self, name):
+        """ Parse an integer argument, None if it wasn't given. """
+        value = self.get_argument(name, None)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+
+    def get_ids_argument(self, name='ids'):
+        """ Parse a comma separated list of ids (e.g. ``?ids=1,2,3``), None if the argument wasn't given. """
+        value = self.get_argument(name, None)
+        if value is None:
+            return None
+        try:
+            ids = [int(i) for i in value.split(',') if i]
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if len(ids) > MAX_IDS:
+            raise tornado.web.HTTPError(400)
+        return ids
 
     def get_body_argument_tuple(self, names):
         return [self.get_body_argument(name) for name in names]
@@ -71,41 +134,75 @@ class SessionHandler(BaseAPIHandler):
 
 
 class LinesHandler(BaseAPIHandler):
+    """ Lines by id (``?id=1`` or ``?ids=1,2``) or from a buffer (``?buffer=1``), filtered by ``after``, ``before``
+    (both inclusive) and ``kind``.
+
+    ``&last=<n>`` gets a buffer's newest n lines, newest first. Without it you get the oldest MAX_RANGE_LINES that
+    match (with or without a buffer), oldest first; ask again with ``after`` past the last of them for more.
+    """
+    query_budgets = {'GET': 3}
+
     def initialize(self, *args, **kwargs):
         super(LinesHandler, self).initialize(*args, **kwargs)
         self.dispatcher = commands.Dispatcher(self.interfaces)
 
     @auth.required
     def get(self):
-        line_id = self.get_argument('id', None)
-        before = self.get_argument('before', None)
-        after = self.get_argument('after', None)
+        line_id = self.get_int_argument('id')
+        ids = self.get_ids_argument()
+        before = self.get_int_argument('before')
+        after = self.get_int_argument('after')
         kind = self.get_argument('kind', None)
         last = self.get_argument('last', None)
-        buffer = self.get_argument('buffer', None)
+        buffer = self.get_int_argument('buffer')
 
-        if not (line_id or before or after or last or buffer):
+        if not (line_id or ids or before or after or last or buffer):
             raise tornado.web.HTTPError(403)
 
-        lines = model.IRCLineModel.select()
-        if line_id is not None:
-            lines = lines.where(model.IRCLineModel.id == line_id)
-        if before is not None:
-            lines = lines.where(model.IRCLineModel.id <= before)
-        if after is not None:
-            lines = lines.where(model.IRCLineModel.id >= after)
-        if kind is not None:
-            lines = lines.where(model.IRCLineModel.kind == kind)
         if last is not None:
             try:
                 last = int(last)
             except ValueError:
                 last = 1
-            lines = lines.order_by(-model.IRCLineModel.id).limit(last)
-        if buffer is not None:
-            lines = lines.where(model.IRCLineModel.buffer == buffer)
-
-        self.write(json.dumps([line.to_dict() for line in lines]))
+            if last < 0:
+                raise tornado.web.HTTPError(400)
+
+        if buffer is not None and last is not None and not (line_id or ids or before or after or kind):
+            # "Last N lines of this buffer" is nearly every read we get, try and answer it from memory
+            cached = model.recent_lines.get(buffer, last)
+            if cached is not None and (len(cached) == last or not archive.archiver.has_lines(buffer)):
+                self.write(json.dumps(cached))
+                return
+
+        through_archive = buffer is not None and line_id is None and ids is None
+        if last is None:
+            lines = self.read_range(buffer, line_id, ids, after, before, kind, through_archive)
+        else:
+            lines = model.line_store.lines(buffer, line_id, ids, after, before, kind, last)
+            if through_archive:
+                lines = self.read_through_archive(lines, buffer, after, before, kind, last)
+
+        self.write(json.dumps(lines))
+
+    def read_range(self, buffer, line_id, ids, after, before, kind, through_archive):
+        """ Get the oldest MAX_RANGE_LINES lines that match, starting in the buffer's archive if it has one. """
+        archived = []
+        if through_archive:
+            # Everything archived is older than everything still in the database
+            archived = archive.archiver.read(buffer, after, before, kind, first=MAX_RANGE_LINES)
+        wanted = MAX_RANGE_LINES - len(archived)
+        if not wanted:
+            return archived
+        return archived + model.line_store.lines(buffer, line_id, ids, after, before, kind, first=wanted)
+
+    def read_through_archive(self, lines, buffer, after, before, kind, last):
+        """ Add any lines from the buffer's archive that the ``last`` query should also have matched. """
+        if len(lines) >= last:
+            return lines
+        if lines:
+            # Everything archived is older than everything still in the database
+            before = lines[-1]['id'] - 1
+        return lines + archive.archiver.read(buffer, after, before, kind, last=last - len(lines))
 
     @auth.required
     def post(self):
@@ -123,24 +220,100 @@ class LinesHandler(BaseAPIHandler):
             interface = self.interfaces[buffer.server_id]
 
             if buffer.current:
-                interface.server_handler.send_message(buffer.name, content)
+                priority = self.json.get('priority')
+                if priority is not None and priority not in outbound.PRIORITIES:
+                    raise tornado.web.HTTPError(400)
+                outbound.queues.get(interface).send_message(buffer.name, content,
+                                                            priority=outbound.PRIORITIES.get(priority))
 
         # javascript needs this to write something, otherwise it doesn't
         # handle it as a success.
         self.write({})
 
 
+class LineWaitHandler(BaseAPIHandler):
+    """ Long polling for new lines, see possel.longpoll.
+
+    Returns ``{"lines": [...], "next": id}``, pass ``next`` as ``after`` on the next poll.
+    """
+    query_budgets = {'GET': 2}
+
+    @auth.required
+    @gen.coroutine
+    def get(self):
+        after = self.get_int_argument('after')
+        buffer = self.get_int_argument('buffer')
+        try:
+            timeout = min(float(self.get_argument('timeout', DEFAULT_WAIT)), MAX_WAIT)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if after is None:
+            raise tornado.web.HTTPError(400)
+
+        lines = longpoll.feed.since(after, buffer, MAX_WAIT_LINES)
+        if lines is None:
+            self.catch_up(after, buffer)
+            return
+
+        if not lines and timeout > 0:
+            # Nothing we do while parked should count against this request
+            self.query_scope.finish()
+            self.query_scope = None
+            self.waiter = longpoll.feed.wait(buffer)
+            started = self.request.request_time()
+            try:
+                yield gen.with_timeout(datetime.timedelta(seconds=timeout), self.waiter)
+            except gen.TimeoutError:
+                pass
+            finally:
+                longpoll.feed.cancel(self.waiter, buffer)
+                self.monitor_idle = self.request.request_time() - started
+            if self.request.connection.stream.closed():
+                return
+            lines = longpoll.feed.since(after, buffer, MAX_WAIT_LINES)
+            if lines is None:
+                # So many came in while we waited that the feed's moved on past ``after``
+                self.catch_up(after, buffer)
+                return
+
+        if len(lines) == MAX_WAIT_LINES:
+            upto = lines[-1]['id']
+        else:
+            upto = max(after, longpoll.feed.last_id)
+        self.write({'lines': lines, 'next': upto})
+
+    def catch_up(self, after, buffer):
+        """ Answer a client further behind than the feed remembers from the line store. """
+        upto = longpoll.feed.floor
+        lines = model.line_store.lines(buffer, after=after + 1, before=upto, first=MAX_WAIT_LINES)
+        if len(lines) == MAX_WAIT_LINES:
+            upto = lines[-1]['id']
+        self.write({'lines': lines, 'next': upto})
+
+    def on_connection_close(self):
+        waiter = getattr(self, 'waiter', None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+
 class BufferGetHandler(BaseAPIHandler):
+    query_budgets = {'GET': 2}
+
     @auth.required
-    def get(self, buffer_id):
+    def get(self, buffer_id='all'):
         buffers = model.IRCBufferModel.select()
         if buffer_id != 'all':
             buffers = buffers.where(model.IRCBufferModel.id == buffer_id)
 
+        ids = self.get_ids_argument()
+        if ids is not None:
+            buffers = buffers.where(model.IRCBufferModel.id << ids)
+
         self.write(json.dumps([buffer.to_dict() for buffer in buffers]))
 
 
-class BufferPostHandler(BaseAPIHandler):
+class BufferPostHandler(BufferGetHandler):
+    """ Joins channels, also answers ``GET /buffer?ids=...`` lookups by way of BufferGetHandler. """
     @auth.required
     def post(self):
         server_id = self.json['server']
@@ -149,7 +322,7 @@ class BufferPostHandler(BaseAPIHandler):
         assert name[0] in '#&+!', 'Not given a channel as buffer'
 
         interface = self.interfaces[server_id]
-        interface.server_handler.join(name)
+        outbound.queues.get(interface).join(name)
 
         self.write({})
 
@@ -184,12 +357,24 @@ class ServerPostHandler(BaseAPIHandler):
 
 
 class UserGetHandler(BaseAPIHandler):
+    """ Users by id (``/user/1`` or ``?ids=1,2``), those in a buffer (``?buffer=1``) or all of them.
+
+    All of them means the current ones, who we can see on a server now. Everyone we've ever seen, including the nicks
+    people have since changed from, comes from ``?history=1`` a page at a time, ordered by id; pass the last id you got
+    as ``&after=<id>`` for the next page, and ``&limit=<n>`` for a different page size.
+    """
+    query_budgets = {'GET': 2}
+
     @auth.required
-    def get(self, user_id):
+    def get(self, user_id=None):
         users = model.IRCUserModel.select()
-        if user_id != 'all':
+        if user_id not in {None, 'all'}:
             users = users.where(model.IRCUserModel.id == user_id)
 
+        ids = self.get_ids_argument()
+        if ids is not None:
+            users = users.where(model.IRCUserModel.id << ids)
+
         buffer = self.get_argument('buffer', None)
         if buffer is not None:
             buffer = int(buffer)
@@ -197,4 +382,146 @@ class UserGetHandler(BaseAPIHandler):
                      .join(model.IRCBufferMembershipRelation)
                      .where(model.IRCBufferMembershipRelation.buffer == buffer))
 
+        if user_id in {None, 'all'} and ids is None and buffer is None:
+            if self.get_argument('history', None):
+                limit = self.get_int_argument('limit') or USER_PAGE
+                users = (users
+                         .where(model.IRCUserModel.id > (self.get_int_argument('after') or 0))
+                         .order_by(model.IRCUserModel.id)
+                         .limit(max(1, min(limit, MAX_USER_PAGE))))
+            else:
+                users = users.where(model.IRCUserModel.current == True)  # noqa: E712
+
         self.write(json.dumps([user.to_dict() for user in users]))
+
+
+class RosterHandler(BaseAPIHandler):
+    """ Who's in a buffer, straight from memory.
+
+    Members come as ``[user id, mode prefixes]`` pairs. Passing ``?since=<version>`` gets just the changes since that
+    version instead (modes of ``null`` mean the user left), unless we can no longer tell, in which case you get the
+    whole roster again.
+    """
+    @auth.required
+    def get(self, buffer_id):
+        buffer_id = int(buffer_id)
+        since = self.get_int_argument('since')
+        if since is not None:
+            delta = model.rosters.changes_since(buffer_id, since)
+            if delta is None:
+                raise tornado.web.HTTPError(404)
+            version, changes = delta
+            if changes is not None:
+                self.write({'buffer': buffer_id, 'version': version, 'changes': changes})
+                return
+
+        roster = model.rosters.get(buffer_id)
+        if roster is None:
+            raise tornado.web.HTTPError(404)
+        version, members = roster
+        self.write({'buffer': buffer_id, 'version': version, 'members': list(members.items())})
+
+
+class ActivityHandler(BaseAPIHandler):
+    """ Unread and mention counts for every buffer, and where to move the read markers for them. """
+    @auth.required
+    def get(self):
+        self.write(json.dumps(activity.counters.get(self.current_user.id)))
+
+    @auth.required
+    def post(self):
+        buffer = activity.counters.mark_read(self.current_user.id, int(self.json['buffer']), int(self.json['line']))
+        self.write(buffer.to_dict())
+
+
+class MentionsHandler(BaseAPIHandler):
+    @auth.required
+    def get(self):
+        before = self.get_int_argument('before')
+        server = self.get_int_argument('server')
+        limit = max(1, min(self.get_int_argument('limit') or MENTION_PAGE, MAX_MENTION_PAGE))
+
+        self.write(json.dumps(highlights.get_mentions(before=before, server=server, limit=limit)))
+
+
+class RetentionHandler(BaseAPIHandler):
+    """ How many days of lines each buffer keeps in the database before they're archived. """
+    @auth.required
+    def get(self):
+        self.write(json.dumps({'default': archive.archiver.default_days,
+                               'buffers': archive.get_retention(),
+                               }))
+
+    @auth.required
+    def post(self):
+        days = self.json['days']
+        archive.set_retention(int(self.json['buffer']), int(days) if days is not None else None)
+        self.write({})
+
+
+class StatsHandler(BaseAPIHandler):
+    @auth.required
+    def get(self):
+        self.write({'line_cache': model.recent_lines.stats(),
+                    'line_store': model.line_store.stats(),
+                    'longpoll': longpoll.feed.stats(),
+                    'rosters': model.rosters.stats(),
+                    'activity': activity.counters.stats(),
+                    'archive': archive.archiver.stats(),
+                    'outbound': outbound.queues.stats(),
+                    'monitor': monitor.monitor.stats(),
+                    'push': dict(push.subscriptions.stats(), **push.heartbeat.stats()),
+                    'maintenance': maintenance.scheduler.stats(),
+                    })
+
+
+class DebugHandler(BaseAPIHandler):
+    """ Admin-only profiling of the running server.
+
+    ``GET /debug/profile`` says whether the CPU profiler is running, ``POST`` ``{"action": "start"}`` (with an optional
+    ``interval_ms``) starts it and ``{"action": "stop"}`` stops it and returns the results. ``/debug/memory`` works the
+    same way for tracemalloc, except ``GET`` takes a snapshot. ``GET /debug/objects`` counts live objects.
+    """
+    @auth.admin_required
+    def get(self, what):
+        if what == 'profile':
+            self.write({'running': debug.profiler.running})
+        elif what == 'memory':
+            limit = self.get_int_argument('limit')
+            if limit is not None and limit < 1:
+                raise tornado.web.HTTPError(400)
+            try:
+                self.write(debug.memory_snapshot(limit or 25))
+            except ValueError:
+                raise tornado.web.HTTPError(409, 'tracemalloc is not running')
+        else:
+            self.write(debug.live_objects())
+
+    def get_interval(self):
+        """ The profiler's sampling interval in seconds, from ``interval_ms``. """
+        interval_ms = self.json.get('interval_ms', PROFILE_INTERVAL_MS)
+        if isinstance(interval_ms, bool) or not isinstance(interval_ms, (int, float)):
+            raise tornado.web.HTTPError(400)
+        if not MIN_PROFILE_INTERVAL_MS <= interval_ms <= MAX_PROFILE_INTERVAL_MS:
+            raise tornado.web.HTTPError(400)
+        return interval_ms / 1000
+
+    @auth.admin_required
+    def post(self, what):
+        action = self.json.get('action')
+        try:
+            if what == 'profile' and action == 'start':
+                debug.profiler.start(interval=self.get_interval())
+                self.write({})
+            elif what == 'profile' and action == 'stop':
+                self.write(debug.profiler.stop())
+            elif what == 'memory' and action == 'start':
+                debug.memory_start()
+                self.write({})
+            elif what == 'memory' and action == 'stop':
+                debug.memory_stop()
+                self.write({})
+            else:
+                raise tornado.web.HTTPError(400)
+        except ValueError as e:  # already running or not running
+            raise tornado.web.HTTPError(409, str(e))
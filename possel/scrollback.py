@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+possel.scrollback
+-----------------
+
+Bulk export and import of scrollback, for compliance dumps and for bringing years of logs over from other clients.
+
+Both directions stream, so memory use stays flat however much history there is. Imports skip all the usual signals and
+caches, so run them with the server stopped. Imported lines get new ids after every existing line, and everything that
+reads lines assumes a buffer's ids go up with time, so they can only go into buffers that don't have any lines yet.
+
+    python -m possel.scrollback export --server irc.example.org --since 2015-01-01 -o dump.jsonl.gz
+    python -m possel.scrollback import --format jsonl dump.jsonl.gz
+    python -m possel.scrollback import --format irssi --server irc.example.org --buffer '#possel' possel.log
+"""
+import argparse
+import collections
+import datetime
+import gzip
+import json
+import logging
+import os
+import re
+import sys
+
+import peewee as p
+
+import possel
+from possel import archive, linelog, linestore, model
+
+logger = logging.getLogger(__name__)
+
+
+class BufferNotEmptyError(possel.Error):
+    """ Raised when importing into a buffer that already has lines. """
+
+
+def _open(path, mode):
+    """ Open a file for text, transparently (de)compressing it if it ends in .gz and using stdio for '-'. """
+    if path == '-':
+        stdio = sys.stdout if 'w' in mode else sys.stdin
+        return open(stdio.fileno(), mode, encoding='utf-8', closefd=False)  # closing this leaves stdio open
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def _from_timestamp(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
+
+# =========================================================================
+# Export
+# =========================================================================
+def _select_buffers(servers, buffers):
+    """ Map the ids of the buffers we're exporting to (server "host:port", buffer name). """
+    query = (model.IRCBufferModel
+             .select(model.IRCBufferModel.id, model.IRCBufferModel.name,
+                     model.IRCServerModel.host, model.IRCServerModel.port)
+             .join(model.IRCServerModel, p.JOIN.LEFT_OUTER))
+    if servers:
+        query = query.where(model.IRCServerModel.host << servers)
+    if buffers:
+        query = query.where(model.IRCBufferModel.name << buffers)
+    return {buffer_id: ('{}:{}'.format(host, port) if host else None, name)
+            for buffer_id, name, host, port in query.tuples()}
+
+
+def export_lines(buffers, since=None, until=None, include_archive=True):
+    """ Stream lines for the given buffers as exportable dicts, buffer by buffer and oldest first.
+
+    Args:
+        buffers (dict): As returned by _select_buffers.
+        since (datetime): Only export lines from after this.
+        until (datetime): Only export lines from before this.
+    """
+    for buffer_id, (server, buffer_name) in buffers.items():
+        def row(line_id, timestamp, nick, kind, content):
+            return {'id': line_id,
+                    'timestamp': timestamp,
+                    'server': server,
+                    'buffer': buffer_name,
+                    'nick': nick,
+                    'kind': kind,
+                    'content': content,
+                    }
+
+        # Archived lines are all older than the ones still in the database, so they go first; one segment at a time
+        if include_archive:
+            segments = (archive.ArchiveSegmentModel
+                        .select()
+                        .where(archive.ArchiveSegmentModel.buffer == buffer_id)
+                        .order_by(archive.ArchiveSegmentModel.first_line))
+            for segment in segments:
+                for archived in archive.archiver._read_segment(segment):
+                    timestamp = _from_timestamp(archived['timestamp'])
+                    if (since is None or timestamp >= since) and (until is None or timestamp < until):
+                        yield row(archived['id'], archived['timestamp'], archived['nick'], archived['kind'],
+                                  archived['content'])
+
+        for line in model.line_store.iter_lines(buffer_id, since, until):
+            yield row(line['id'], line['timestamp'], line['nick'], line['kind'], line['content'])
+
+
+def export(args):
+    buffers = _select_buffers(args.server, args.buffer)
+    count = 0
+    with _open(args.output, 'w') as out:
+        for row in export_lines(buffers, args.since, args.until, include_archive=not args.no_archive):
+            out.write(json.dumps(row))
+            out.write('\n')
+            count += 1
+    logger.info('Exported %d lines from %d buffers', count, len(buffers))
+# =========================================================================
+
+
+# =========================================================================
+# Log parsers
+# -----------
+#
+# Each takes an iterable of lines from a log file and yields dicts with
+# "timestamp", "nick", "kind" and "content" in the same shape possel stores
+# them, skipping anything it doesn't understand.
+# =========================================================================
+def parse_jsonl(lines, **_):
+    for line in lines:
+        row = json.loads(line)
+        row['timestamp'] = _from_timestamp(row['timestamp'])
+        yield row
+
+
+_WEECHAT_LINE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\t([^\t]*)\t(.*)$')
+
+
+def parse_weechat(lines, **_):
+    for line in lines:
+        match = _WEECHAT_LINE.match(line.rstrip('\n'))
+        if match is None:
+            continue
+        timestamp, prefix, message = match.groups()
+        timestamp = datetime.datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+        nick, _, rest = message.partition(' ')
+
+        if prefix == '-->':
+            yield {'timestamp': timestamp, 'nick': nick, 'kind': 'join', 'content': 'has joined the channel'}
+        elif prefix == '<--':
+            if ' has quit' in rest:
+                reason = rest.rpartition(' (')[2].rstrip(')')
+                yield {'timestamp': timestamp, 'nick': nick, 'kind': 'quit', 'content': 'has quit ({})'.format(reason)}
+            else:
+                yield {'timestamp': timestamp, 'nick': nick, 'kind': 'part', 'content': 'has left the channel'}
+        elif prefix.strip() == '*':
+            yield {'timestamp': timestamp, 'nick': nick, 'kind': 'action', 'content': rest}
+        elif prefix == '--':
+            yield {'timestamp': timestamp, 'nick': model.SYSNICK, 'kind': 'other', 'content': message}
+        else:
+            yield {'timestamp': timestamp, 'nick': prefix.lstrip(model.NICK_PREFIXES), 'kind': 'message',
+                   'content': message}
+
+
+_IRSSI_OPENED = re.compile(r'^--- Log opened \w+ (\w+ \d+ [\d:]+ \d{4})')
+_IRSSI_DAY = re.compile(r'^--- Day changed \w+ (\w+ \d+ \d{4})')
+_IRSSI_LINE = re.compile(r'^(\d\d:\d\d(?::\d\d)?) (.*)$')
+_IRSSI_EVENT = re.compile(r'^-!- (\S+) (?:\[[^\]]*\] )?(has joined|has left|has quit|is now known as)(.*)$')
+
+
+def parse_irssi(lines, **_):
+    day = None
+    for line in lines:
+        line = line.rstrip('\n')
+        opened = _IRSSI_OPENED.match(line)
+        if opened:
+            day = datetime.datetime.strptime(opened.group(1), '%b %d %H:%M:%S %Y').date()
+            continue
+        changed = _IRSSI_DAY.match(line)
+        if changed:
+            day = datetime.datetime.strptime(changed.group(1), '%b %d %Y').date()
+            continue
+        match = _IRSSI_LINE.match(line)
+        if match is None or day is None:
+            continue
+
+        clock, message = match.groups()
+        clock = datetime.datetime.strptime(clock, '%H:%M:%S' if clock.count(':') == 2 else '%H:%M').time()
+        timestamp = datetime.datetime.combine(day, clock)
+
+        if message.startswith('<'):
+            nick, _, content = message[1:].partition('> ')
+            yield {'timestamp': timestamp, 'nick': nick.strip().lstrip(model.NICK_PREFIXES), 'kind': 'message',
+                   'content': content}
+        elif message.startswith(' * '):
+            nick, _, content = message[3:].partition(' ')
+            yield {'timestamp': timestamp, 'nick': nick, 'kind': 'action', 'content': content}
+        else:
+            event = _IRSSI_EVENT.match(message)
+            if event is None:
+                continue
+            nick, what, rest = event.groups()
+            if what == 'has joined':
+                yield {'timestamp': timestamp, 'nick': nick, 'kind': 'join', 'content': 'has joined the channel'}
+            elif what == 'has left':
+                yield {'timestamp': timestamp, 'nick': nick, 'kind': 'part', 'content': 'has left the channel'}
+            elif what == 'has quit':
+                reason = rest.strip().lstrip('[').rstrip(']')
+                yield {'timestamp': timestamp, 'nick': nick, 'kind': 'quit', 'content': 'has quit ({})'.format(reason)}
+            else:
+                yield {'timestamp': timestamp, 'nick': nick, 'kind': 'nick',
+                       'content': 'is now known as {}'.format(rest.strip())}
+
+
+_ZNC_LINE = re.compile(r'^\[(\d\d:\d\d:\d\d)\] (.*)$')
+_ZNC_EVENT = re.compile(r'^\*\*\* (Joins|Parts|Quits): (\S+)(?: \([^)]*\))?(?: \((.*)\))?$')
+_ZNC_NICK = re.compile(r'^\*\*\* (\S+) is now known as (\S+)$')
+_DATE_IN_FILENAME = re.compile(r'(\d{4})-?(\d\d)-?(\d\d)')
+
+
+def parse_znc(lines, date=None, filename=None, **_):
+    if date is None and filename is not None:
+        found = _DATE_IN_FILENAME.search(os.path.basename(filename))
+        if found:
+            date = datetime.date(*map(int, found.groups()))
+    if date is None:
+        raise ValueError('ZNC logs need a date, either in the filename or given with --date')
+
+    for line in lines:
+        match = _ZNC_LINE.match(line.rstrip('\n'))
+        if match is None:
+            continue
+        clock, message = match.groups()
+        timestamp = datetime.datetime.combine(date, datetime.datetime.strptime(clock, '%H:%M:%S').time())
+
+        if message.startswith('<'):
+            nick, _, content = message[1:].partition('> ')
+            yield {'timestamp': timestamp, 'nick': nick, 'kind': 'message', 'content': content}
+        elif message.startswith('-') and '- ' in message:
+            nick, _, content = message[1:].partition('- ')
+            yield {'timestamp': timestamp, 'nick': nick, 'kind': 'notice', 'content': content}
+        elif message.startswith('* '):
+            nick, _, content = message[2:].partition(' ')
+            yield {'timestamp': timestamp, 'nick': nick, 'kind': 'action', 'content': content}
+        elif _ZNC_NICK.match(message):
+            old_nick, new_nick = _ZNC_NICK.match(message).groups()
+            yield {'timestamp': timestamp, 'nick': old_nick, 'kind': 'nick',
+                   'content': 'is now known as {}'.format(new_nick)}
+        elif _ZNC_EVENT.match(message):
+            what, nick, reason = _ZNC_EVENT.match(message).groups()
+            if what == 'Joins':
+                yield {'timestamp': timestamp, 'nick': nick, 'kind': 'join', 'content': 'has joined the channel'}
+            elif what == 'Parts':
+                yield {'timestamp': timestamp, 'nick': nick, 'kind': 'part', 'content': 'has left the channel'}
+            else:
+                yield {'timestamp': timestamp, 'nick': nick, 'kind': 'quit',
+                       'content': 'has quit ({})'.format(reason or '')}
+
+
+PARSERS = {'jsonl': parse_jsonl,
+           'weechat': parse_weechat,
+           'irssi': parse_irssi,
+           'znc': parse_znc,
+           }
+# =========================================================================
+
+
+# =========================================================================
+# Import
+# =========================================================================
+class Resolver:
+    """ Finds (or makes) the ids of the servers, buffers and users imported lines belong to, remembering them so each
+    is only looked up once per import.
+    """
+    def __init__(self, nick):
+        self.nick = nick  # who we are on servers we have to create
+        self._servers = {}
+        self._buffers = {}
+        self._users = {}
+
+    def server(self, address):
+        if not address:  # buffers that aren't attached to a server
+            return None
+        server_id = self._servers.get(address)
+        if server_id is None:
+            host, _, port = address.partition(':')
+            port = int(port or 6697)
+            try:
+                server = model.IRCServerModel.get(host=host, port=port)
+            except p.DoesNotExist:
+                user = model.UserDetails.create(nick=self.nick, realname=self.nick, username=self.nick)
+                server = model.IRCServerModel.create(host=host, port=port, secure=port != 6667, user=user)
+            server_id = self._servers[address] = server.id
+        return server_id
+
+    def buffer(self, server_id, name):
+        """ Raises BufferNotEmptyError the first time it's asked for a buffer that already has lines. """
+        key = (server_id, name)
+        buffer_id = self._buffers.get(key)
+        if buffer_id is None:
+            buffer, _ = model._get_or_create(model.IRCBufferModel, {'current': False}, name=name, server=server_id)
+            if model.line_store.lines(buffer.id, last=1) or archive.archiver.has_lines(buffer.id):
+                raise BufferNotEmptyError('{} already has lines'.format(name))
+            buffer_id = self._buffers[key] = buffer.id
+        return buffer_id
+
+    def user(self, server_id, nick):
+        """ Any user that has had this nick on the server will do, they're only used to group a nick's lines. """
+        if nick is None or nick == model.SYSNICK:
+            return None
+        nick_key = model.server_nick_key(nick, server_id)
+        key = (server_id, nick_key)
+        user_id = self._users.get(key)
+        if user_id is None:
+            users = (model.IRCUserModel
+                     .select(model.IRCUserModel.id)
+                     .where(model.IRCUserModel.server == server_id, model.IRCUserModel.nick_key == nick_key)
+                     .order_by(-model.IRCUserModel.current)
+                     .limit(1)
+                     .tuples())
+            try:
+                user_id, = users[0]
+            except IndexError:
+                user_id = model.IRCUserModel.create(nick=nick, nick_key=nick_key, server=server_id, current=False).id
+            self._users[key] = user_id
+        return user_id
+
+
+def import_lines(rows, resolver, server=None, buffer=None, batch_size=10000, rows_per_insert=100):
+    """ Insert parsed log lines in large transactions, bypassing create_line and everything that hangs off it.
+
+    Args:
+        rows (iterable): Parsed lines, as yielded by one of the PARSERS.
+        server (str): "host:port" for rows that don't say which server they're from.
+        buffer (str): Name of the buffer for rows that don't say which buffer they're from.
+        batch_size (int): How many lines to insert per transaction.
+        rows_per_insert (int): How many lines to insert per statement, small enough to stay under SQLite's limit on
+            bound parameters.
+    """
+    total = 0
+    pending = []  # (server id, row)
+
+    def flush():
+        by_server = collections.defaultdict(list)
+        for server_id, line in pending:
+            by_server[server_id].append(line)
+        with model.database.atomic():
+            for server_id, server_rows in by_server.items():
+                model.line_store.insert_many(server_id, server_rows, rows_per_insert)
+        pending.clear()
+
+    for row in rows:
+        server_id = resolver.server(row.get('server') or server)
+        pending.append((server_id, {'buffer': resolver.buffer(server_id, row.get('buffer') or buffer),
+                                    'timestamp': row['timestamp'],
+                                    'user': resolver.user(server_id, row['nick']),
+                                    'nick': row['nick'],
+                                    'kind': row['kind'],
+                                    'content': row['content'],
+                                    }))
+        if len(pending) >= batch_size:
+            total += len(pending)
+            flush()
+            logger.info('Imported %d lines', total)
+
+    if pending:
+        total += len(pending)
+        flush()
+    return total
+
+
+def import_(args):
+    parser = PARSERS[args.format]
+    if args.format != 'jsonl' and not (args.server and args.buffer):
+        raise SystemExit('--server and --buffer are required when importing {} logs'.format(args.format))
+
+    resolver = Resolver(args.nick)
+    total = 0
+    for path in args.files:
+        with _open(path, 'r') as log_file:
+            rows = parser(log_file, date=args.date, filename=path)
+            try:
+                total += import_lines(rows, resolver,
+                                      server=args.server[0] if args.server else None,
+                                      buffer=args.buffer[0] if args.buffer else None,
+                                      batch_size=args.batch_size)
+            except BufferNotEmptyError as e:
+                raise SystemExit('Stopped importing {}: {}'.format(path, e))
+    logger.info('Imported %d lines in total', total)
+# =========================================================================
+
+
+def _date(string):
+    return datetime.datetime.strptime(string, '%Y-%m-%d')
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(description='Bulk export and import of scrollback')
+    parser.add_argument('-d', '--database', help='Peewee database selector', default='sqlite:///possel.db')
+    parser.add_argument('--archive-dir', default='possel-archive', help='Where archived lines are kept')
+    line_storage = parser.add_mutually_exclusive_group()
+    line_storage.add_argument('--line-shards', help='Directory of per-server line databases, if the server uses them')
+    line_storage.add_argument('--line-log', help='Directory of line logs, if the server uses them')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    export_parser = subparsers.add_parser('export', help='Write lines out as JSONL')
+    export_parser.set_defaults(function=export)
+    export_parser.add_argument('-s', '--server', action='append', default=[],
+                               help='Only export lines from this server (host), can be given more than once')
+    export_parser.add_argument('-b', '--buffer', action='append', default=[],
+                               help='Only export lines from this buffer (name), can be given more than once')
+    export_parser.add_argument('--since', type=_date, help='Only export lines from this date (YYYY-MM-DD) on')
+    export_parser.add_argument('--until', type=_date, help='Only export lines from before this date (YYYY-MM-DD)')
+    export_parser.add_argument('--no-archive', action='store_true', help="Don't export lines from the archive")
+    export_parser.add_argument('-o', '--output', default='-',
+                               help='Where to write to, compressed if it ends in .gz (default: stdout)')
+
+    import_parser = subparsers.add_parser('import', help='Read lines in from logs')
+    import_parser.set_defaults(function=import_)
+    import_parser.add_argument('-f', '--format', choices=sorted(PARSERS), default='jsonl',
+                               help='What wrote the logs')
+    import_parser.add_argument('-s', '--server', action='append',
+                               help='host[:port] of the server the logs are from, required for anything but jsonl')
+    import_parser.add_argument('-b', '--buffer', action='append',
+                               help='Name of the buffer the logs are from, required for anything but jsonl')
+    import_parser.add_argument('--date', type=lambda s: _date(s).date(),
+                               help='Date of the log (YYYY-MM-DD), for formats that only record times')
+    import_parser.add_argument('--nick', default='possel', help='Our nick on any servers that have to be created')
+    import_parser.add_argument('--batch-size', type=int, default=10000, help='Lines to insert per transaction')
+    import_parser.add_argument('files', nargs='+', help='Log files to import, decompressed if they end in .gz')
+    return parser
+
+
+def main():
+    from playhouse import db_url
+    args = get_arg_parser().parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db = db_url.connect(args.database)
+    model.database.initialize(db)
+    model.initialize()
+    if args.line_shards:
+        linestore.initialize(args.line_shards)
+    elif args.line_log:
+        linelog.initialize(args.line_log)
+    archive.initialize(args.archive_dir, None)
+
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
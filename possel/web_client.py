@@ -1,8 +1,138 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+"""
+possel.web_client
+-----------------
+
+Serves the web client's page. For someone who's logged in the page comes with the buffer list, the newest lines of the
+buffer they'll be looking at and its nicklist already rendered, plus a snapshot of the same state for main.js to pick up
+from, so it's usable on first paint instead of after half a dozen requests and a few thousand client-side renders.
+"""
+import datetime
+
 import tornado.web
 
+from possel import activity, assets, auth, model
+
+INITIAL_LINES = 300  # the same as main.js keeps rendered
+MAX_IDS = 500  # users looked up per query, keeps us under SQLite's limit on bound parameters
+ORANGE = '#C9952E'
+
+# Shown as "-*- nick content", like main.js does
+EVENT_KINDS = {'action', 'join', 'quit', 'part'}
+ROW_COLORS = {'notice': ORANGE, 'join': 'gray', 'part': 'gray', 'quit': 'gray'}
+
+
+def user_color(user_id):
+    """ The colour for a user's nick; main.js picks the same one. """
+    return 'hsl({}, 65%, 40%)'.format(user_id * 137 % 360)
+
+
+def display_line(line, tz_offset=0):
+    """ Work out how to show a line (as a dict), the same way main.js's ``line_row`` does.
+
+    Args:
+        tz_offset (int): Minutes behind UTC the browser is, as given by ``Date.getTimezoneOffset()``.
+    """
+    nick, content = line['nick'], line['content']
+    nick_color = user_color(line['user']) if line['user'] else ORANGE
+    row_color = ROW_COLORS.get(line['kind'])
+    if line['kind'] == 'action':
+        row_color = nick_color
+    if line['kind'] in EVENT_KINDS:
+        nick, content, nick_color = '-*-', '{} {}'.format(nick, content), ORANGE
+
+    timestamp = datetime.datetime.utcfromtimestamp(line['timestamp']) - datetime.timedelta(minutes=tz_offset)
+    return {'id': line['id'],
+            'kind': line['kind'],
+            'time': timestamp.strftime('%H:%M:%S'),
+            'nick': nick,
+            'nick_color': nick_color,
+            'content': content,
+            'row_color': row_color,
+            }
+
+
+def buffer_order(buffers):
+    """ Put buffers in the order the buffer list shows them: each server's system buffer followed by its channels and
+    queries.
+    """
+    by_server = {}
+    for buffer in buffers:
+        by_server.setdefault(buffer.server_id, []).append(buffer)
+    ordered = []
+    for server_id in sorted(by_server, key=lambda server_id: server_id or 0):
+        ordered.extend(sorted(by_server[server_id], key=lambda buffer: (buffer.kind != 'system', buffer.name.lower())))
+    return ordered
+
+
+def get_users(user_ids):
+    user_ids = sorted(user_ids)
+    users = []
+    for i in range(0, len(user_ids), MAX_IDS):
+        users.extend(model.IRCUserModel.select().where(model.IRCUserModel.id << user_ids[i:i + MAX_IDS]))
+    return users
+
+
+def initial_state(user, buffer_id=None):
+    """ Everything the client needs to show a buffer, by default the last one in the buffer list. """
+    buffers = buffer_order(model.IRCBufferModel.select())
+    state = {'buffers': [buffer.to_dict() for buffer in buffers],
+             'activity': activity.counters.get(user.id),
+             'active': None,
+             'lines': [],
+             'roster': None,
+             'users': [],
+             }
+    if not buffers:
+        return state
+
+    active = buffers[-1].id
+    if buffer_id is not None and any(buffer.id == buffer_id for buffer in buffers):
+        active = buffer_id
+    lines = model.line_store.lines(active, last=INITIAL_LINES)
+    lines.reverse()
+    version, members = model.rosters.get(active)
+
+    user_ids = set(members) | {line['user'] for line in lines if line['user']}
+    state.update(active=active,
+                 lines=lines,
+                 roster={'buffer': active, 'version': version, 'members': list(members.items())},
+                 users=[user.to_dict() for user in get_users(user_ids)],
+                 )
+    return state
+
+
+def nicklist(state):
+    """ The active buffer's members as (nick, prefix, colour), ops first. """
+    users = {user['id']: user for user in state['users']}
+    members = [(users[user_id]['nick'], modes[:1], user_color(user_id))
+               for user_id, modes in state['roster']['members'] if user_id in users]
+    members.sort(key=lambda member: (not member[1], member[0].lower()))
+    return members
+
 
 class WebUIServer(tornado.web.RequestHandler):
+    def get_current_user(self):
+        token = self.get_secure_cookie('token')
+        if token is None:
+            return None
+        return auth.get_user_by_token(token)
+
     def get(self):
-        self.render('client.html')
+        # The page names the current bundles and now carries the user's state, so always check it's fresh, and don't
+        # let anyone else cache it; the bundles are cached forever
+        self.set_header('Cache-Control', 'no-cache, private')
+
+        state, lines, members = None, [], []
+        if self.current_user:
+            buffer_id = self.get_argument('buffer', None)
+            state = initial_state(self.current_user, int(buffer_id) if buffer_id and buffer_id.isdigit() else None)
+            try:
+                tz_offset = int(self.get_cookie('tz_offset', 0))
+            except ValueError:
+                tz_offset = 0
+            lines = [display_line(line, tz_offset) for line in state['lines']]
+            if state['roster'] is not None:
+                members = nicklist(state)
+        self.render('client.html', bundles=assets.bundles, state=state, lines=lines, members=members)
@@ -41,7 +41,7 @@ setup(
     py_modules=[],
     zip_safe=False,
     install_requires=install_requires,
-    extras_require={},
+    extras_require={'assets': ['rjsmin', 'rcssmin']},
     scripts=['bin/possel'],
     package_data={},
 )
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+API latency benchmarks against a database seeded with realistic volumes.
+
+    # Record a baseline (seeding the "full" database takes a few minutes the first time, it's kept for next time)
+    python -m tests.benchmark --scale full --save baseline.json
+
+    # Later, fail if anything got more than 20% slower
+    python -m tests.benchmark --scale full --compare baseline.json --threshold 0.2
+
+    # Just the line stores, SQLite against the line log
+    python -m tests.benchmark StorageBenchmark
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from playhouse import db_url
+from tornado import httpclient, testing, websocket
+import tornado.web
+
+from possel import activity, application, archive, auth, highlights, linelog, model
+
+USERNAME = 'benchmark'
+PASSWORD = 'benchmark'
+
+SCALES = {  # servers, buffers, users, lines
+    'small': (3, 60, 3000, 50000),
+    'full': (10, 3000, 300000, 3000000),
+}
+
+MEMBERS_PER_BUFFER = 40
+LINE_KINDS = ['message'] * 85 + ['action'] * 3 + ['notice'] * 2 + ['join'] * 4 + ['part'] * 3 + ['quit'] * 3
+ROWS_PER_INSERT = 100  # keeps us under SQLite's limit on bound parameters
+ROWS_PER_TRANSACTION = 20000
+
+# Filled in by main()
+config = argparse.Namespace(scale='small', database=None, requests=200)
+results = {}
+
+
+# =========================================================================
+# Seeding
+# =========================================================================
+def _insert(model_class, rows):
+    for start in range(0, len(rows), ROWS_PER_INSERT):
+        model_class.insert_many(rows[start:start + ROWS_PER_INSERT]).execute()
+
+
+def _ids(model_class):
+    return [row_id for row_id, in model_class.select(model_class.id).order_by(model_class.id).tuples()]
+
+
+def seed(servers, buffers, users, lines):
+    """ Fill an empty database. Buffers get lines with a long tail (a few very busy channels, lots of quiet ones). """
+    rng = random.Random(0)
+    auth.create_user(USERNAME, PASSWORD)
+
+    with model.database.atomic():
+        for i in range(servers):
+            details = model.UserDetails.create(nick='possel', realname='Possel', username='possel')
+            model.IRCServerModel.create(host='irc{}.example.org'.format(i), port=6697, user=details)
+    server_ids = _ids(model.IRCServerModel)
+
+    with model.database.atomic():
+        _insert(model.IRCBufferModel, [{'name': '#channel{}'.format(i),
+                                        'server': server_ids[i % servers],
+                                        'current': True,
+                                        } for i in range(buffers)])
+    buffer_rows = list(model.IRCBufferModel.select(model.IRCBufferModel.id, model.IRCBufferModel.server).tuples())
+
+    for start in range(0, users, ROWS_PER_TRANSACTION):
+        with model.database.atomic():
+            _insert(model.IRCUserModel, [{'nick': 'user{}'.format(i),
+                                          'nick_key': model.nick_key('user{}'.format(i)),
+                                          'username': 'user{}'.format(i),
+                                          'host': 'host{}.example.com'.format(i),
+                                          'server': server_ids[i % servers],
+                                          'current': rng.random() < 0.3,
+                                          } for i in range(start, min(start + ROWS_PER_TRANSACTION, users))])
+    users_by_server = {}
+    for user_id, server_id, nick in model.IRCUserModel.select(model.IRCUserModel.id, model.IRCUserModel.server,
+                                                              model.IRCUserModel.nick).tuples():
+        users_by_server.setdefault(server_id, []).append((user_id, nick))
+
+    members = {}
+    with model.database.atomic():
+        rows = []
+        for buffer_id, server_id in buffer_rows:
+            members[buffer_id] = rng.sample(users_by_server[server_id], MEMBERS_PER_BUFFER)
+            rows.extend({'buffer': buffer_id, 'user': user_id} for user_id, _ in members[buffer_id])
+        _insert(model.IRCBufferMembershipRelation, rows)
+
+    # Weight buffers so the busiest get most of the lines
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(buffer_rows))))
+    start_time = datetime.datetime.utcnow() - datetime.timedelta(days=365)
+    step = datetime.timedelta(days=365) / lines
+    for start in range(0, lines, ROWS_PER_TRANSACTION):
+        rows = []
+        for i in range(start, min(start + ROWS_PER_TRANSACTION, lines)):
+            buffer_id, _ = rng.choices(buffer_rows, cum_weights=weights)[0]
+            user_id, nick = rng.choice(members[buffer_id])
+            rows.append({'buffer': buffer_id,
+                         'timestamp': start_time + step * i,
+                         'user': user_id,
+                         'nick': nick,
+                         'kind': rng.choice(LINE_KINDS),
+                         'content': 'line {} with some words in it for good measure'.format(i),
+                         })
+        with model.database.atomic():
+            _insert(model.IRCLineModel, rows)
+
+
+def open_database(scale, path=None):
+    """ Connect to the benchmark database for a scale, seeding it first if it doesn't exist yet. """
+    path = path or 'possel-benchmark-{}.db'.format(scale)
+    exists = os.path.exists(path)
+    seeding_path = path if exists else path + '.seeding'
+    if not exists and os.path.exists(seeding_path):
+        os.remove(seeding_path)  # left over from an interrupted run
+
+    db = db_url.connect('sqlite:///{}'.format(seeding_path))
+    model.database.initialize(db)
+    model.initialize()
+    auth.create_tables()
+    activity.initialize()
+    archive.initialize('possel-benchmark-archive', None)
+    highlights.initialize({}, ())
+
+    if not exists:
+        start = time.monotonic()
+        print('Seeding {} ({} servers, {} buffers, {} users, {} lines)...'.format(path, *SCALES[scale]),
+              file=sys.stderr)
+        seed(*SCALES[scale])
+        print('Seeded in {:.0f}s'.format(time.monotonic() - start), file=sys.stderr)
+        db.close()
+        os.replace(seeding_path, path)
+        db = db_url.connect('sqlite:///{}'.format(path))
+        model.database.initialize(db)
+# =========================================================================
+
+
+# =========================================================================
+# Benchmarks
+# =========================================================================
+def summarise(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {'requests': len(latencies),
+            'throughput': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+            'p99_ms': round(latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000, 2),
+            }
+
+
+class APIBenchmark(testing.AsyncHTTPTestCase):
+    @classmethod
+    def setUpClass(cls):
+        open_database(config.scale, config.database)
+        line = model.IRCLineModel
+        cls.last_line = line.select(line.id).order_by(-line.id).limit(1).tuples()[0][0]
+        buffer_ids = _ids(model.IRCBufferModel)
+        cls.busy_buffer, cls.quiet_buffer = buffer_ids[0], buffer_ids[-1]  # see the weights in seed()
+
+    def get_app(self):
+        return tornado.web.Application(application.get_routes({}), **application.settings)
+
+    def setUp(self):
+        super(APIBenchmark, self).setUp()
+        response = self.fetch('/session', method='POST', body=json.dumps({'username': USERNAME, 'password': PASSWORD}),
+                              headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.code, 200)
+        self.cookie = response.headers['Set-Cookie'].split(';')[0]
+
+    def measure(self, name, path, requests=None, **kwargs):
+        requests = requests or config.requests
+        kwargs.setdefault('headers', {})['Cookie'] = self.cookie
+        latencies = []
+        start = time.monotonic()
+        for _ in range(requests):
+            request_start = time.monotonic()
+            response = self.fetch(path, **kwargs)
+            latencies.append(time.monotonic() - request_start)
+            self.assertEqual(response.code, 200, '{} returned {}'.format(path, response.code))
+        results[name] = summarise(latencies, time.monotonic() - start)
+
+    def test_session(self):
+        self.measure('GET /session', '/session')
+        # Logging in is deliberately slow (PBKDF2), so don't do it as often
+        self.measure('POST /session', '/session', requests=max(config.requests // 20, 5), method='POST',
+                     body=json.dumps({'username': USERNAME, 'password': PASSWORD}),
+                     headers={'Content-Type': 'application/json'})
+
+    def test_lines(self):
+        last = self.last_line
+        self.measure('GET /line?id', '/line?id={}'.format(last - 100))
+        self.measure('GET /line?ids', '/line?ids={}'.format(','.join(str(last - i * 7) for i in range(100))))
+
+        filters = {'buffer': str(self.busy_buffer),
+                   'before': str(last - 1000),
+                   'after': str(last - 5000),
+                   'last': '50',
+                   'kind': 'message',
+                   }
+        for size in range(1, len(filters) + 1):
+            for names in itertools.combinations(sorted(filters), size):
+                if 'after' not in names and 'last' not in names:
+                    continue  # without either we'd be fetching hundreds of thousands of lines a request
+                query = '&'.join('{}={}'.format(name, filters[name]) for name in names)
+                self.measure('GET /line?{}'.format('&'.join(names)), '/line?{}'.format(query))
+
+        self.measure('GET /line?buffer&last (quiet buffer)', '/line?buffer={}&last=50'.format(self.quiet_buffer))
+
+    def test_users(self):
+        self.measure('GET /user/all', '/user/all', requests=max(config.requests // 20, 5))
+        self.measure('GET /user?buffer', '/user?buffer={}'.format(self.busy_buffer))
+
+    def test_buffers(self):
+        self.measure('GET /buffer/all', '/buffer/all')
+
+    def test_push_connect(self):
+        url = 'ws://localhost:{}/push'.format(self.get_http_port())
+        latencies = []
+        start = time.monotonic()
+        for _ in range(config.requests):
+            request_start = time.monotonic()
+            request = httpclient.HTTPRequest(url, headers={'Cookie': self.cookie})
+            connection = self.io_loop.run_sync(lambda: websocket.websocket_connect(request))
+            self.io_loop.run_sync(connection.read_message)  # the last_line message, sent once we're set up
+            latencies.append(time.monotonic() - request_start)
+            connection.close()
+        results['WS /push connect'] = summarise(latencies, time.monotonic() - start)
+
+
+class StorageBenchmark(unittest.TestCase):
+    """ Ingest and range reads straight against each line store, with nothing else in the way.
+
+    Lines are created one at a time as they would be from IRC, so this is the SQLite table committing every line
+    against the line log syncing every so often.
+    """
+    stores = {'sqlite': lambda directory: model.LineStore(),
+              'line log': lambda directory: linelog.LogLineStore(directory),
+              }
+    buffers = 20
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='possel-benchmark-')
+        model.database.initialize(db_url.connect('sqlite:///{}'.format(os.path.join(cls.directory, 'possel.db'))))
+        model.initialize()
+        details = model.UserDetails.create(nick='possel', realname='Possel', username='possel')
+        server = model.IRCServerModel.create(host='irc.example.org', port=6697, user=details)
+        cls.buffer_ids = [model.IRCBufferModel.create(name='#channel{}'.format(i), server=server, current=True).id
+                          for i in range(cls.buffers)]
+        cls.server_id = server.id
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_storage(self):
+        rng = random.Random(0)
+        lines = config.requests * 25
+        for name, make_store in sorted(self.stores.items()):
+            store = make_store(os.path.join(self.directory, name.replace(' ', '-')))
+
+            latencies = []
+            start = time.monotonic()
+            for i in range(lines):
+                request_start = time.monotonic()
+                store.create(self.server_id, buffer=rng.choice(self.buffer_ids), nick='user{}'.format(i % 50),
+                             kind=rng.choice(LINE_KINDS), content='line {} with some words in it'.format(i))
+                latencies.append(time.monotonic() - request_start)
+            store.flush()
+            results['ingest ({})'.format(name)] = summarise(latencies, time.monotonic() - start)
+
+            last = store.last_id()
+            reads = {'last 50': lambda after: {'last': 50},
+                     'last 50 before': lambda after: {'before': after, 'last': 50},
+                     'after..before': lambda after: {'after': after, 'before': after + 2000},
+                     'kind after..before': lambda after: {'after': after, 'before': after + 2000, 'kind': 'message'},
+                     }
+            for read_name, make_filters in sorted(reads.items()):
+                latencies = []
+                start = time.monotonic()
+                for _ in range(config.requests):
+                    filters = make_filters(rng.randrange(1, max(last - 2000, 2)))
+                    request_start = time.monotonic()
+                    store.lines(rng.choice(self.buffer_ids), **filters)
+                    latencies.append(time.monotonic() - request_start)
+                results['read {} ({})'.format(read_name, name)] = summarise(latencies, time.monotonic() - start)
+# =========================================================================
+
+
+# =========================================================================
+# Baselines
+# =========================================================================
+def compare(baseline, current, threshold):
+    """ Find benchmarks that got slower (p99) or handle less (throughput) by more than ``threshold``, as a fraction. """
+    regressions = []
+    for name, result in sorted(current.items()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result['p99_ms'] > before['p99_ms'] * (1 + threshold):
+            regressions.append('{}: p99 {}ms -> {}ms'.format(name, before['p99_ms'], result['p99_ms']))
+        if result['throughput'] < before['throughput'] * (1 - threshold):
+            regressions.append('{}: throughput {}/s -> {}/s'.format(name, before['throughput'], result['throughput']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Possel API benchmarks')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small', help='How much data to seed')
+    parser.add_argument('--database', help='Where to keep the seeded database (default possel-benchmark-SCALE.db)')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per benchmark')
+    parser.add_argument('--save', metavar='FILE', help='Write the results to FILE as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='Compare the results to the baseline in FILE')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='How much worse than the baseline counts as a regression, as a fraction')
+    parser.add_argument('tests', nargs='*', help='Only run these benchmarks (e.g. APIBenchmark.test_lines)')
+    args = parser.parse_args()
+    config.scale, config.database, config.requests = args.scale, args.database, args.requests
+
+    loader = unittest.TestLoader()
+    if args.tests:
+        suite = loader.loadTestsFromNames(args.tests, sys.modules[__name__])
+    else:
+        suite = unittest.TestSuite([loader.loadTestsFromTestCase(APIBenchmark),
+                                    loader.loadTestsFromTestCase(StorageBenchmark)])
+    outcome = unittest.TextTestRunner(verbosity=2).run(suite)
+
+    print('\n{:<45} {:>10} {:>10} {:>10}'.format('benchmark', 'req/s', 'p50 ms', 'p99 ms'))
+    for name, result in sorted(results.items()):
+        print('{:<45} {throughput:>10} {p50_ms:>10} {p99_ms:>10}'.format(name, **result))
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump({'scale': args.scale, 'results': results}, baseline_file, indent=2, sort_keys=True)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['scale'] != args.scale:
+            print('Warning: baseline was recorded at scale {}'.format(baseline['scale']), file=sys.stderr)
+        regressions = compare(baseline['results'], results, args.threshold)
+        for regression in regressions:
+            print('REGRESSION', regression)
+
+    sys.exit(0 if outcome.wasSuccessful() and not regressions else 1)
+
+
+if __name__ == '__main__':
+    main()
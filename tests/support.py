@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Shared setup for the tests: a fresh database and empty caches for each test, as if possel had just started.
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import peewee as p
+from tornado import testing
+import tornado.web
+
+from possel import activity, application, archive, auth, cache, highlights, longpoll, model, monitor
+
+USERNAME = 'test'
+PASSWORD = 'test'
+
+
+class FakeServerHandler:
+    """ Stands in for pircel's protocol handler, keeping the callbacks an interface attaches so tests can fire them. """
+    def __init__(self, identity):
+        self.callbacks = {}
+        self.identity = identity
+
+    def add_callback(self, signal, callback):
+        self.callbacks.setdefault(signal, []).append(callback)
+
+    def event(self, signal, prefix, *args):
+        for callback in self.callbacks.get(signal, ()):
+            callback(self, prefix=prefix, args=list(args))
+
+
+def use_database(directory):
+    """ Point possel at a new SQLite database in ``directory`` and forget everything cached from the last one. """
+    db = p.SqliteDatabase(os.path.join(directory, 'possel.db'))
+    model.database.initialize(db)
+    monitor.monitor.watch_database(db)
+
+    model.line_store = model.LineStore()
+    model.recent_lines = cache.RecentLines(model._load_recent_lines)
+    model.rosters = cache.Rosters(model._load_roster)
+    model._casemappings.clear()
+    activity.counters._users.clear()
+    longpoll.feed.lines.clear()
+    longpoll.feed.configure(longpoll.feed.lines.maxlen, 0)
+
+    model.initialize()
+    auth.create_tables()
+    activity.initialize()
+    highlights.initialize({}, ())
+    archive.initialize(os.path.join(directory, 'archive'), None)
+    return db
+
+
+def create_server(host='irc.example.org', nick='possel'):
+    """ Make a server and an interface for it attached to a FakeServerHandler. """
+    server = model.create_server(host=host, port=6697, secure=True, nick=nick, realname='Possel', username='possel')
+    interface = model.IRCServerInterface(server)
+    interface.server_handler = FakeServerHandler(interface.identity)
+    return interface
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        super(DatabaseTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp(prefix='possel-test-')
+        self.db = use_database(self.directory)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+        super(DatabaseTestCase, self).tearDown()
+
+
+class APITestCase(testing.AsyncHTTPTestCase):
+    """ Runs the API against a fresh database, logged in as USERNAME. """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='possel-test-')
+        self.db = use_database(self.directory)
+        self.interfaces = {}
+        super(APITestCase, self).setUp()
+        auth.create_user(USERNAME, PASSWORD)
+        response = self.fetch('/session', method='POST', body=json.dumps({'username': USERNAME, 'password': PASSWORD}),
+                              headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.code, 200)
+        self.cookie = response.headers['Set-Cookie'].split(';')[0]
+
+    def tearDown(self):
+        super(APITestCase, self).tearDown()
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def get_app(self):
+        return tornado.web.Application(application.get_routes(self.interfaces), **application.settings)
+
+    def get(self, path):
+        response = self.fetch(path, headers={'Cookie': self.cookie})
+        return response.code, json.loads(response.body.decode()) if response.code == 200 else None
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from possel import activity, auth, model
+from . import support
+
+
+class CountersTest(support.DatabaseTestCase):
+    def setUp(self):
+        super(CountersTest, self).setUp()
+        interface = support.create_server()
+        self.handler = interface.server_handler
+        self.handler.event('join', 'possel!possel@host', '#read')
+        self.handler.event('join', 'possel!possel@host', '#unread')
+        for i in range(3):
+            self.handler.event('privmsg', 'alice!alice@host', '#read', 'read {}'.format(i))
+            self.handler.event('privmsg', 'alice!alice@host', '#unread', 'unread {}'.format(i))
+        self.marked = model.IRCBufferModel.get(name='#read').id
+        self.unmarked = model.IRCBufferModel.get(name='#unread').id
+
+        auth.create_user(support.USERNAME, support.PASSWORD)
+        self.user_id = auth.UserModel.get(username=support.USERNAME).id
+        second_line = model.line_store.lines(self.marked)[-2]['id']
+        activity.ReadMarkerModel.create(user=self.user_id, buffer=self.marked, line=second_line)
+
+    def unread_counts(self):
+        return {buffer_id: counts['unread'] for buffer_id, counts in activity.counters.get(self.user_id).items()}
+
+    def test_load(self):
+        self.assertEqual(self.unread_counts(), {self.marked: 1, self.unmarked: 3})
+
+    def test_new_lines(self):
+        self.unread_counts()
+        changes = []
+
+        def changed(_, user_id, buffer_id, line_id, activity):
+            changes.append((buffer_id, activity.unread))
+        activity.signal_factory(activity.UNREAD_CHANGED).connect(changed)
+        try:
+            self.handler.event('privmsg', 'alice!alice@host', '#read', 'more')
+            self.handler.event('join', 'bob!bob@host', '#read')  # doesn't count
+        finally:
+            activity.signal_factory(activity.UNREAD_CHANGED).disconnect(changed)
+        self.assertEqual(changes, [(self.marked, 2)])
+
+    def test_totals_follow_new_lines(self):
+        self.handler.event('privmsg', 'alice!alice@host', '#unread', 'more')
+        self.assertEqual(self.unread_counts(), {self.marked: 1, self.unmarked: 4})
+
+    def test_totals_counted_when_first_needed(self):
+        self.unread_counts()
+        auth.create_user('other', support.PASSWORD)
+        other_id = auth.UserModel.get(username='other').id
+        activity.ReadMarkerModel.create(user=other_id, buffer=self.unmarked, line=model.line_store.last_id())
+        self.handler.event('privmsg', 'alice!alice@host', '#read', 'more')
+
+        counts = activity.counters.get(other_id)
+        self.assertEqual({buffer_id: buffer['unread'] for buffer_id, buffer in counts.items()},
+                         {self.marked: 4, self.unmarked: 0})
+
+    def test_mark_read(self):
+        self.unread_counts()
+        last = model.line_store.last_id()
+        self.assertEqual(activity.counters.mark_read(self.user_id, self.unmarked, last).unread, 0)
+        self.assertEqual(self.unread_counts()[self.unmarked], 0)
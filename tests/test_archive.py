@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import datetime
+import os
+from unittest import mock
+
+from possel import archive, model, resources
+from . import support
+
+
+class ArchiveTest(support.APITestCase):
+    def setUp(self):
+        super(ArchiveTest, self).setUp()
+        server = support.create_server().server_model
+        self.buffer = model.ensure_buffer('#possel', server)
+        for i in range(10):
+            model.create_line(buffer=self.buffer, server=server, nick='alice', kind='message', content=str(i))
+        # The first six are from last year
+        last_year = datetime.datetime.utcnow() - datetime.timedelta(days=365)
+        model.IRCLineModel.update(timestamp=last_year).where(model.IRCLineModel.id <= 6).execute()
+        archive.set_retention(self.buffer.id, 30)
+        archive.archiver.batch_size = 4
+
+    def contents(self, lines):
+        return [line['content'] for line in lines]
+
+    def test_run(self):
+        self.assertEqual(self.io_loop.run_sync(archive.archiver.run), 2)
+        self.assertEqual(self.contents(model.line_store.lines(self.buffer.id)), ['6', '7', '8', '9'])
+        segments = archive.ArchiveSegmentModel.select().order_by(archive.ArchiveSegmentModel.first_line)
+        self.assertEqual([(segment.first_line, segment.last_line) for segment in segments], [(1, 4), (5, 6)])
+        for segment in segments:
+            self.assertTrue(os.path.exists(os.path.join(archive.archiver.directory, segment.path)))
+
+        self.assertEqual(self.io_loop.run_sync(archive.archiver.run), 0)  # nothing left to do
+
+    def test_read_through(self):
+        self.io_loop.run_sync(archive.archiver.run)
+        code, lines = self.get('/line?buffer={}&last=7'.format(self.buffer.id))
+        self.assertEqual(self.contents(lines), ['9', '8', '7', '6', '5', '4', '3'])
+        code, lines = self.get('/line?buffer={}&after=2&before=7'.format(self.buffer.id))
+        self.assertEqual(self.contents(lines), ['1', '2', '3', '4', '5', '6'])
+
+    def test_ranges_are_capped(self):
+        self.io_loop.run_sync(archive.archiver.run)
+        with mock.patch.object(resources, 'MAX_RANGE_LINES', 3):
+            code, lines = self.get('/line?buffer={}'.format(self.buffer.id))
+            self.assertEqual(self.contents(lines), ['0', '1', '2'])
+            code, lines = self.get('/line?buffer={}&after={}'.format(self.buffer.id, lines[-1]['id'] + 1))
+            self.assertEqual(self.contents(lines), ['3', '4', '5'])
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from possel import auth
+from . import support
+
+
+class CleanupTokensTest(support.DatabaseTestCase):
+    def test_cleanup_tokens(self):
+        auth.create_user(support.USERNAME, support.PASSWORD)
+        user = auth.UserModel.get(username=support.USERNAME)
+        tokens = [auth.get_new_token(user) for _ in range(5)]
+        yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        auth.TokenModel.update(expiry_date=yesterday).where(auth.TokenModel.token != tokens[0]).execute()
+
+        self.assertEqual(auth.cleanup_tokens(batch_size=2), 4)
+        self.assertEqual([token.token for token in auth.TokenModel.select()], [tokens[0].decode()])
+        self.assertEqual(auth.cleanup_tokens(batch_size=2), 0)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from possel import cache
+
+
+def line(line_id, buffer_id=1, content='hello'):
+    return {'id': line_id, 'buffer': buffer_id, 'content': content, 'nick': 'alice'}
+
+
+class RecentLinesTest(unittest.TestCase):
+    def setUp(self):
+        self.stored = {1: [line(i) for i in range(1, 11)], 2: [line(i, 2) for i in range(11, 14)]}
+        self.loads = []
+        self.cache = cache.RecentLines(self.load, depth=5)
+
+    def load(self, buffer_id, count):
+        self.loads.append(buffer_id)
+        if buffer_id not in self.stored:
+            return None
+        return list(reversed(self.stored[buffer_id]))[:count]
+
+    def ids(self, lines):
+        return [line['id'] for line in lines]
+
+    def test_warms_once(self):
+        self.assertEqual(self.ids(self.cache.get(1, 3)), [10, 9, 8])
+        self.assertEqual(self.ids(self.cache.get(1, 5)), [10, 9, 8, 7, 6])
+        self.assertEqual(self.loads, [1])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_deeper_than_cached(self):
+        self.assertIsNone(self.cache.get(1, 6))
+        self.cache.get(1, 1)
+        self.assertIsNone(self.cache.get(1, 6))
+
+    def test_complete_buffer_serves_any_count(self):
+        self.cache.get(2, 1)
+        self.assertEqual(self.ids(self.cache.get(2, 5)), [13, 12, 11])
+
+    def test_add(self):
+        self.cache.add(line(20, 3))  # cold, ignored
+        self.assertEqual(self.cache.stats()['buffers'], 0)
+
+        self.cache.get(2, 1)
+        for line_id in range(14, 17):
+            self.cache.add(line(line_id, 2))
+        self.assertEqual(self.ids(self.cache.get(2, 5)), [16, 15, 14, 13, 12])
+        # Dropped a line, so it no longer knows it has all of them
+        self.assertIsNone(self.cache.get(2, 6))
+
+    def test_evicts_least_recently_used(self):
+        line_bytes = cache.LINE_OVERHEAD_BYTES + len('hello') + len('alice')
+        self.cache.configure(5, 2 * (cache.RING_OVERHEAD_BYTES + 5 * line_bytes))
+        self.cache.get(1, 1)
+        self.cache.get(2, 1)
+        self.cache.get(1, 1)
+        self.stored[3] = [line(i, 3) for i in range(20, 25)]
+        self.cache.get(3, 1)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(list(self.cache._buffers), [1, 3])
+
+    def test_unknown_buffer_not_cached(self):
+        self.assertIsNone(self.cache.get(3, 1))
+        self.assertEqual(self.cache.stats()['buffers'], 0)
+        self.stored[3] = []
+        self.assertEqual(self.cache.get(3, 1), [])
+        self.assertEqual(self.cache.stats()['bytes'], cache.RING_OVERHEAD_BYTES)
+
+
+class RostersTest(unittest.TestCase):
+    def setUp(self):
+        self.members = {1: [10, 11]}
+        self.rosters = cache.Rosters(lambda buffer_id: self.members.get(buffer_id), history=2)
+
+    def test_get_warms(self):
+        version, members = self.rosters.get(1)
+        self.assertEqual(members, {10: '', 11: ''})
+        self.assertEqual(self.rosters.get(1)[0], version)
+
+    def test_changes_before_warming_are_ignored(self):
+        self.rosters.add(1, 12)
+        self.rosters.remove(1, 10)
+        self.assertEqual(self.rosters.get(1)[1], {10: '', 11: ''})
+
+    def test_changes_since(self):
+        version, _ = self.rosters.get(1)
+        self.rosters.update(1, 10, '@')
+        self.rosters.remove(1, 11)
+        latest, changes = self.rosters.changes_since(1, version)
+        self.assertEqual(changes, [(10, '@'), (11, None)])
+        self.assertEqual(self.rosters.changes_since(1, latest), (latest, []))
+
+    def test_changes_since_forgotten_version(self):
+        version, _ = self.rosters.get(1)
+        for user_id in (12, 13, 14):
+            self.rosters.add(1, user_id)
+        latest, changes = self.rosters.changes_since(1, version)
+        self.assertIsNone(changes)
+        self.assertEqual(self.rosters.changes_since(1, 0), (latest, None))
+
+    def test_unchanged_update_keeps_version(self):
+        self.rosters.update(1, 10, '@')
+        version, _ = self.rosters.get(1)
+        self.rosters.update(1, 10, '@')
+        self.rosters.add(1, 10)
+        self.assertEqual(self.rosters.get(1)[0], version)
+
+    def test_unknown_buffer(self):
+        self.assertIsNone(self.rosters.get(2))
+        self.assertIsNone(self.rosters.changes_since(2, 0))
+        self.assertEqual(self.rosters.stats()['buffers'], 0)
+
+    def test_change_modes(self):
+        self.rosters.change_modes(1, 10, added='@')  # cold, ignored
+        self.rosters.update(1, 10, '+')
+        self.rosters.change_modes(1, 10, added='@', order='@+')
+        self.assertEqual(self.rosters.get(1)[1][10], '@+')
+        self.rosters.change_modes(1, 10, removed='+', order='@+')
+        self.rosters.change_modes(1, 12, added='@', order='@+')  # not a member
+        self.assertEqual(self.rosters.get(1)[1], {10: '@', 11: ''})
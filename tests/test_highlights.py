@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from possel import highlights, model
+from . import support
+
+
+class MentionsTest(support.APITestCase):
+    def setUp(self):
+        super(MentionsTest, self).setUp()
+        interface = support.create_server()
+        self.interfaces[interface.server_model.id] = interface
+        highlights.initialize(self.interfaces, ['possel-dev'])
+        handler = interface.server_handler
+        handler.event('join', 'possel!possel@host', '#possel')
+        for content in ('hi possel', 'nothing to see', 'ping possel-dev', 'possel: again'):
+            handler.event('privmsg', 'alice!alice@host', '#possel', content)
+
+    def contents(self, lines):
+        return [line['content'] for line in lines]
+
+    def test_newest_first_and_paged(self):
+        code, lines = self.get('/mentions')
+        self.assertEqual(self.contents(lines), ['possel: again', 'ping possel-dev', 'hi possel'])
+
+        code, lines = self.get('/mentions?limit=2')
+        self.assertEqual(self.contents(lines), ['possel: again', 'ping possel-dev'])
+        code, lines = self.get('/mentions?before={}'.format(lines[-1]['id']))
+        self.assertEqual(self.contents(lines), ['hi possel'])
+
+    def test_outlive_their_lines(self):
+        model.database.execute_sql('PRAGMA foreign_keys = ON')  # so a foreign key would take them with the line
+        model.IRCLineModel.delete().where(model.IRCLineModel.content == 'hi possel').execute()
+        self.assertEqual(highlights.MentionModel.select().count(), 3)
+
+    def test_paged_by_index(self):
+        for server in (None, 1):
+            query = highlights.MentionModel.select().order_by(-highlights.MentionModel.line).limit(2)
+            if server is not None:
+                query = query.where(highlights.MentionModel.server == server)
+            sql, params = query.sql()
+            plan = ' '.join(str(row) for row in model.database.execute_sql('EXPLAIN QUERY PLAN ' + sql, params))
+            self.assertIn('USING', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_old_indexes_replaced(self):
+        model.database.execute_sql('DROP INDEX mentionmodel_server_id_line_id')
+        model.database.execute_sql('DROP INDEX mentionmodel_line_id')
+        model.database.create_index(highlights.MentionModel,
+                                    [highlights.MentionModel.server, highlights.MentionModel.timestamp])
+        highlights.initialize(self.interfaces)
+        indexes = {tuple(index.columns) for index in model.database.get_indexes('mentionmodel')}
+        self.assertEqual(indexes, {('buffer_id',), ('server_id',), ('line_id',), ('server_id', 'line_id'),
+                                   ('buffer_id', 'line_id')})
+
+    def test_bad_arguments(self):
+        for query in ('before=x', 'server=x', 'limit=x'):
+            self.assertEqual(self.get('/mentions?{}'.format(query))[0], 400)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from possel import archive, linelog, maintenance, model
+from . import support
+
+
+def record(line_id):
+    return linelog._encode({'id': line_id, 'buffer': 1, 'kind': 'message', 'content': str(line_id)})
+
+
+class LogLineStoreTest(support.DatabaseTestCase):
+    def setUp(self):
+        super(LogLineStoreTest, self).setUp()
+        self.log_directory = os.path.join(self.directory, 'lines')
+        self.store = model.line_store = linelog.LogLineStore(self.log_directory, sync_lines=3)
+        server = support.create_server().server_model
+        self.buffer = model.ensure_buffer('#possel', server)
+        self.server = server
+
+    def tearDown(self):
+        self.store.executor.shutdown()
+        super(LogLineStoreTest, self).tearDown()
+
+    def add_lines(self, count):
+        for i in range(count):
+            model.create_line(buffer=self.buffer, server=self.server, nick='alice', kind='message', content=str(i))
+
+    def test_sync_in_background(self):
+        self.add_lines(2)
+        self.assertIsNone(self.store._syncing)
+        self.add_lines(1)  # that's sync_lines
+        syncing = self.store._syncing
+        self.assertIsNotNone(syncing)
+        syncing.result()
+        self.assertFalse(any(segment.dirty for segment in self.store._logs[self.buffer.id].segments))
+
+        self.add_lines(1)
+        self.store.sync()
+        self.assertIsNone(self.store._syncing)
+        self.assertFalse(self.store._dirty)
+        self.assertFalse(any(segment.dirty for segment in self.store._logs[self.buffer.id].segments))
+
+    def test_first(self):
+        self.add_lines(4)
+        self.assertEqual([line['content'] for line in self.store.lines(self.buffer.id, first=2)], ['0', '1'])
+        self.assertEqual([line['content'] for line in self.store.lines(after=3, first=5)], ['2', '3'])
+
+    def test_not_queryable(self):
+        self.add_lines(2)
+        self.assertFalse(self.store.queryable)
+        self.assertEqual(self.store.readable(), [])
+        self.assertTrue(maintenance.compact_users().result()['skipped'])
+        archive.set_retention(self.buffer.id, 0)
+        self.assertEqual(archive.archiver.run().result(), 0)
+
+
+class RecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='possel-test-')
+        self.addCleanup(shutil.rmtree, self.root)
+        self.directory = os.path.join(self.root, '1')
+        self.data_path = os.path.join(self.directory, '{:020d}.log'.format(1))
+
+    def write(self, *line_ids):
+        log = linelog.BufferLog(self.directory)
+        for line_id in line_ids:
+            log.append(line_id, 0, record(line_id))
+        log.segments[-1].seal()
+
+    def reopen(self):
+        log = linelog.BufferLog(self.directory)
+        ids = [line['id'] for line in log.select()]
+        log.segments[-1].seal()
+        return log.recovered, ids
+
+    def test_clean(self):
+        self.write(1, 2, 3)
+        self.assertEqual(self.reopen(), (0, [1, 2, 3]))
+        self.assertEqual(linelog.verify(self.root), [])
+
+    def test_indexed_data_lost(self):
+        self.write(1, 2, 3)
+        os.truncate(self.data_path, 2 * len(record(1)))
+        self.assertEqual(self.reopen(), (1, [1, 2]))
+        self.assertEqual(self.reopen(), (0, [1, 2]))
+
+    def test_half_written_record(self):
+        self.write(1, 2)
+        size = os.path.getsize(self.data_path)
+        with open(self.data_path, 'ab') as data_file:
+            data_file.write(record(3)[:-5])
+        self.assertEqual(self.reopen(), (0, [1, 2]))
+        self.assertEqual(os.path.getsize(self.data_path), size)
+
+    def test_unindexed_records(self):
+        self.write(1, 2)
+        with open(self.data_path, 'ab') as data_file:
+            data_file.write(record(3) + record(4))
+        self.assertEqual(self.reopen(), (2, [1, 2, 3, 4]))
+
+    def test_rebuild(self):
+        self.write(1, 2, 3)
+        os.remove(os.path.join(self.directory, '{:020d}.idx'.format(1)))
+        self.assertEqual(len(linelog.verify(self.root)), 1)
+        self.assertEqual(linelog.rebuild(self.root), [])
+        self.assertEqual(linelog.verify(self.root), [])
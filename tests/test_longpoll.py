@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import types
+import unittest
+
+from possel import longpoll
+
+
+def line(line_id, buffer_id=1):
+    return types.SimpleNamespace(to_dict=lambda: {'id': line_id, 'buffer': buffer_id})
+
+
+class LineFeedTest(unittest.TestCase):
+    def setUp(self):
+        self.feed = longpoll.LineFeed(size=3)
+        self.feed.configure(3, 10)
+
+    def add(self, *line_ids, buffer_id=1):
+        for line_id in line_ids:
+            self.feed.on_new_line(None, line(line_id, buffer_id), None)
+
+    def ids(self, lines):
+        return [line['id'] for line in lines]
+
+    def test_since(self):
+        self.assertEqual(self.feed.since(10), [])
+        self.add(11, 12)
+        self.add(13, buffer_id=2)
+        self.assertEqual(self.ids(self.feed.since(10)), [11, 12, 13])
+        self.assertEqual(self.ids(self.feed.since(11, buffer_id=1)), [12])
+        self.assertEqual(self.ids(self.feed.since(10, limit=2)), [11, 12])
+
+    def test_too_far_behind(self):
+        self.assertIsNone(self.feed.since(9))
+        self.add(11, 12, 13, 14)
+        self.assertIsNone(self.feed.since(10))
+        self.assertEqual(self.ids(self.feed.since(11)), [12, 13, 14])
+
+    def test_wait(self):
+        anything, other, ours = self.feed.wait(), self.feed.wait(2), self.feed.wait(1)
+        self.add(11)
+        self.assertTrue(anything.done() and ours.done())
+        self.assertFalse(other.done())
+        self.assertEqual(self.feed.woken, 2)
+
+    def test_cancel(self):
+        future = self.feed.wait(1)
+        self.feed.cancel(future, 1)
+        self.assertEqual(self.feed.stats()['waiting'], 0)
+        self.add(11)
+        self.assertFalse(future.done())
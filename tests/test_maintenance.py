@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+from unittest import mock
+
+from tornado import ioloop
+
+from possel import linestore, longpoll, maintenance, model
+from . import support
+
+
+class CompactUsersTest(support.DatabaseTestCase):
+    def setUp(self):
+        super(CompactUsersTest, self).setUp()
+        self.server = support.create_server().server_model
+        self.buffer = model.ensure_buffer('#possel', self.server)
+        self.old, self.new = [model.IRCUserModel.create(nick='alice', nick_key='alice', server=self.server,
+                                                        current=False) for _ in range(2)]
+        self.unused = model.IRCUserModel.create(nick='bob', nick_key='bob', server=self.server, current=False)
+
+    def add_lines(self):
+        for user in (self.old, self.new):
+            model.create_line(buffer=self.buffer, server=self.server, user=user, nick=user.nick, kind='message',
+                              content='hello')
+
+    def compact(self, **kwargs):
+        return ioloop.IOLoop.current().run_sync(lambda: maintenance.compact_users(**kwargs))
+
+    def remaining(self):
+        users = model.IRCUserModel.select().where(model.IRCUserModel.current == False)  # noqa: E712
+        return [user.id for user in users]
+
+    def test_compact(self):
+        self.add_lines()
+        model.recent_lines.get(self.buffer.id, 10)  # warm the cache
+        result = self.compact(batch_size=1)
+        self.assertEqual(result, {'skipped': False, 'merged': 1, 'deleted': 2})
+        self.assertEqual(self.remaining(), [self.new.id])
+
+        self.assertEqual({line['user'] for line in model.line_store.lines(self.buffer.id)}, {self.new.id})
+        self.assertEqual({line['user'] for line in model.recent_lines.get(self.buffer.id, 10)}, {self.new.id})
+        self.assertEqual({line['user'] for line in longpoll.feed.since(0)}, {self.new.id})
+
+    def test_members_kept(self):
+        self.add_lines()
+        model.ensure_membership(self.buffer, self.unused)
+        self.assertEqual(self.compact()['deleted'], 1)
+        self.assertTrue(model.IRCUserModel.select().where(model.IRCUserModel.id == self.unused.id).exists())
+
+    def test_sharded_unwritten_lines_kept(self):
+        model.line_store = linestore.ShardedLineStore(os.path.join(self.directory, 'lines'))
+        released = threading.Event()
+        self.addCleanup(released.set)
+        with mock.patch.object(linestore.Shard, '_commit', side_effect=lambda rows: released.wait()):
+            self.add_lines()
+            self.assertEqual(len(model.line_store.unwritten()), 2)
+            result = self.compact(batch_size=1)
+        self.assertEqual(result, {'skipped': False, 'merged': 0, 'deleted': 1})
+        self.assertEqual(self.remaining(), [self.old.id, self.new.id])
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import peewee as p
+
+from possel import model
+from . import support
+
+
+class CasemappingTest(unittest.TestCase):
+    def test_rfc1459(self):
+        self.assertEqual(model.nick_key('Alice[]\\~'), 'alice{}|^')
+        self.assertEqual(model.nick_key('Alice[]\\~', 'rfc1459'), model.nick_key('alice{}|^', 'rfc1459'))
+
+    def test_strict_rfc1459(self):
+        self.assertEqual(model.nick_key('Alice[]\\~', 'strict-rfc1459'), 'alice{}|~')
+
+    def test_ascii(self):
+        self.assertEqual(model.nick_key('Alice[]\\~', 'ascii'), 'alice[]\\~')
+
+    def test_unknown_casemapping_folds_unicode(self):
+        self.assertEqual(model.nick_key('Straße', 'rfc7613'), 'strasse')
+
+    def test_server_nick_key(self):
+        model._casemappings[1] = 'ascii'
+        self.addCleanup(model._casemappings.clear)
+        self.assertEqual(model.server_nick_key('A[', 1), 'a[')
+        self.assertEqual(model.server_nick_key('A[', 2), 'a{')
+
+
+class CurrentUserTest(support.DatabaseTestCase):
+    def setUp(self):
+        super(CurrentUserTest, self).setUp()
+        self.interface = support.create_server()
+        self.server = self.interface.server_model
+
+    def current_users(self):
+        return [user.nick for user in model.IRCUserModel.select().where(model.IRCUserModel.current == True)  # noqa
+                .order_by(model.IRCUserModel.id)]
+
+    def test_one_current_user_per_nick_key(self):
+        model.ensure_user('Alice', self.server)
+        with self.assertRaises(p.IntegrityError):
+            with model.database.atomic():
+                model.IRCUserModel.create(nick='ALICE', nick_key='alice', server=self.server, current=True)
+        model.IRCUserModel.create(nick='ALICE', nick_key='alice', server=self.server, current=False)
+
+    def test_claiming_a_current_nick(self):
+        model.ensure_user('Alice', self.server)
+        with self.assertRaises(p.IntegrityError):
+            model.create_user('ALICE', self.server)
+        bob = model.ensure_user('bob', self.server)
+        with self.assertRaises(p.IntegrityError):
+            model.update_user(bob, nick='alice')
+        self.assertEqual((bob.nick, bob.nick_key), ('bob', 'bob'))
+        self.assertEqual(self.current_users(), ['Alice', 'bob'])
+
+    def test_ensure_user_follows_case_changes(self):
+        first = model.ensure_user('Alice', self.server)
+        second = model.ensure_user('alice', self.server)
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(self.current_users(), ['alice'])
+
+    def test_casemapping_change_merges_users(self):
+        model.set_casemapping(self.server, 'ascii')
+        buffer = model.ensure_buffer('#possel', self.server)
+        model.ensure_membership(buffer, model.ensure_user('a[', self.server))
+        newest = model.ensure_user('a{', self.server)
+
+        model.set_casemapping(self.server, 'rfc1459')
+        self.assertEqual(self.current_users(), ['a{'])
+        members = model.IRCBufferMembershipRelation.select().where(model.IRCBufferMembershipRelation.buffer == buffer)
+        self.assertEqual([membership.user_id for membership in members], [newest.id])
+
+    def test_index_made_over_existing_duplicates(self):
+        model.database.execute_sql('DROP INDEX ircusermodel_unique_current_nick_key')
+        for nick in ('Bob', 'bob'):
+            model.IRCUserModel.create(nick=nick, nick_key='bob', server=self.server, current=True)
+
+        model.initialize()
+        self.assertEqual(self.current_users(), ['bob'])
+        with self.assertRaises(p.IntegrityError):
+            model.IRCUserModel.create(nick='BOB', nick_key='bob', server=self.server, current=True)
+
+    def test_our_nick_change_saved_whatever_the_case(self):
+        self.interface.server_handler.event('join', 'possel!possel@host', '#possel')
+        identity = self.interface.server_handler.identity
+        identity.nick = 'Possel'  # the protocol handler changes it before telling us, but doesn't save it
+        self.interface.server_handler.event('nick', 'possel!possel@host', 'POSSEL')
+        self.assertEqual(model.UserDetails.get(id=identity.id).nick, 'Possel')
+
+
+class SystemBufferTest(support.DatabaseTestCase):
+    def system_buffers(self):
+        buffers = model.IRCBufferModel.select().where(model.IRCBufferModel.kind == 'system',
+                                                      model.IRCBufferModel.server.is_null(False))
+        return sorted((buffer.server_id, buffer.name) for buffer in buffers)
+
+    def test_made_with_the_server(self):
+        server = support.create_server().server_model
+        self.assertEqual(self.system_buffers(), [(server.id, server.host)])
+
+    def test_get_all_makes_missing_ones(self):
+        first = support.create_server().server_model
+        second = support.create_server(host='irc.example.net').server_model
+        model.IRCBufferModel.delete().where(model.IRCBufferModel.server == second).execute()
+
+        interfaces = model.IRCServerInterface.get_all()
+        self.assertEqual(self.system_buffers(), [(first.id, first.host), (second.id, second.host)])
+        self.assertEqual(interfaces[second.id].system_buffer.name, second.host)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import types
+import unittest
+from unittest import mock
+
+from possel import outbound
+
+
+class SplitMessageTest(unittest.TestCase):
+    def test_short(self):
+        self.assertEqual(outbound.split_message('PRIVMSG', '#possel', 'hello\nworld'), ['hello', 'world'])
+
+    def test_long_lines_fit(self):
+        content = ' '.join(['wörd'] * 300)
+        lines = outbound.split_message('PRIVMSG', '#possel', content, '\1ACTION ', '\1')
+        self.assertGreater(len(lines), 1)
+        for line in lines:
+            self.assertTrue(line.startswith('\1ACTION ') and line.endswith('\1'))
+            wire = ':{} PRIVMSG #possel :{}\r\n'.format('x' * (outbound.PREFIX_ALLOWANCE - 2), line)
+            self.assertLessEqual(len(wire.encode()), outbound.MAX_LINE_BYTES)
+        self.assertEqual(' '.join(line[8:-1] for line in lines), content)
+
+    def test_limit_narrower_than_a_character(self):
+        self.assertEqual(list(outbound._split_line('añ€b', 1)), ['a', 'ñ', '€', 'b'])
+        self.assertEqual(list(outbound._split_line('€€€', 4)), ['€', '€', '€'])
+
+
+class OutboundQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.handler = mock.Mock()
+        self.interface = types.SimpleNamespace(server_handler=self.handler,
+                                               server_model=types.SimpleNamespace(host='irc.example.org'))
+        self.queue = outbound.OutboundQueue(self.interface, penalty=2.0, bytes_per_second=120, burst=10.0,
+                                            clock=lambda: self.now)
+        self.io_loop = mock.patch('tornado.ioloop.IOLoop.current').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def sent(self):
+        return [call[1][1] for call in self.handler.send_message.mock_calls]
+
+    def test_burst_then_wait(self):
+        for i in range(10):
+            self.queue.send_message('#possel', str(i))
+        # Each costs a little over 2s, so five fit in the 10s burst
+        self.assertEqual(self.sent(), ['0', '1', '2', '3', '4'])
+        self.assertEqual(self.queue.waited, 1)
+        self.assertEqual(self.io_loop.return_value.call_later.call_count, 1)
+
+        # Waiting to send doesn't send anything more
+        self.queue.send_message('#possel', 'more')
+        self.assertEqual(len(self.sent()), 5)
+
+        self.now = 5.0
+        self.queue.flush()
+        self.assertEqual(self.sent()[5:], ['5', '6'])
+
+    def test_interactive_jumps_the_queue(self):
+        self.queue.send_message('#possel', '\n'.join(str(i) for i in range(10)))  # a paste
+        self.queue.send_message('#possel', 'typed')
+        self.now = 100.0
+        self.queue.flush()
+        self.assertEqual(self.sent()[5], 'typed')
+
+    def test_dropped_when_disconnected(self):
+        self.interface.server_handler = None
+        self.queue.join('#possel')
+        self.assertEqual((self.queue.sent, self.queue.dropped), (0, 1))
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import types
+import unittest
+
+from tornado import websocket
+
+from possel import push
+
+
+class SubscriptionsTest(unittest.TestCase):
+    def setUp(self):
+        self.subscriptions = push.Subscriptions()
+        self.old, self.new = object(), object()
+        self.subscriptions.add(self.old)
+        self.subscriptions.add(self.new)
+
+    def for_buffer(self, buffer_id):
+        return dict(self.subscriptions.for_buffer(buffer_id))
+
+    def test_unsubscribed_get_everything(self):
+        self.assertEqual(self.for_buffer(1), {self.old: push.FULL, self.new: push.FULL})
+        self.assertEqual(self.subscriptions.for_server(1), {self.old, self.new})
+
+    def test_buffer_levels(self):
+        self.subscriptions.subscribe(self.new, buffers={1: push.FULL, 2: push.NONE}, default=push.ACTIVITY)
+        self.assertEqual(self.for_buffer(1), {self.old: push.FULL, self.new: push.FULL})
+        self.assertEqual(self.for_buffer(2), {self.old: push.FULL})
+        self.assertEqual(self.for_buffer(3), {self.old: push.FULL, self.new: push.ACTIVITY})
+
+    def test_servers(self):
+        self.subscriptions.subscribe(self.new, servers=[1])
+        self.assertEqual(self.subscriptions.for_server(1), {self.old, self.new})
+        self.assertEqual(self.subscriptions.for_server(2), {self.old})
+        self.subscriptions.subscribe(self.new)
+        self.assertEqual(self.subscriptions.for_server(2), {self.old, self.new})
+
+    def test_resubscribe_replaces(self):
+        self.subscriptions.subscribe(self.new, buffers={1: push.FULL})
+        self.subscriptions.subscribe(self.new, buffers={2: push.FULL})
+        self.assertEqual(self.for_buffer(1), {self.old: push.FULL})
+        self.assertEqual(self.subscriptions.stats()['indexed_buffers'], 1)
+
+    def test_remove(self):
+        self.subscriptions.subscribe(self.new, servers=[1], buffers={1: push.FULL}, default=push.FULL)
+        self.subscriptions.remove(self.new)
+        self.subscriptions.remove(self.old)
+        self.assertEqual(self.for_buffer(1), {})
+        self.assertEqual(self.subscriptions.for_server(1), set())
+        self.assertEqual(self.subscriptions.everyone(), set())
+        self.assertEqual(self.subscriptions.stats()['indexed_buffers'], 0)
+
+
+class SubscribeMessageTest(unittest.TestCase):
+    def setUp(self):
+        self.pusher = push.ResourcePusher.__new__(push.ResourcePusher)
+        self.addCleanup(push.subscriptions.remove, self.pusher)
+
+    def test_subscribe(self):
+        self.pusher.on_message(json.dumps({'type': 'subscribe', 'servers': [1], 'buffers': {'3': 'full'}}))
+        self.assertEqual(dict(push.subscriptions.for_buffer(3)).get(self.pusher), push.FULL)
+
+    def test_bad_messages_ignored(self):
+        for message in ({'type': 'subscribe', 'buffers': [3]},
+                        {'type': 'subscribe', 'buffers': 'full'},
+                        {'type': 'subscribe', 'servers': '12'},
+                        {'type': 'subscribe', 'servers': ['one']},
+                        {'type': 'subscribe', 'default': 'most'},
+                        {'type': 'unsubscribe'},
+                        ['subscribe']):
+            with self.assertLogs(push.logger, 'WARNING'):
+                self.pusher.on_message(json.dumps(message))
+        self.assertNotIn(self.pusher, push.subscriptions.everyone())
+
+
+class FakePusher:
+    def __init__(self, last_seen, closed=False):
+        self.request = types.SimpleNamespace(remote_ip='127.0.0.1')
+        self.last_seen = last_seen
+        self.closed = closed
+        self.pings = 0
+
+    def ping(self, data):
+        if self.closed:
+            raise websocket.WebSocketClosedError()
+        self.pings += 1
+
+    def close(self):
+        self.closed = True
+
+
+class HeartbeatTest(unittest.TestCase):
+    def setUp(self):
+        self.heartbeat = push.Heartbeat()
+        now = time.monotonic()
+        self.live, self.silent, self.gone = FakePusher(now), FakePusher(now - 100), FakePusher(now, closed=True)
+        for pusher in (self.live, self.silent, self.gone):
+            push.subscriptions.add(pusher)
+            self.addCleanup(push.subscriptions.remove, pusher)
+
+    def test_beat(self):
+        with self.assertLogs(push.logger, 'INFO') as logs:
+            self.heartbeat.beat()
+        self.assertEqual(push.subscriptions.everyone(), {self.live})
+        self.assertEqual((self.live.pings, self.heartbeat.reaped), (1, 2))
+        self.assertEqual(sorted(message.split(', ', 1)[1] for message in logs.output),
+                         ['connection already closed', 'nothing heard for 100s'])
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Query counts for each IRC event and the hot API paths, with strict budgets on so going over one fails outright. If
+you've made something cheaper, lower its count here and its budget with it.
+"""
+from tornado import httpclient, websocket
+
+from possel import model, monitor, push, queries
+from . import support
+
+
+class QueryBudgetTest(support.APITestCase):
+    def setUp(self):
+        super(QueryBudgetTest, self).setUp()
+        queries.enable(strict_budgets=True)
+        queries.violations.clear()
+        self.interface = support.create_server()
+        self.interfaces[self.interface.server_model.id] = self.interface
+        self.handler = self.interface.server_handler
+
+    def tearDown(self):
+        queries.strict = False
+        super(QueryBudgetTest, self).tearDown()
+
+    def assert_queries(self, expected, function, *args):
+        start = monitor.monitor.queries
+        function(*args)
+        self.assertEqual(monitor.monitor.queries - start, expected)
+        self.assertEqual(list(queries.violations), [])
+
+    def event(self, signal, prefix, *args):
+        self.handler.event(signal, prefix, *args)
+
+    def test_budgeted_irc_events(self):
+        self.assert_queries(8, self.event, 'join', 'possel!possel@host', '#possel')
+        self.assert_queries(6, self.event, 'join', 'alice!alice@host', '#possel')
+        self.assert_queries(3, self.event, 'privmsg', 'alice!alice@host', '#possel', 'hello')
+        self.assert_queries(4, self.event, 'privmsg', 'alice!alice@host', 'possel', 'just you')
+        self.assert_queries(5, self.event, 'privmsg', 'bob!bob@host', 'possel', 'who are you?')
+        self.assert_queries(3, self.event, 'notice', 'alice!alice@host', '#possel', 'hello')
+        self.assert_queries(1, self.event, 'notice', 'irc.example.org', 'possel', 'server notice')
+        self.assert_queries(2, self.event, 'rpl_topic', 'irc.example.org', 'possel', '#possel', 'the topic')
+        self.assert_queries(5, self.event, 'part', 'alice!alice@host', '#possel', 'bye')
+        self.assert_queries(6, self.event, 'part', 'possel!possel@host', '#possel', 'bye')
+
+    def test_unbudgeted_irc_events(self):
+        self.event('join', 'possel!possel@host', '#possel')
+        self.event('join', 'alice!alice@host', '#possel')
+        self.event('join', 'alice!alice@host', '#other')
+
+        # A few queries per name
+        self.assert_queries(14, self.event, 'rpl_namreply', 'irc.example.org', 'possel', '=', '#possel',
+                            '@possel alice bob carol')
+        # A few per buffer the user's in
+        self.assert_queries(6, self.event, 'nick', 'alice!alice@host', 'alicia')
+        self.assert_queries(8, self.event, 'quit', 'alicia!alice@host', 'bye')
+        # Re-keys the server's users
+        self.assert_queries(3, self.event, 'rpl_isupport', 'irc.example.org', 'possel', 'CASEMAPPING=ascii',
+                            'are supported by this server')
+
+        self.assert_queries(0, self.event, 'rpl_welcome', 'irc.example.org', 'possel', 'Welcome')
+        self.assert_queries(1, self.event, 'rpl_motd', 'irc.example.org', 'possel', '- hello')
+        self.assert_queries(2, self.event, 'rpl_topicwhotime', 'irc.example.org', 'possel', '#possel',
+                            'alice!alice@host', '1400000000')
+        self.assert_queries(0, self.event, 'rpl_notopic', 'irc.example.org', 'possel', '#possel', 'No topic')
+
+    def test_lines(self):
+        self.event('join', 'possel!possel@host', '#possel')
+        buffer_id = model.IRCBufferModel.get(name='#possel').id
+
+        self.assert_queries(3, self.get, '/line?buffer={}&last=50'.format(buffer_id))
+        self.assert_queries(2, self.get, '/line?buffer={}&last=50'.format(buffer_id))  # cached now
+        self.assert_queries(3, self.get, '/line?buffer={}&after=1'.format(buffer_id))
+        self.assert_queries(2, self.get, '/line?ids=1,2,3')
+
+    def test_buffers_and_users(self):
+        self.event('join', 'possel!possel@host', '#possel')
+        self.event('rpl_namreply', 'irc.example.org', 'possel', '=', '#possel', '@possel alice bob')
+        buffer_id = model.IRCBufferModel.get(name='#possel').id
+
+        for path in ['/buffer/all', '/buffer/{}'.format(buffer_id), '/buffer?ids=1,2', '/user/all',
+                     '/user?buffer={}'.format(buffer_id), '/user?ids=1,2', '/user/all?history=1']:
+            self.assert_queries(2, self.get, path)
+
+    def connect(self):
+        request = httpclient.HTTPRequest('ws://localhost:{}/push'.format(self.get_http_port()),
+                                         headers={'Cookie': self.cookie})
+        connection = self.io_loop.run_sync(lambda: websocket.websocket_connect(request))
+        message = self.io_loop.run_sync(connection.read_message)  # the last line, sent once it's open
+        connection.close()
+        self.assertIsNotNone(message)
+
+    def test_push_open(self):
+        # Authenticating, then loading our unread counts (with every buffer's, the first time) and the last line id
+        self.assert_queries(1 + push.OPEN_QUERY_BUDGET, self.connect)
+        # Once the counts are loaded they're kept up to date in memory
+        self.assert_queries(2, self.connect)
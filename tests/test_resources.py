@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import json
+from unittest import mock
+
+from possel import debug, longpoll, model, resources
+from . import support
+
+
+class RosterTest(support.APITestCase):
+    def setUp(self):
+        super(RosterTest, self).setUp()
+        self.interface = support.create_server()
+        self.handler = self.interface.server_handler
+        self.handler.event('join', 'possel!possel@host', '#possel')
+        self.handler.event('rpl_namreply', 'irc.example.org', 'possel', '=', '#possel', '@possel alice +bob')
+        self.buffer_id = model.IRCBufferModel.get(name='#possel').id
+        self.users = {user.nick: user.id for user in model.IRCUserModel.select()}
+
+    def members(self):
+        code, roster = self.get('/roster/{}'.format(self.buffer_id))
+        return {user_id: modes for user_id, modes in roster['members']}
+
+    def test_modes_follow_mode_changes(self):
+        self.handler.event('mode', 'possel!possel@host', '#possel', '+o-v+l', 'alice', 'bob', '10')
+        self.handler.event('mode', 'possel!possel@host', '#possel', '+bv', '*!*@spam', 'carol')  # carol isn't here
+        self.assertEqual(self.members(), {self.users['possel']: '@', self.users['alice']: '@', self.users['bob']: ''})
+
+    def test_delta(self):
+        code, roster = self.get('/roster/{}'.format(self.buffer_id))
+        self.handler.event('mode', 'possel!possel@host', '#possel', '+v', 'alice')
+        code, delta = self.get('/roster/{}?since={}'.format(self.buffer_id, roster['version']))
+        self.assertEqual(delta['changes'], [[self.users['alice'], '+']])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.get('/roster/{}?since=yesterday'.format(self.buffer_id))[0], 400)
+        self.assertEqual(self.get('/roster/12345')[0], 404)
+        self.assertEqual(self.get('/roster/12345?since=1')[0], 404)
+        self.assertEqual(model.rosters.stats()['buffers'], 1)
+
+
+class LinesTest(support.APITestCase):
+    def setUp(self):
+        super(LinesTest, self).setUp()
+        server = support.create_server().server_model
+        self.buffer = model.ensure_buffer('#possel', server)
+        for i in range(3):
+            model.create_line(buffer=self.buffer, server=server, nick='alice', kind='message', content=str(i))
+
+    def test_last(self):
+        path = '/line?buffer={}&last={}'
+        self.assertEqual([line['content'] for line in self.get(path.format(self.buffer.id, 2))[1]], ['2', '1'])
+        self.assertEqual(self.get(path.format(self.buffer.id, 0)), (200, []))
+        self.assertEqual(len(self.get(path.format(self.buffer.id, 'yes'))[1]), 1)
+        self.assertEqual(self.get(path.format(self.buffer.id, -1))[0], 400)
+
+    def test_range_capped(self):
+        with mock.patch.object(resources, 'MAX_RANGE_LINES', 2):
+            for path in ('/line?after=1', '/line?buffer={}&after=1'.format(self.buffer.id)):
+                self.assertEqual([line['content'] for line in self.get(path)[1]], ['0', '1'])
+
+
+class DebugTest(support.APITestCase):
+    def get_app(self):
+        app = super(DebugTest, self).get_app()
+        app.settings['admins'] = (support.USERNAME,)
+        return app
+
+    def post(self, path, body):
+        response = self.fetch(path, method='POST', body=json.dumps(body),
+                              headers={'Cookie': self.cookie, 'Content-Type': 'application/json'})
+        return response.code
+
+    def test_memory_limit(self):
+        self.assertEqual(self.get('/debug/memory?limit=lots')[0], 400)
+        self.assertEqual(self.get('/debug/memory?limit=0')[0], 400)
+        self.assertEqual(self.get('/debug/memory?limit=5')[0], 409)  # tracemalloc isn't running
+
+    def test_profile_interval(self):
+        for interval_ms in ('fast', True, 0, -5, 10 ** 6):
+            self.assertEqual(self.post('/debug/profile', {'action': 'start', 'interval_ms': interval_ms}), 400)
+        self.assertFalse(debug.profiler.running)
+
+
+class LineWaitTest(support.APITestCase):
+    def setUp(self):
+        super(LineWaitTest, self).setUp()
+        self.server = support.create_server().server_model
+        self.buffer = model.ensure_buffer('#possel', self.server)
+        self.last_id = model.line_store.last_id() or 0
+        longpoll.feed.configure(2, self.last_id)
+
+    def add_lines(self, count):
+        for i in range(count):
+            model.create_line(buffer=self.buffer, server=self.server, nick='alice', kind='message', content=str(i))
+
+    def test_overrun_while_waiting(self):
+        future = self.http_client.fetch(self.get_url('/line/wait?after={}&timeout=5'.format(self.last_id)),
+                                        headers={'Cookie': self.cookie})
+        self.io_loop.call_later(0.1, self.add_lines, 3)
+        response = self.io_loop.run_sync(lambda: future)
+        self.assertEqual(response.code, 200)
+        result = json.loads(response.body.decode())
+        # The feed only goes back to the second line now, the first comes from the line store
+        self.assertEqual([line['content'] for line in result['lines']], ['0'])
+        self.assertEqual(result['next'], result['lines'][0]['id'])
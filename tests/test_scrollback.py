@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from possel import model, scrollback
+from . import support
+
+
+def rows(*contents):
+    start = datetime.datetime(2015, 1, 1)
+    return [{'timestamp': start + datetime.timedelta(minutes=i), 'nick': 'alice', 'kind': 'message',
+             'content': content} for i, content in enumerate(contents)]
+
+
+class ImportTest(support.DatabaseTestCase):
+    def setUp(self):
+        super(ImportTest, self).setUp()
+        self.server = support.create_server().server_model
+        self.address = '{}:{}'.format(self.server.host, self.server.port)
+
+    def test_import_into_new_buffer(self):
+        resolver = scrollback.Resolver('possel')
+        self.assertEqual(scrollback.import_lines(rows('one', 'two'), resolver, self.address, '#old'), 2)
+        self.assertEqual(scrollback.import_lines(rows('three'), resolver, self.address, '#old'), 1)
+
+        buffer = model.IRCBufferModel.get(name='#old')
+        self.assertEqual([line['content'] for line in model.line_store.lines(buffer.id)], ['one', 'two', 'three'])
+
+    def test_refuses_buffer_with_lines(self):
+        buffer = model.ensure_buffer('#possel', self.server)
+        model.create_line(buffer=buffer, server=self.server, nick='alice', kind='message', content='hello')
+
+        with self.assertRaises(scrollback.BufferNotEmptyError):
+            scrollback.import_lines(rows('old'), scrollback.Resolver('possel'), self.address, '#possel')
+        self.assertEqual(model.line_store.count(buffer.id), 1)